@@ -1,36 +1,100 @@
 import os
 import json
 import hashlib
-from flask import Flask, render_template, request, jsonify, redirect, url_for
-import firebase_admin
-from firebase_admin import credentials, firestore, storage
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, send_file, stream_with_context
+from firebase_admin import firestore
 import config
+import metrics
+from backends import Backend
+from streaming_upload import stream_to_blob, read_chunk, MemoryLimitExceeded
+from blob_store import (
+    CONTENT_PREFIX, content_key, staging_blob_name, unique_blob_name, file_blob_name, share_blob_name, download_disposition,
+    attachment_disposition, delete_blobs, find_reference, add_reference, delete_file_bytes, delete_orphan, PREVIEW_VARIANTS
+)
+from datastore import (
+    get_all, exists, delete_all, create_unless_exists, create_unless_document_exists
+)
+from delta_sync import (
+    is_block_hash, missing_blocks, store_block, ManifestReader, save_manifest, release_manifest, BlocksMissing
+)
+from chunking import MAX_CHUNK_SIZE
+from listing_cache import create_listing_cache
+from signed_urls import SignedUrlCache, file_key, share_key
+from search_index import SearchIndex, SearchError
+from usage import USER_SCOPE, QuotaExceeded, check_quota, get_usage, quota_of
+from change_feed import (ChangeFeedBusy, ChangeFeedReset, change, record_changes, parse_cursor, poll_changes,
+                         stream_changes, hold_waiter, release_waiter)
+from previews import PreviewPipeline, previewable, PREVIEW_MIMETYPE
+from compression import decompress_chunks
+from backend_pool import gather
+from duplicate_index import create_file, delete_files, duplicate_groups, directory_duplicates, ensure_index, INDEX_READY
+from share_expiry import utc_now, expiration_of, is_expired, active_shares_query
+from directory_tree import DirectoryTree, TreeConflict, subtree_directories, reparent_directory
+from directory_jobs import (
+    join_path, is_within, locked_path, overlapping_job, create_job, job_status, needs_runner, run_job
+)
+from zip_stream import ZipEntry, iter_zip, unique_name
+from ndjson import wants_ndjson, ndjson_response
+from directory_listing import list_page, SORT_FIELDS, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from upload_sessions import (
+    chunk_count, expected_chunk_size, chunk_blob_name, verify_chunk, compose_blobs, hash_blob
+)
 import datetime
+import functools
+import itertools
 import re
+import threading
+from collections import defaultdict
 
 # Initialize Flask app
 app = Flask(__name__, static_folder='public', static_url_path='')
 
-# Initialize Firebase Admin SDK
-cred = credentials.Certificate({
-    "type": "service_account",
-    "project_id": config.GOOGLE_PROJECT_ID,
-    "private_key_id": config.GOOGLE_PRIVATE_KEY_ID,
-    "private_key": config.GOOGLE_PRIVATE_KEY,
-    "client_email": config.GOOGLE_CLIENT_EMAIL,
-    "client_id": config.GOOGLE_CLIENT_ID,
-    "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-    "token_uri": "https://oauth2.googleapis.com/token",
-    "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-    "client_x509_cert_url": config.GOOGLE_CLIENT_X509_CERT_URL
-})
-firebase_admin.initialize_app(cred, {
-    'storageBucket': config.FIREBASE_STORAGE_BUCKET
-})
-
-# Initialize Firestore and Storage
-db = firestore.client()
-bucket = storage.bucket()
+# Firestore and Storage, or their local stand-ins; each process connects on first use
+backend = Backend()
+db = backend.db
+bucket = backend.bucket
+
+# Files per /get-download-urls request
+MAX_URL_BATCH = 500
+
+# Files named explicitly in one /download-zip request
+MAX_ZIP_FILE_IDS = 1000
+
+# The user's files with a client's MD5 checked for one with the same size
+MAX_OWN_CONTENT_MATCHES = 10
+
+# Cache of directory and file listings per (user, path)
+listing_cache = create_listing_cache(config.LISTING_CACHE_SIZE, config.LISTING_CACHE_TTL, config.LISTING_CACHE_PATH)
+
+# Signed download URLs, reused until shortly before they expire
+signed_url_cache = SignedUrlCache(config.SIGNED_URL_CACHE_SIZE, config.SIGNED_URL_TTL, config.SIGNED_URL_REUSE_MARGIN)
+
+# Directory tree nodes, for resolving paths on the ID schema
+tree = DirectoryTree(db, config.TREE_CACHE_SIZE, config.TREE_CACHE_TTL)
+
+# Search indexes of users' files and directories, on this host's disk
+search_index = SearchIndex(config.SEARCH_INDEX_PATH, db, config.SEARCH_INDEX_MAX_AGE)
+
+def on_preview_ready(uid, file_data):
+    """Drop the cached listing that still shows a file's previews as pending"""
+    listing_cache.invalidate(uid, 'files', file_directory(uid, file_data))
+
+# Thumbnails and previews of uploaded images and PDFs, rendered in the background
+preview_pipeline = PreviewPipeline(
+    db, bucket, config.PREVIEW_WORKERS, config.PREVIEW_QUEUE_SIZE, config.PREVIEW_TIMEOUT,
+    config.PREVIEW_CACHE_SIZE, on_ready=on_preview_ready
+)
+
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    # Finish once the body has been sent, so streamed responses are timed whole
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    response.call_on_close(functools.partial(metrics.finish_request, route, request.method))
+    return response
 
 @app.route('/')
 def index():
@@ -59,6 +123,39 @@ def health_check():
         'version': '1.0.0'
     })
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Request latencies and backend call counts of this worker, for Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache-stats')
+def cache_stats():
+    """Hit/miss counters for the caches in this worker"""
+    return jsonify({
+        'success': True,
+        'listing_cache': listing_cache.stats(),
+        'signed_urls': signed_url_cache.stats(),
+        'directory_tree': tree.stats(),
+        'previews': preview_pipeline.stats()
+    })
+
+@app.route('/local-storage')
+def local_storage_download():
+    """Serve a file from a signed URL issued by the local storage backend"""
+    if backend.name != 'local':
+        return jsonify({'success': False, 'message': 'Not found'}), 404
+    
+    verified = bucket.verify(request.args)
+    if verified is None:
+        return jsonify({'success': False, 'message': 'Invalid or expired link'}), 403
+    
+    # send_file hands the open file to the server, which sends it with sendfile()
+    path, disposition = verified
+    response = send_file(path, conditional=True, max_age=0)
+    if disposition:
+        response.headers['Content-Disposition'] = disposition
+    return response
+
 @app.route('/init-user', methods=['POST'])
 def init_user():
     """Initialize a new user with root directory when they first log in"""
@@ -66,30 +163,58 @@ def init_user():
     uid = data.get('uid')
     email = data.get('email')
     
-    # Check if user already exists
+    # Create the user document and root directory together, only if the user is new
     user_ref = db.collection('users').document(uid)
-    user = user_ref.get()
-    
-    if not user.exists:
-        # Create user document
-        user_ref.set({
+    created = create_unless_document_exists(db, user_ref, [
+        (user_ref, {
             'email': email,
+            'duplicate_index': INDEX_READY,
+            'usage_counters': 'ready',
+            'tree_schema': 'ids',
             'created_at': firestore.SERVER_TIMESTAMP
-        })
-        
-        # Create root directory
-        db.collection('directories').document().set({
+        }),
+        (db.collection('directories').document(), {
             'user_id': uid,
             'name': '/',
             'path': '/',
             'parent_path': None,
+            'parent_id': None,
             'created_at': firestore.SERVER_TIMESTAMP
         })
-        
+    ])
+    
+    if created:
         return jsonify({'success': True, 'message': 'User initialized with root directory'})
     
     return jsonify({'success': True, 'message': 'User already exists'})
 
+def directory_id_at(uid, path, fresh=False):
+    """ID of the user's directory at `path`, or None if there is none"""
+    if tree.uses_ids(uid):
+        return tree.resolve(uid, path, fresh)
+    directories = db.collection('directories').where('user_id', '==', uid).where('path', '==', path).limit(1).get()
+    return directories[0].id if directories else None
+
+def directory_path(uid, directory_id, dir_data):
+    """Current path of a directory; stored paths go stale on the ID schema"""
+    if tree.uses_ids(uid):
+        return tree.path_of(uid, directory_id) or dir_data['path']
+    return dir_data['path']
+
+def file_directory(uid, file_data):
+    """Current path of the directory a file is in"""
+    if tree.uses_ids(uid) and file_data.get('parent_id'):
+        return tree.path_of(uid, file_data['parent_id']) or file_data['path']
+    return file_data['path']
+
+def children_query(uid, collection, path):
+    """Query for the directories or files directly in `path`, or None if there is no such directory"""
+    query = db.collection(collection).where('user_id', '==', uid)
+    if not tree.uses_ids(uid):
+        return query.where('parent_path' if collection == 'directories' else 'path', '==', path)
+    parent_id = tree.resolve(uid, path)
+    return None if parent_id is None else query.where('parent_id', '==', parent_id)
+
 @app.route('/get-directories', methods=['POST'])
 def get_directories():
     """Get all directories within the current path"""
@@ -97,14 +222,18 @@ def get_directories():
     uid = data.get('uid')
     current_path = data.get('path', '/')
     
-    # Query directories in the current path
-    directories = db.collection('directories').where('user_id', '==', uid).where('parent_path', '==', current_path).stream()
+    def load_directories():
+        # Query directories in the current path
+        directories = children_query(uid, 'directories', current_path)
+        
+        listing = []
+        for directory in directories.stream() if directories else []:
+            dir_data = directory.to_dict()
+            dir_data['id'] = directory.id
+            listing.append(dir_data)
+        return listing
     
-    result = []
-    for directory in directories:
-        dir_data = directory.to_dict()
-        dir_data['id'] = directory.id
-        result.append(dir_data)
+    result = list(listing_cache.get_or_load(uid, 'directories', current_path, load_directories))
     
     # Add special entry for parent directory if not in root
     if current_path != '/':
@@ -125,17 +254,133 @@ def get_files():
     uid = data.get('uid')
     current_path = data.get('path', '/')
     
-    # Query files in the current path
-    files = db.collection('files').where('user_id', '==', uid).where('path', '==', current_path).stream()
+    def load_files():
+        # Query files in the current path
+        files = children_query(uid, 'files', current_path)
+        
+        listing = []
+        for file in files.stream() if files else []:
+            file_data = file.to_dict()
+            file_data['id'] = file.id
+            listing.append(file_data)
+        return listing
     
-    result = []
-    for file in files:
-        file_data = file.to_dict()
-        file_data['id'] = file.id
-        result.append(file_data)
+    result = listing_cache.get_or_load(uid, 'files', current_path, load_files)
     
     return jsonify({'success': True, 'files': result})
 
+@app.route('/list-directory', methods=['POST'])
+def list_directory():
+    """Get one page of the directories and files within the current directory"""
+    data = request.json
+    uid = data.get('uid')
+    current_path = data.get('path', '/')
+    sort = data.get('sort', 'name')
+    order = data.get('order', 'asc')
+    cursor = data.get('cursor')
+    
+    if sort not in SORT_FIELDS or order not in ('asc', 'desc'):
+        return jsonify({'success': False, 'message': 'Invalid sort option'})
+    
+    parent_id = None
+    if tree.uses_ids(uid):
+        parent_id = tree.resolve(uid, current_path)
+        if parent_id is None:
+            return jsonify({'success': False, 'message': 'Directory not found'})
+    
+    try:
+        page_size = min(max(int(data.get('page_size', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        directories, files, next_cursor = list_page(
+            db, uid, current_path, sort, order == 'desc', page_size, cursor, parent_id
+        )
+    except (ValueError, TypeError):
+        return jsonify({'success': False, 'message': 'Invalid page request'})
+    
+    # Add special entry for parent directory to the first page if not in root
+    if current_path != '/' and not cursor:
+        directories.insert(0, {
+            'id': 'parent',
+            'name': '..',
+            'path': '../',
+            'parent_path': current_path,
+            'is_special': True
+        })
+    
+    return jsonify({
+        'success': True,
+        'directories': directories,
+        'files': files,
+        'next_cursor': next_cursor
+    })
+
+@app.route('/list-changes', methods=['GET', 'POST'])
+def get_changes():
+    """Get the changes to the user's files, directories and shares after a cursor, optionally waiting for one"""
+    data = request.get_json(silent=True) or request.values
+    uid = data.get('uid')
+    if not uid:
+        return jsonify({'success': False, 'message': 'User ID is required'})
+    
+    try:
+        cursor = parse_cursor(data.get('cursor'))
+        wait = min(max(float(data.get('wait', 0)), 0), config.CHANGE_FEED_MAX_WAIT)
+    except (ValueError, TypeError):
+        return jsonify({'success': False, 'message': 'Invalid cursor'})
+    
+    try:
+        changes, next_cursor, has_more = poll_changes(db, uid, cursor, wait)
+    except ChangeFeedReset as e:
+        # Too far behind to catch up from the feed, so list again from this cursor
+        return jsonify({'success': True, 'reset': True, 'changes': [], 'cursor': e.cursor, 'has_more': False})
+    except ChangeFeedBusy as e:
+        return busy_response(str(e))
+    
+    return jsonify({
+        'success': True,
+        'reset': False,
+        'changes': changes,
+        'cursor': next_cursor,
+        'has_more': has_more
+    })
+
+@app.route('/change-stream')
+def change_stream():
+    """Stream the changes to the user's files, directories and shares as server-sent events"""
+    # Each open stream holds a worker thread, so streams are only served when
+    # the deployment is sized for them (see DEPLOYMENT.md)
+    if not config.CHANGE_STREAM_ENABLED:
+        return jsonify({'success': False, 'message': 'Change streams are turned off, use /list-changes'}), 404
+    
+    uid = request.args.get('uid')
+    if not uid:
+        return jsonify({'success': False, 'message': 'User ID is required'})
+    
+    # A reconnecting EventSource resumes after the last change it saw
+    try:
+        cursor = parse_cursor(request.headers.get('Last-Event-ID') or request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid cursor'})
+    
+    try:
+        hold_waiter()
+    except ChangeFeedBusy as e:
+        return busy_response(str(e))
+    
+    events = stream_changes(db, uid, cursor, config.CHANGE_STREAM_DURATION)
+    response = Response(stream_with_context(events), mimetype='text/event-stream', headers={
+        'X-Accel-Buffering': 'no',
+        'Cache-Control': 'no-cache'
+    })
+    response.call_on_close(release_waiter)
+    return response
+
+def busy_response(message):
+    """503 asking the client to come back once a waiting request has finished"""
+    response = jsonify({'success': False, 'message': message})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, round(config.CHANGE_FEED_POLL_INTERVAL)))
+    return response
+
 @app.route('/create-directory', methods=['POST'])
 def create_directory():
     """Create a new directory"""
@@ -148,27 +393,45 @@ def create_directory():
     if not dir_name or '/' in dir_name or dir_name == '..':
         return jsonify({'success': False, 'message': 'Invalid directory name'})
     
-    # Check for duplicate directories
+    if locked_path(db, uid, current_path):
+        return jsonify({'success': False, 'message': 'This folder is being moved or deleted, try again shortly'})
+    
+    parent_id = directory_id_at(uid, current_path, fresh=True)
+    if parent_id is None:
+        return jsonify({'success': False, 'message': 'Parent directory not found'})
+    
+    # Create the directory, unless one with the same name exists there (checked atomically)
     new_path = current_path + ('' if current_path.endswith('/') else '/') + dir_name
-    existing_dirs = db.collection('directories').where('user_id', '==', uid).where('path', '==', new_path).get()
+    existing_dirs = db.collection('directories').where('user_id', '==', uid)
+    if tree.uses_ids(uid):
+        existing_dirs = existing_dirs.where('parent_id', '==', parent_id).where('name', '==', dir_name)
+    else:
+        existing_dirs = existing_dirs.where('path', '==', new_path)
+    dir_ref = db.collection('directories').document()
+    created = create_unless_exists(db, existing_dirs, [
+        (dir_ref, {
+            'user_id': uid,
+            'name': dir_name,
+            'path': new_path,
+            'parent_path': current_path,
+            'parent_id': parent_id,
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+    ])
     
-    if len(existing_dirs) > 0:
+    if not created:
         return jsonify({'success': False, 'message': 'Directory already exists'})
     
-    # Create the directory
-    db.collection('directories').document().set({
-        'user_id': uid,
-        'name': dir_name,
-        'path': new_path,
-        'parent_path': current_path,
-        'created_at': firestore.SERVER_TIMESTAMP
-    })
+    tree.remember(uid, dir_ref.id, parent_id, dir_name)
+    listing_cache.invalidate(uid, 'directories', current_path)
+    search_index.add_directory(uid, dir_ref.id, dir_name, current_path)
+    record_changes(db, uid, [change('create', 'directory', dir_ref.id, dir_name, current_path)])
     
     return jsonify({'success': True, 'message': 'Directory created successfully'})
 
 @app.route('/delete-directory', methods=['POST'])
 def delete_directory():
-    """Delete a directory if it's empty"""
+    """Delete a directory if it's empty, or with everything in it if `recursive`"""
     data = request.json
     uid = data.get('uid')
     directory_id = data.get('directory_id')
@@ -177,26 +440,174 @@ def delete_directory():
     dir_ref = db.collection('directories').document(directory_id)
     directory = dir_ref.get()
     
-    if not directory.exists:
+    if not directory.exists or directory.get('user_id') != uid:
         return jsonify({'success': False, 'message': 'Directory not found'})
     
     dir_data = directory.to_dict()
-    
-    # Check for files in directory
-    files = db.collection('files').where('user_id', '==', uid).where('path', '==', dir_data['path']).get()
-    if len(files) > 0:
+    path = directory_path(uid, directory_id, dir_data)
+    if path == '/':
+        return jsonify({'success': False, 'message': 'Cannot delete the root directory'})
+    
+    if data.get('recursive', False):
+        if tree.uses_ids(uid):
+            return start_directory_job(uid, 'delete_tree', path, extra={'stack': [directory_id], 'directory_id': directory_id})
+        return start_directory_job(uid, 'delete', path, extra={'directory_id': directory_id})
+    
+    # Check for files and subdirectories in directory at the same time
+    files = db.collection('files').where('user_id', '==', uid)
+    subdirectories = db.collection('directories').where('user_id', '==', uid)
+    if tree.uses_ids(uid):
+        files = files.where('parent_id', '==', directory_id)
+        subdirectories = subdirectories.where('parent_id', '==', directory_id)
+    else:
+        files = files.where('path', '==', path)
+        subdirectories = subdirectories.where('parent_path', '==', path)
+    has_files, has_subdirectories = gather(lambda: exists(files), lambda: exists(subdirectories))
+    
+    if has_files:
         return jsonify({'success': False, 'message': 'Cannot delete directory with files'})
     
-    # Check for subdirectories
-    subdirs = db.collection('directories').where('user_id', '==', uid).where('parent_path', '==', dir_data['path']).get()
-    if len(subdirs) > 0:
+    if has_subdirectories:
         return jsonify({'success': False, 'message': 'Cannot delete directory with subdirectories'})
     
     # Delete the directory
     dir_ref.delete()
+    tree.forget(uid, directory_id)
+    listing_cache.invalidate(uid, 'directories', path.rpartition('/')[0] or '/')
+    listing_cache.invalidate(uid, 'directory', directory_id)
+    search_index.remove(uid, [directory_id])
+    record_changes(db, uid, [change('delete', 'directory', directory_id, dir_data['name'], path.rpartition('/')[0] or '/')])
     
     return jsonify({'success': True, 'message': 'Directory deleted successfully'})
 
+@app.route('/move-directory', methods=['POST'])
+def move_directory():
+    """Move and/or rename a directory with everything in it"""
+    data = request.json
+    uid = data.get('uid')
+    directory_id = data.get('directory_id')
+    
+    directory = db.collection('directories').document(directory_id).get()
+    if not directory.exists or directory.get('user_id') != uid:
+        return jsonify({'success': False, 'message': 'Directory not found'})
+    
+    dir_data = directory.to_dict()
+    source = directory_path(uid, directory_id, dir_data)
+    if source == '/':
+        return jsonify({'success': False, 'message': 'Cannot move the root directory'})
+    
+    parent_path = data.get('target_path') or source.rpartition('/')[0] or '/'
+    new_name = data.get('new_name') or dir_data['name']
+    
+    if '/' in new_name or new_name == '..':
+        return jsonify({'success': False, 'message': 'Invalid directory name'})
+    
+    target = join_path(parent_path, new_name)
+    if target == source:
+        return jsonify({'success': False, 'message': 'Directory is already there'})
+    if is_within(target, source):
+        return jsonify({'success': False, 'message': 'Cannot move a directory into itself'})
+    
+    if overlapping_job(db, uid, source, target) is not None:
+        return jsonify({'success': False, 'message': 'Another move or delete is in progress for this folder'})
+    
+    schema = tree.schema(uid)
+    if schema == 'migrating':
+        return jsonify({'success': False, 'message': 'Your files are being upgraded, try again shortly'})
+    
+    parent_id = directory_id_at(uid, parent_path, fresh=True)
+    if parent_id is None:
+        return jsonify({'success': False, 'message': 'Target directory not found'})
+    
+    if schema == 'ids':
+        # Only the directory's own document changes; everything below follows its parent link
+        try:
+            reparent_directory(db, uid, directory_id, parent_id, new_name)
+        except TreeConflict as e:
+            return jsonify({'success': False, 'message': str(e)})
+        tree.remember(uid, directory_id, parent_id, new_name)
+        listing_cache.invalidate(uid)
+        search_index.move(uid, directory_id, source, target)
+        record_changes(db, uid, [directory_move(directory_id, source, target)])
+        return jsonify({'success': True, 'message': 'Directory moved'})
+    
+    if exists(db.collection('directories').where('user_id', '==', uid).where('path', '==', target)):
+        return jsonify({'success': False, 'message': 'Directory already exists'})
+    
+    return start_directory_job(uid, 'move', source, target, extra={'target_parent_id': parent_id, 'directory_id': directory_id})
+
+def directory_move(directory_id, source, target):
+    """Change feed entry for a directory moved or renamed from `source` to `target`"""
+    parent_path, _, name = target.rpartition('/')
+    return change('move', 'directory', directory_id, name, parent_path or '/', source=source, target=target)
+
+def start_directory_job(uid, job_type, source, target=None, extra=None):
+    """Record a move or recursive delete and run it in the background"""
+    paths = [source] if target is None else [source, target]
+    if overlapping_job(db, uid, *paths) is not None:
+        return jsonify({'success': False, 'message': 'Another move or delete is in progress for this folder'})
+    
+    job_id = create_job(db, uid, job_type, source, target, extra)
+    start_job_runner(job_id)
+    
+    return jsonify({'success': True, 'job_id': job_id, 'message': 'Started'})
+
+def start_job_runner(job_id, resume_failed=False):
+    threading.Thread(
+        target=run_job, args=(db, bucket, job_id, on_job_change, resume_failed, on_job_done), daemon=True
+    ).start()
+
+def on_job_change(uid, file_ids, share_ids):
+    """Drop cached listings and URLs that a directory job step made stale"""
+    # Paths change across the whole subtree, so drop all of the user's listings
+    listing_cache.invalidate(uid)
+    search_index.invalidate(uid)
+    for file_id in file_ids:
+        signed_url_cache.invalidate(file_key(file_id))
+    for share_id in share_ids:
+        signed_url_cache.invalidate(share_key(share_id))
+
+def on_job_done(job):
+    """Record a finished directory job in the change feed; clients list the directories it touched again"""
+    if job['type'] == 'move':
+        entry = directory_move(job.get('directory_id'), job['source'], job['target'])
+    else:
+        parent_path, _, name = job['source'].rpartition('/')
+        entry = change('delete', 'directory', job.get('directory_id'), name, parent_path or '/')
+    record_changes(db, job['user_id'], [entry])
+
+@app.route('/job-status', methods=['POST'])
+def get_job_status():
+    """Report a directory job's progress, resuming it if its runner stopped"""
+    data = request.json
+    uid = data.get('uid')
+    
+    job = db.collection('jobs').document(data.get('job_id') or 'missing').get()
+    if not job.exists or job.get('user_id') != uid:
+        return jsonify({'success': False, 'message': 'Job not found'})
+    
+    if needs_runner(job):
+        start_job_runner(job.id)
+    
+    return jsonify({'success': True, 'job': job_status(job)})
+
+@app.route('/resume-job', methods=['POST'])
+def resume_job():
+    """Retry a directory job that failed"""
+    data = request.json
+    uid = data.get('uid')
+    
+    job = db.collection('jobs').document(data.get('job_id') or 'missing').get()
+    if not job.exists or job.get('user_id') != uid:
+        return jsonify({'success': False, 'message': 'Job not found'})
+    
+    if job.get('state') == 'done':
+        return jsonify({'success': False, 'message': 'Job already finished'})
+    
+    start_job_runner(job.id, resume_failed=True)
+    
+    return jsonify({'success': True, 'message': 'Resumed'})
+
 @app.route('/navigate-directory', methods=['POST'])
 def navigate_directory():
     """Get the path for navigating to a specific directory"""
@@ -221,13 +632,113 @@ def navigate_directory():
         return jsonify({'success': True, 'path': new_path})
     
     # For regular directory navigation
-    dir_ref = db.collection('directories').document(directory_id)
-    directory = dir_ref.get()
-    
-    if not directory.exists:
-        return jsonify({'success': False, 'message': 'Directory not found'})
+    if tree.uses_ids(uid):
+        path = tree.path_of(uid, directory_id)
+        if path is None:
+            return jsonify({'success': False, 'message': 'Directory not found'})
+        return jsonify({'success': True, 'path': path})
+    
+    path = listing_cache.get(uid, 'directory', directory_id)
+    if path is None:
+        dir_ref = db.collection('directories').document(directory_id)
+        directory = dir_ref.get()
+        
+        if not directory.exists:
+            return jsonify({'success': False, 'message': 'Directory not found'})
+        
+        path = directory.to_dict()['path']
+        listing_cache.put(uid, 'directory', directory_id, path)
     
-    return jsonify({'success': True, 'path': directory.to_dict()['path']})
+    return jsonify({'success': True, 'path': path})
+
+def find_existing_files(uid, current_path, filename):
+    """Find files with the same name in a directory"""
+    files = children_query(uid, 'files', current_path)
+    return files.where('name', '==', filename).get() if files else []
+
+def overwritten_size(existing_files):
+    """Bytes an upload frees by replacing existing files"""
+    return sum(existing_file.to_dict().get('size') or 0 for existing_file in existing_files)
+
+def remove_existing_files(uid, existing_files):
+    """Delete files that are being overwritten from storage and Firestore"""
+    # Delete from firestore and the duplicate index, flagging shares and
+    # dropping references to shared content, in one transaction
+    result = delete_files(db, uid, existing_files)
+    delete_file_storage(uid, result)
+    share_ids = result.share_ids
+    search_index.remove(uid, [existing_file.id for existing_file in existing_files])
+    for existing_file in existing_files:
+        listing_cache.invalidate(uid, 'files', file_directory(uid, existing_file.to_dict()))
+        signed_url_cache.invalidate(file_key(existing_file.id))
+    for share_id in share_ids:
+        signed_url_cache.invalidate(share_key(share_id))
+
+def delete_file_storage(uid, result):
+    """Delete the bytes of files deleted by delete_files(), once their records are gone"""
+    for deleted_file in result.deleted:
+        file_data = deleted_file.to_dict()
+        delete_file_bytes(bucket, uid, file_data)
+        if file_data.get('has_manifest'):
+            release_manifest(db, uid, deleted_file.id)
+    for orphan in result.orphans:
+        delete_orphan(bucket, orphan)
+
+def new_file_blob(uid, storage_path, replacing=False):
+    """
+    Blob to write a new file's bytes to. A file `replacing` others is written
+    before they are removed, so it can't take the blob name they have.
+    """
+    if config.CONTENT_ADDRESSED_STORAGE:
+        # The hash isn't known yet, so stage the bytes
+        return bucket.blob(staging_blob_name(uid))
+    if tree.uses_ids(uid) or replacing:
+        # Directories move without their files' blobs, so the name can't depend on the path
+        return bucket.blob(unique_blob_name(uid))
+    return bucket.blob(f"{uid}/{storage_path}")
+
+def add_file_record(uid, filename, current_path, storage_path, size, content_type, file_hash,
+                    blob_name=None, file_id=None, has_manifest=False, replaced=(), encoding=None, stored_size=None,
+                    content_hash=None):
+    """
+    Record an uploaded file in Firestore and the duplicate index, and return its ID.
+    
+    `replaced` holds the snapshots of the files it overwrote, if any.
+    `encoding` and `stored_size` say how its blob is compressed, if it is,
+    and `content_hash` is the SHA-256 of content-addressed files.
+    """
+    file_ref = db.collection('files').document(file_id)
+    wants_previews = previewable(content_type, size)
+    file_data = {
+        'user_id': uid,
+        'name': filename,
+        'path': current_path,
+        'parent_id': directory_id_at(uid, current_path, fresh=True),
+        'storage_path': storage_path,
+        'blob_name': blob_name or f"{uid}/{storage_path}",
+        'size': size,
+        'content_type': content_type,
+        'hash': file_hash,
+        'content_hash': content_hash,
+        'has_manifest': has_manifest,
+        'encoding': encoding,
+        'stored_size': stored_size if stored_size is not None else size,
+        'preview_state': 'pending' if wants_previews else None,
+        'created_at': firestore.SERVER_TIMESTAMP
+    }
+    create_file(db, file_ref, file_data)
+    if wants_previews:
+        preview_pipeline.submit(uid, file_ref.id, file_data)
+    listing_cache.invalidate(uid, 'files', current_path)
+    search_index.add_file(uid, file_ref.id, {
+        'name': filename, 'path': current_path, 'size': size, 'content_type': content_type
+    })
+    replaced_ids = [replaced_file.id for replaced_file in replaced]
+    record_changes(db, uid, [change(
+        'overwrite' if replaced_ids else 'create', 'file', file_ref.id, filename, current_path,
+        size=size, content_type=content_type, replaced=replaced_ids
+    )])
+    return file_ref.id
 
 @app.route('/upload-file', methods=['POST'])
 def upload_file():
@@ -243,48 +754,392 @@ def upload_file():
     if not file.filename:
         return jsonify({'success': False, 'message': 'No file selected'})
     
+    if locked_path(db, uid, current_path):
+        return jsonify({'success': False, 'message': 'This folder is being moved or deleted, try again shortly'})
+    
     # Check if file already exists
-    existing_files = db.collection('files').where('user_id', '==', uid).where('path', '==', current_path).where('name', '==', file.filename).get()
+    existing_files = find_existing_files(uid, current_path, file.filename)
     
     if len(existing_files) > 0 and not overwrite:
         return jsonify({'success': False, 'message': 'File already exists', 'needs_confirmation': True})
     
-    # If overwriting, delete the old file
-    if len(existing_files) > 0 and overwrite:
-        for existing_file in existing_files:
-            file_data = existing_file.to_dict()
-            # Delete from storage
-            old_blob = bucket.blob(f"{uid}/{file_data['storage_path']}")
-            old_blob.delete()
-            # Delete from firestore
-            db.collection('files').document(existing_file.id).delete()
+    # The request body is the file plus a few hundred bytes of form fields
+    freed = overwritten_size(existing_files) if overwrite else 0
+    try:
+        check_quota(db, uid, (request.content_length or 0) - freed)
+    except QuotaExceeded as e:
+        return jsonify({'success': False, 'quota_exceeded': True, 'message': str(e)})
     
-    # Calculate file hash
-    file_content = file.read()
-    file_hash = hashlib.md5(file_content).hexdigest()
+    # Stream to Firebase Storage, hashing chunks on the way through; a file
+    # being overwritten stays until the new one has been stored
+    replaced = existing_files if overwrite else []
+    storage_path = f"{current_path}/{file.filename}".replace('//', '/')
+    blob = new_file_blob(uid, storage_path, replacing=len(replaced) > 0)
+    try:
+        file_hash, content_hash, file_size, encoding, stored_size = stream_to_blob(
+            file.stream, blob, content_type=file.content_type, compress=True
+        )
+    except MemoryLimitExceeded as e:
+        app.logger.error(f"Error uploading file: {str(e)}")
+        return jsonify({'success': False, 'message': 'Upload exceeded the server memory limit'})
+    
+    if request.content_length is None:
+        # Sent without a length, so only now is the size known
+        try:
+            check_quota(db, uid, file_size)
+        except QuotaExceeded as e:
+            blob.delete()
+            return jsonify({'success': False, 'quota_exceeded': True, 'message': str(e)})
+
+    blob_name = blob.name
+    if config.CONTENT_ADDRESSED_STORAGE:
+        blob_name, encoding, stored_size = add_reference(db, bucket, content_hash, file_size, blob, encoding, stored_size)
+    else:
+        content_hash = None
+
+    if len(replaced) > 0:
+        remove_existing_files(uid, replaced)
+
+    # Add to Firestore
+    add_file_record(uid, file.filename, current_path, storage_path, file_size, file.content_type, file_hash, blob_name,
+                    replaced=replaced, encoding=encoding, stored_size=stored_size, content_hash=content_hash)
+    
+    return jsonify({'success': True, 'message': 'File uploaded successfully'})
+
+def own_content(uid, file_hash, size):
+    """One of the user's content-addressed files with this MD5 and size, if they have one"""
+    files = db.collection('files').where('user_id', '==', uid).where('hash', '==', file_hash)
+    for file in files.limit(MAX_OWN_CONTENT_MATCHES).stream():
+        file_data = file.to_dict()
+        if file_data.get('size') == size and (file_data.get('blob_name') or '').startswith(CONTENT_PREFIX):
+            return file_data
+    return None
+
+@app.route('/upload-session/init', methods=['POST'])
+def init_upload_session():
+    """Start a chunked upload session"""
+    data = request.json
+    if not data:
+        return jsonify({'success': False, 'message': 'No data provided'})
     
-    # Reset file pointer to beginning
-    file.seek(0)
+    uid = data.get('uid')
+    current_path = data.get('path', '/')
+    filename = data.get('filename')
+    size = data.get('size')
+    overwrite = data.get('overwrite', False)
     
-    # Upload to Firebase Storage
-    storage_path = f"{current_path}/{file.filename}".replace('//', '/')
-    blob = bucket.blob(f"{uid}/{storage_path}")
-    blob.upload_from_file(file)
+    if not uid or not filename or not isinstance(size, int) or size < 0:
+        return jsonify({'success': False, 'message': 'Missing required fields'})
     
-    # Add to Firestore
-    db.collection('files').document().set({
+    if '/' in filename:
+        return jsonify({'success': False, 'message': 'Invalid file name'})
+    
+    if locked_path(db, uid, current_path):
+        return jsonify({'success': False, 'message': 'This folder is being moved or deleted, try again shortly'})
+    
+    # Check if file already exists (checked again on commit)
+    existing_files = find_existing_files(uid, current_path, filename)
+    if len(existing_files) > 0 and not overwrite:
+        return jsonify({'success': False, 'message': 'File already exists', 'needs_confirmation': True})
+    
+    # Checked again on commit, as other uploads may finish meanwhile
+    try:
+        check_quota(db, uid, size - overwritten_size(existing_files))
+    except QuotaExceeded as e:
+        return jsonify({'success': False, 'quota_exceeded': True, 'message': str(e)})
+    
+    # If the client knows the content hash and the user already has a file
+    # with those bytes, the file is recorded without uploading anything. Only
+    # the user's own files count: knowing a hash doesn't prove having the bytes
+    file_hash = data.get('hash')
+    own = None
+    if config.CONTENT_ADDRESSED_STORAGE and isinstance(file_hash, str) and file_hash:
+        own = own_content(uid, file_hash, size)
+    content = find_reference(db, content_key(own), size) if own is not None else None
+    if content is not None:
+        if len(existing_files) > 0:
+            remove_existing_files(uid, existing_files)
+        
+        storage_path = f"{current_path}/{filename}".replace('//', '/')
+        add_file_record(uid, filename, current_path, storage_path, size,
+                        data.get('content_type') or 'application/octet-stream', file_hash,
+                        own['blob_name'], replaced=existing_files,
+                        encoding=content.get('encoding'), stored_size=content.get('stored_size'),
+                        content_hash=own.get('content_hash'))
+        
+        return jsonify({'success': True, 'deduplicated': True, 'message': 'File uploaded successfully'})
+    
+    chunk_size = config.UPLOAD_SESSION_CHUNK_SIZE
+    session_ref = db.collection('upload_sessions').document()
+    session_ref.set({
         'user_id': uid,
-        'name': file.filename,
+        'name': filename,
         'path': current_path,
-        'storage_path': storage_path,
-        'size': len(file_content),
-        'content_type': file.content_type,
-        'hash': file_hash,
-        'created_at': firestore.SERVER_TIMESTAMP
+        'size': size,
+        'content_type': data.get('content_type') or 'application/octet-stream',
+        'chunk_size': chunk_size,
+        'chunk_count': chunk_count(size, chunk_size),
+        'overwrite': bool(overwrite),
+        'created_at': firestore.SERVER_TIMESTAMP,
+        'expires_at': utc_now() + datetime.timedelta(hours=config.UPLOAD_SESSION_TTL_HOURS)
     })
     
+    return jsonify({
+        'success': True,
+        'session_id': session_ref.id,
+        'chunk_size': chunk_size,
+        'chunk_count': chunk_count(size, chunk_size)
+    })
+
+def get_upload_session(session_id, uid):
+    """Load an upload session, returning (ref, data) or (None, error message)"""
+    session_ref = db.collection('upload_sessions').document(session_id)
+    session = session_ref.get()
+    
+    if not session.exists:
+        return None, 'Upload session not found'
+    
+    session_data = session.to_dict()
+    if session_data['user_id'] != uid:
+        return None, 'Access denied'
+    
+    # Its chunks are about to be swept (see sweep_upload_sessions.py)
+    if is_expired(session_data, utc_now()):
+        return None, 'Upload session has expired'
+    
+    return session_ref, session_data
+
+@app.route('/upload-session/<session_id>/chunk/<int:index>', methods=['PUT'])
+def upload_session_chunk(session_id, index):
+    """Receive one numbered chunk of a chunked upload"""
+    uid = request.args.get('uid')
+    chunk_hash = request.headers.get('X-Chunk-SHA256')
+    
+    if not uid or not chunk_hash:
+        return jsonify({'success': False, 'message': 'Missing required fields'})
+    
+    session_ref, session_data = get_upload_session(session_id, uid)
+    if session_ref is None:
+        return jsonify({'success': False, 'message': session_data})
+    
+    if index < 0 or index >= session_data['chunk_count']:
+        return jsonify({'success': False, 'message': 'Chunk index out of range'})
+    
+    # Never read more than one chunk (plus a byte to detect oversized bodies)
+    expected_size = expected_chunk_size(index, session_data['size'], session_data['chunk_size'])
+    chunk = read_chunk(request.stream, expected_size + 1)
+    if len(chunk) != expected_size:
+        return jsonify({'success': False, 'message': f'Chunk {index} must be {expected_size} bytes'})
+    
+    if not verify_chunk(chunk, chunk_hash):
+        return jsonify({'success': False, 'message': f'Chunk {index} failed hash verification'})
+    
+    blob = bucket.blob(chunk_blob_name(uid, session_id, index))
+    blob.upload_from_string(chunk, content_type='application/octet-stream')
+    
+    # Record the chunk so any worker can see it arrived
+    session_ref.collection('chunks').document(str(index)).set({
+        'size': len(chunk),
+        'sha256': chunk_hash.lower(),
+        'uploaded_at': firestore.SERVER_TIMESTAMP
+    })
+    
+    return jsonify({'success': True, 'index': index})
+
+@app.route('/upload-session/<session_id>/status', methods=['POST'])
+def upload_session_status(session_id):
+    """List the chunks a session has received, so clients can resume"""
+    data = request.json
+    uid = data.get('uid')
+    
+    session_ref, session_data = get_upload_session(session_id, uid)
+    if session_ref is None:
+        return jsonify({'success': False, 'message': session_data})
+    
+    received = sorted(int(chunk.id) for chunk in session_ref.collection('chunks').stream())
+    
+    return jsonify({
+        'success': True,
+        'chunk_size': session_data['chunk_size'],
+        'chunk_count': session_data['chunk_count'],
+        'received': received
+    })
+
+@app.route('/upload-session/<session_id>/commit', methods=['POST'])
+def commit_upload_session(session_id):
+    """Assemble the uploaded chunks into the final file"""
+    data = request.json
+    uid = data.get('uid')
+    
+    session_ref, session_data = get_upload_session(session_id, uid)
+    if session_ref is None:
+        return jsonify({'success': False, 'message': session_data})
+    
+    chunk_refs = list(session_ref.collection('chunks').stream())
+    received = {int(chunk.id) for chunk in chunk_refs}
+    missing = [index for index in range(session_data['chunk_count']) if index not in received]
+    if missing:
+        return jsonify({'success': False, 'message': 'Upload is incomplete', 'missing': missing})
+    
+    filename = session_data['name']
+    current_path = session_data['path']
+    
+    if locked_path(db, uid, current_path):
+        return jsonify({'success': False, 'message': 'This folder is being moved or deleted, try again shortly'})
+    
+    # Overwrite can be confirmed at init or, if the file appeared meanwhile, at commit
+    overwrite = session_data['overwrite'] or data.get('overwrite', False)
+    existing_files = find_existing_files(uid, current_path, filename)
+    if len(existing_files) > 0 and not overwrite:
+        return jsonify({'success': False, 'message': 'File already exists', 'needs_confirmation': True})
+    
+    try:
+        check_quota(db, uid, session_data['size'] - overwritten_size(existing_files))
+    except QuotaExceeded as e:
+        return jsonify({'success': False, 'quota_exceeded': True, 'message': str(e)})
+    
+    # Compose the chunks server-side into the final blob; files being
+    # overwritten stay until it's done
+    storage_path = f"{current_path}/{filename}".replace('//', '/')
+    blob = new_file_blob(uid, storage_path, replacing=len(existing_files) > 0)
+    chunk_blobs = [bucket.blob(chunk_blob_name(uid, session_id, index)) for index in range(session_data['chunk_count'])]
+    compose_blobs(bucket, chunk_blobs, blob, content_type=session_data['content_type'])
+    
+    # Chunks arrive out of order, so the hashes are computed from the assembled blob
+    file_hash, content_hash = hash_blob(blob)
+    
+    # Composed blobs are stored uncompressed, though they may share content with a compressed one
+    blob_name, encoding, stored_size = blob.name, None, session_data['size']
+    if config.CONTENT_ADDRESSED_STORAGE:
+        blob_name, encoding, stored_size = add_reference(db, bucket, content_hash, session_data['size'], blob)
+    else:
+        content_hash = None
+    
+    if len(existing_files) > 0:
+        remove_existing_files(uid, existing_files)
+    
+    add_file_record(uid, filename, current_path, storage_path, session_data['size'], session_data['content_type'], file_hash,
+                    blob_name, replaced=existing_files, encoding=encoding, stored_size=stored_size,
+                    content_hash=content_hash)
+    
+    # Clean up the chunks and the session
+    delete_blobs(bucket, chunk_blobs)
+    delete_all(db, [chunk.reference for chunk in chunk_refs] + [session_ref])
+    
     return jsonify({'success': True, 'message': 'File uploaded successfully'})
 
+def block_grace():
+    """How long an unreferenced block is kept (see delta_sync.collect_blocks())"""
+    return datetime.timedelta(hours=config.SYNC_BLOCK_GRACE_HOURS)
+
+@app.route('/sync/missing-blocks', methods=['POST'])
+def sync_missing_blocks():
+    """Tell a client which of a file's blocks it still has to upload"""
+    data = request.json
+    if not data:
+        return jsonify({'success': False, 'message': 'No data provided'})
+    
+    uid = data.get('uid')
+    hashes = data.get('hashes', [])
+    
+    if not uid or not isinstance(hashes, list) or not all(is_block_hash(h) for h in hashes):
+        return jsonify({'success': False, 'message': 'Missing required fields'})
+    
+    return jsonify({'success': True, 'missing': missing_blocks(db, uid, hashes, block_grace(), utc_now())})
+
+@app.route('/sync/block/<block_hash>', methods=['PUT'])
+def sync_upload_block(block_hash):
+    """Receive one content-defined block"""
+    uid = request.args.get('uid')
+    
+    if not uid or not is_block_hash(block_hash):
+        return jsonify({'success': False, 'message': 'Missing required fields'})
+    
+    # Never read more than one block (plus a byte to detect oversized bodies)
+    data = read_chunk(request.stream, MAX_CHUNK_SIZE + 1)
+    try:
+        store_block(db, bucket, uid, block_hash, data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
+    
+    return jsonify({'success': True, 'hash': block_hash})
+
+@app.route('/sync/commit', methods=['POST'])
+def sync_commit():
+    """Create or replace a file from a manifest of uploaded blocks"""
+    data = request.json
+    if not data:
+        return jsonify({'success': False, 'message': 'No data provided'})
+    
+    uid = data.get('uid')
+    current_path = data.get('path', '/')
+    filename = data.get('filename')
+    content_type = data.get('content_type') or 'application/octet-stream'
+    overwrite = data.get('overwrite', False)
+    blocks = data.get('blocks')
+    
+    if not uid or not filename or '/' in filename or not isinstance(blocks, list):
+        return jsonify({'success': False, 'message': 'Missing required fields'})
+    
+    for block in blocks:
+        if not isinstance(block, dict) or not is_block_hash(block.get('hash')) \
+                or not isinstance(block.get('size'), int) or not 0 < block['size'] <= MAX_CHUNK_SIZE:
+            return jsonify({'success': False, 'message': 'Invalid manifest'})
+    
+    if locked_path(db, uid, current_path):
+        return jsonify({'success': False, 'message': 'This folder is being moved or deleted, try again shortly'})
+    
+    missing = missing_blocks(db, uid, [block['hash'] for block in blocks], block_grace(), utc_now())
+    if missing:
+        return jsonify({'success': False, 'message': 'Blocks are missing', 'missing': missing})
+    
+    existing_files = find_existing_files(uid, current_path, filename)
+    if len(existing_files) > 0 and not overwrite:
+        return jsonify({'success': False, 'message': 'File already exists', 'needs_confirmation': True})
+    
+    try:
+        check_quota(db, uid, sum(block['size'] for block in blocks) - overwritten_size(existing_files))
+    except QuotaExceeded as e:
+        return jsonify({'success': False, 'quota_exceeded': True, 'message': str(e)})
+    
+    # Take references on the blocks before assembling, so they can't be collected meanwhile
+    file_id = db.collection('files').document().id
+    try:
+        save_manifest(db, uid, file_id, blocks)
+    except BlocksMissing as e:
+        return jsonify({'success': False, 'message': str(e), 'missing': e.hashes})
+    
+    # Assemble the full blob server-side from the stored blocks; the client
+    # only ever sent the blocks that were missing
+    storage_path = f"{current_path}/{filename}".replace('//', '/')
+    blob = new_file_blob(uid, storage_path, replacing=len(existing_files) > 0)
+    
+    try:
+        reader = ManifestReader(bucket, uid, [block['hash'] for block in blocks])
+        file_hash, content_hash, file_size, encoding, stored_size = stream_to_blob(
+            reader, blob, content_type=content_type, compress=True
+        )
+    except Exception as e:
+        release_manifest(db, uid, file_id)
+        app.logger.error(f"Error assembling file: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error assembling file: {str(e)}'})
+    
+    blob_name = blob.name
+    if config.CONTENT_ADDRESSED_STORAGE:
+        blob_name, encoding, stored_size = add_reference(db, bucket, content_hash, file_size, blob, encoding, stored_size)
+    else:
+        content_hash = None
+    
+    # Only now that the new file is stored does the old one go
+    if len(existing_files) > 0:
+        remove_existing_files(uid, existing_files)
+    
+    add_file_record(uid, filename, current_path, storage_path, file_size, content_type, file_hash,
+                    blob_name, file_id=file_id, has_manifest=True, replaced=existing_files,
+                    encoding=encoding, stored_size=stored_size, content_hash=content_hash)
+    
+    return jsonify({'success': True, 'message': 'File uploaded successfully', 'file_id': file_id})
+
 @app.route('/delete-file', methods=['POST'])
 def delete_file():
     """Delete a file"""
@@ -300,13 +1155,24 @@ def delete_file():
         return jsonify({'success': False, 'message': 'File not found'})
     
     file_data = file.to_dict()
+    if file_data.get('user_id') != uid:
+        return jsonify({'success': False, 'message': 'File not found'})
     
-    # Delete from storage
-    blob = bucket.blob(f"{uid}/{file_data['storage_path']}")
-    blob.delete()
-    
-    # Delete from firestore
-    file_ref.delete()
+    # Delete from firestore and the duplicate index, flagging shares of the file and
+    # dropping its reference to shared content; only the request that deleted it frees its bytes
+    result = delete_files(db, uid, [file])
+    if not result.deleted:
+        return jsonify({'success': False, 'message': 'File not found'})
+    delete_file_storage(uid, result)
+    share_ids = result.share_ids
+    listing_cache.invalidate(uid, 'files', file_directory(uid, file_data))
+    search_index.remove(uid, [file_id])
+    signed_url_cache.invalidate(file_key(file_id))
+    for share_id in share_ids:
+        signed_url_cache.invalidate(share_key(share_id))
+    record_changes(db, uid, [
+        change('delete', 'file', file_id, file_data['name'], file_directory(uid, file_data))
+    ])
     
     return jsonify({'success': True, 'message': 'File deleted successfully'})
 
@@ -317,29 +1183,257 @@ def get_download_url():
     uid = data.get('uid')
     file_id = data.get('file_id')
     
+    # Reuse a URL signed for this file earlier
+    cached = signed_url_cache.get(file_key(file_id))
+    if cached is not None and cached['user_id'] == uid:
+        return jsonify({'success': True, 'url': cached['url'], 'filename': cached['filename']})
+    
     # Get file
     file_ref = db.collection('files').document(file_id)
     file = file_ref.get()
     
-    if not file.exists:
+    if not file.exists or file.get('user_id') != uid:
         return jsonify({'success': False, 'message': 'File not found'})
     
     file_data = file.to_dict()
     
     # Generate download URL
-    blob = bucket.blob(f"{uid}/{file_data['storage_path']}")
-    download_url = blob.generate_signed_url(
-        version="v4",
-        expiration=300,  # 5 minutes
-        method="GET"
-    )
+    signed = sign_file_url(uid, file_id, file_data)
     
     return jsonify({
         'success': True, 
-        'url': download_url, 
-        'filename': file_data['name']
+        'url': signed['url'], 
+        'filename': signed['filename']
+    })
+
+def sign_file_url(uid, file_id, file_data):
+    """Sign (and cache) a download URL for a file"""
+    if file_data.get('encoding'):
+        # Compressed blobs are decoded on the way out, so they're downloaded through the app
+        return {
+            'url': url_for('download_file', uid=uid, file_id=file_id),
+            'filename': file_data['name'],
+            'expires_in': signed_url_cache.ttl
+        }
+    blob = bucket.blob(file_blob_name(uid, file_data))
+    return signed_url_cache.sign(
+        file_key(file_id), blob, download_disposition(blob.name, file_data['name']),
+        extra={'filename': file_data['name'], 'user_id': uid}
+    )
+
+@app.route('/download-file')
+def download_file():
+    """
+    Download a compressed file, or a compressed file shared with the user.
+
+    The stored bytes are sent as they are with a Content-Encoding if the
+    client accepts it, and decompressed on the way otherwise. Other files
+    are downloaded from signed URLs (see /get-file-url).
+    """
+    uid = request.args.get('uid')
+    file_id = request.args.get('file_id')
+    share_id = request.args.get('share_id')
+    
+    if not uid or not (file_id or share_id):
+        return jsonify({'success': False, 'message': 'Missing required fields'}), 400
+    
+    owner_id = uid
+    if share_id:
+        share = db.collection('shared_files').document(share_id).get()
+        if not share.exists or share.get('shared_with') != uid:
+            return jsonify({'success': False, 'message': 'Shared file not found'}), 404
+        share_data = share.to_dict()
+        if is_expired(share_data, utc_now()):
+            return jsonify({'success': False, 'message': 'This shared file has expired and is no longer available'}), 410
+        if share_data.get('file_missing'):
+            return jsonify({'success': False, 'message': 'The original file has been deleted by the owner'}), 410
+        owner_id = share_data['owner_id']
+        file_id = share_data.get('file_id', '')
+    
+    file = db.collection('files').document(file_id).get()
+    if not file.exists or file.get('user_id') != owner_id:
+        return jsonify({'success': False, 'message': 'File not found'}), 404
+    
+    file_data = file.to_dict()
+    encoding = file_data.get('encoding')
+    chunks = read_blob(file_blob_name(owner_id, file_data))
+    if encoding and request.accept_encodings[encoding] > 0:
+        response = Response(stream_with_context(chunks), mimetype=file_data.get('content_type'))
+        response.headers['Content-Encoding'] = encoding
+        length = file_data.get('stored_size')
+    else:
+        response = Response(stream_with_context(decompress_chunks(chunks, encoding)), mimetype=file_data.get('content_type'))
+        length = file_data.get('size')
+    if length is not None:
+        response.headers['Content-Length'] = str(length)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Content-Disposition'] = attachment_disposition(file_data['name'])
+    return response
+
+@app.route('/preview')
+def preview():
+    """Serve the thumbnail or preview image of one of the user's files"""
+    uid = request.args.get('uid')
+    file_id = request.args.get('file_id')
+    variant = request.args.get('size', 'thumbnail')
+    
+    if not uid or not file_id or variant not in PREVIEW_VARIANTS:
+        return jsonify({'success': False, 'message': 'Missing required fields'}), 400
+    
+    file = db.collection('files').document(file_id).get()
+    if not file.exists or file.get('user_id') != uid:
+        return jsonify({'success': False, 'message': 'File not found'}), 404
+    
+    file_data = file.to_dict()
+    preview_data = (file_data.get('previews') or {}).get(variant)
+    if preview_data is None:
+        # Queue it again in case it was dropped from a full queue or its worker restarted
+        if file_data.get('preview_state') == 'pending' and preview_pipeline.submit(uid, file_id, file_data):
+            return jsonify({'success': False, 'pending': True, 'message': 'The preview is being generated'}), 202
+        return jsonify({'success': False, 'message': 'This file has no preview'}), 404
+    
+    # A file's previews never change, so browsers can keep them and revalidate for free
+    etag = f"{file_id}-{variant}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(preview_pipeline.read(preview_data['blob_name']), mimetype=PREVIEW_MIMETYPE)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = 86400
+    return response
+
+@app.route('/get-download-urls', methods=['POST'])
+def get_download_urls():
+    """Get download URLs for many of the user's files at once, e.g. a whole folder"""
+    data = request.json
+    uid = data.get('uid')
+    file_ids = list(dict.fromkeys(data.get('file_ids') or []))
+    
+    if len(file_ids) > MAX_URL_BATCH:
+        return jsonify({'success': False, 'message': f'At most {MAX_URL_BATCH} files per request'})
+    
+    # Serve what the cache has, then read the rest in one round trip
+    urls = {}
+    uncached = []
+    for file_id in file_ids:
+        cached = signed_url_cache.get(file_key(file_id))
+        if cached is None or cached['user_id'] != uid:
+            uncached.append(file_id)
+        else:
+            urls[file_id] = cached
+    
+    snapshots = get_all(db, (db.collection('files').document(file_id) for file_id in uncached))
+    missing = []
+    for file_id in uncached:
+        file = snapshots[file_id]
+        if not file.exists or file.get('user_id') != uid:
+            missing.append(file_id)
+            continue
+        urls[file_id] = sign_file_url(uid, file_id, file.to_dict())
+    
+    return jsonify({
+        'success': True,
+        'urls': {
+            file_id: {'url': entry['url'], 'filename': entry['filename'], 'expires_in': entry['expires_in']}
+            for file_id, entry in urls.items()
+        },
+        'missing': missing
+    })
+
+@app.route('/download-zip', methods=['GET', 'POST'])
+def download_zip():
+    """Stream a ZIP of a directory (with its subdirectories) or of chosen files"""
+    uid = request.values.get('uid')
+    path = request.values.get('path')
+    file_ids = [file_id for file_id in request.values.get('file_ids', '').split(',') if file_id]
+    
+    if not uid or (path is None and not file_ids):
+        return jsonify({'success': False, 'message': 'Missing required fields'})
+    
+    if file_ids:
+        if len(file_ids) > MAX_ZIP_FILE_IDS:
+            return jsonify({'success': False, 'message': f'At most {MAX_ZIP_FILE_IDS} files per archive'})
+        files = zip_selected_files(uid, file_ids)
+        archive_name = 'files.zip'
+    else:
+        files = zip_directory_files(uid, path)
+        archive_name = f"{path.rstrip('/').rsplit('/', 1)[-1] or 'files'}.zip"
+    
+    archive = iter_zip(zip_entries(uid, files), read_zip_entry, config.ZIP_READ_AHEAD, config.ZIP_QUEUE_DEPTH)
+    return Response(archive, mimetype='application/zip', headers={
+        'Content-Disposition': attachment_disposition(archive_name),
+        'X-Accel-Buffering': 'no'
     })
 
+def zip_directory_files(uid, path):
+    """Yield (relative directory, file data) for every file in and below a directory"""
+    if tree.uses_ids(uid):
+        yield from zip_tree_files(uid, path)
+        return
+    files = db.collection('files').where('user_id', '==', uid)
+    if path == '/':
+        queries = [files]
+    else:
+        prefix = path.rstrip('/') + '/'
+        queries = [
+            files.where('path', '==', path),
+            files.where('path', '>=', prefix).where('path', '<', prefix + '\uf8ff')
+        ]
+    for query in queries:
+        for file in query.stream():
+            file_data = file.to_dict()
+            yield file_data['path'][len(path):].strip('/'), file_data
+
+def zip_tree_files(uid, path):
+    """zip_directory_files() on the ID schema: walk the tree, then list each directory's files"""
+    directory_id = tree.resolve(uid, path)
+    if directory_id is None:
+        return
+    files = db.collection('files').where('user_id', '==', uid)
+    directories = subtree_directories(db, uid, directory_id)
+    while True:
+        # The files of up to 10 directories per query
+        batch = {subdirectory_id: relative for relative, subdirectory_id in itertools.islice(directories, 10)}
+        if not batch:
+            return
+        for file in files.where('parent_id', 'in', list(batch)).stream():
+            file_data = file.to_dict()
+            yield batch[file_data['parent_id']], file_data
+
+def zip_selected_files(uid, file_ids):
+    """Yield ('', file data) for each of the user's files among `file_ids`"""
+    snapshots = get_all(db, (db.collection('files').document(file_id) for file_id in dict.fromkeys(file_ids)))
+    for file in snapshots.values():
+        if file.exists and file.get('user_id') == uid:
+            yield '', file.to_dict()
+
+def zip_entries(uid, files):
+    """Turn (relative directory, file data) pairs into archive members with unique names"""
+    names = set()
+    for directory, file_data in files:
+        name = f"{directory}/{file_data['name']}" if directory else file_data['name']
+        yield ZipEntry(
+            unique_name(name, names),
+            file_data.get('size', 0),
+            file_data.get('created_at'),
+            (file_blob_name(uid, file_data), file_data.get('encoding'))
+        )
+
+def read_blob(name):
+    """Read a blob's stored bytes in chunks"""
+    with bucket.blob(name).open('rb', chunk_size=config.ZIP_READ_CHUNK_SIZE) as reader:
+        while True:
+            chunk = reader.read(config.ZIP_READ_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+def read_zip_entry(entry):
+    """Read an archive member's original bytes in chunks"""
+    blob_name, encoding = entry.source
+    return decompress_chunks(read_blob(blob_name), encoding)
+
 @app.route('/find-duplicates', methods=['POST'])
 def find_duplicates():
     """Find duplicate files in the current directory"""
@@ -347,27 +1441,20 @@ def find_duplicates():
     uid = data.get('uid')
     current_path = data.get('path', '/')
     
-    # Get all files in the current directory
-    files = db.collection('files').where('user_id', '==', uid).where('path', '==', current_path).stream()
-    
-    # Map of hashes to files
-    hash_map = {}
-    duplicates = []
-    
-    for file in files:
-        file_data = file.to_dict()
-        file_hash = file_data['hash']
-        file_data['id'] = file.id
-        
-        if file_hash in hash_map:
-            # This is a duplicate
-            if len(hash_map[file_hash]) == 1:
-                # First duplicate found, add the original to the duplicates list
-                duplicates.append(hash_map[file_hash][0])
-            duplicates.append(file_data)
-            hash_map[file_hash].append(file_data)
-        else:
-            hash_map[file_hash] = [file_data]
+    if tree.uses_ids(uid):
+        # The index records paths as written, so group the directory's own files instead
+        files = children_query(uid, 'files', current_path)
+        groups = defaultdict(list)
+        for file in files.stream() if files else []:
+            file_data = file.to_dict()
+            file_data['id'] = file.id
+            groups[file_data['hash']].append(file_data)
+        duplicates = [file_data for group in groups.values() if len(group) > 1 for file_data in group]
+        return jsonify({'success': True, 'duplicates': duplicates})
+    
+    # Read only the groups of this user's files with duplicates in this directory
+    ensure_index(db, uid)
+    duplicates = [file_data for group in directory_duplicates(db, uid, current_path) for file_data in group]
     
     return jsonify({'success': True, 'duplicates': duplicates})
 
@@ -377,29 +1464,91 @@ def find_all_duplicates():
     data = request.json
     uid = data.get('uid')
     
-    # Get all files for this user
-    files = db.collection('files').where('user_id', '==', uid).stream()
+    # Read only the groups of this user's files that have duplicates
+    ensure_index(db, uid)
+    groups = duplicate_groups(db, uid)
+    if tree.uses_ids(uid):
+        groups = (
+            [dict(file_data, path=file_directory(uid, file_data)) for file_data in group]
+            for group in groups
+        )
+    if wants_ndjson():
+        return ndjson_response('duplicate_group', groups)
     
-    # Map of hashes to files
-    hash_map = {}
+    return jsonify({'success': True, 'duplicate_groups': list(groups)})
+
+@app.route('/search', methods=['POST'])
+def search():
+    """Find the user's files and directories by name, filtered by type, size, date or folder"""
+    data = request.json
+    if not data:
+        return jsonify({'success': False, 'message': 'No data provided'})
     
-    for file in files:
-        file_data = file.to_dict()
-        file_hash = file_data['hash']
-        file_data['id'] = file.id
-        
-        if file_hash in hash_map:
-            hash_map[file_hash].append(file_data)
-        else:
-            hash_map[file_hash] = [file_data]
+    uid = data.get('uid')
+    if not uid:
+        return jsonify({'success': False, 'message': 'User ID is required'})
     
-    # Extract duplicate groups (2 or more files with same hash)
-    duplicate_groups = []
-    for file_hash, files in hash_map.items():
-        if len(files) > 1:
-            duplicate_groups.append(files)
+    if not search_index.ensure(uid):
+        return jsonify({
+            'success': False,
+            'indexing': True,
+            'message': 'Your files are being indexed for search, try again shortly'
+        })
     
-    return jsonify({'success': True, 'duplicate_groups': duplicate_groups})
+    try:
+        results = search_index.search(
+            uid,
+            query=data.get('query', ''),
+            match=data.get('match', 'substring'),
+            kind=data.get('kind'),
+            content_type=data.get('content_type'),
+            path=data.get('path'),
+            min_size=data.get('min_size'),
+            max_size=data.get('max_size'),
+            created_after=data.get('created_after'),
+            created_before=data.get('created_before'),
+            limit=data.get('limit')
+        )
+    except SearchError as e:
+        return jsonify({'success': False, 'message': str(e)})
+    
+    return jsonify({'success': True, 'results': results})
+
+@app.route('/usage', methods=['POST'])
+def usage():
+    """Report a user's storage usage and quota, and optionally the usage of files directly in one directory"""
+    data = request.json
+    if not data:
+        return jsonify({'success': False, 'message': 'No data provided'})
+    
+    uid = data.get('uid')
+    if not uid:
+        return jsonify({'success': False, 'message': 'User ID is required'})
+    
+    path = data.get('path')
+    directory_id = None
+    if path:
+        directory_id = directory_id_at(uid, path)
+        if directory_id is None:
+            return jsonify({'success': False, 'message': 'Directory not found'})
+    
+    user, totals = get_usage(db, uid, [directory_id] if directory_id else [])
+    quota = quota_of(user)
+    result = {
+        'success': True,
+        'used_bytes': totals[USER_SCOPE]['bytes'],
+        'file_count': totals[USER_SCOPE]['files'],
+        'quota_bytes': quota,
+        'free_bytes': None if quota is None else max(quota - totals[USER_SCOPE]['bytes'], 0)
+    }
+    if directory_id:
+        result['directory'] = {
+            'path': path,
+            'used_bytes': totals[directory_id]['bytes'],
+            'file_count': totals[directory_id]['files']
+        }
+    
+    return jsonify(result)
 
 @app.route('/share-file', methods=['POST'])
 def share_file():
@@ -422,29 +1571,28 @@ def share_file():
     
     # Default expiration is 30 days from now
     expiration_seconds = data.get('expiration_days', 30) * 24 * 60 * 60
-    expiration_date = datetime.datetime.now() + datetime.timedelta(seconds=expiration_seconds)
-    
-    # Find user to share with
-    users = db.collection('users').where('email', '==', share_email).get()
-    
-    if len(users) == 0:
-        return jsonify({'success': False, 'message': 'User not found. Make sure the email is registered in the system.'})
-    
-    share_uid = users[0].id
-    
-    # Prevent sharing with yourself
-    if share_uid == uid:
-        return jsonify({'success': False, 'message': 'Cannot share with yourself'})
+    expiration_date = utc_now() + datetime.timedelta(seconds=expiration_seconds)
     
     try:
-        # Check if already shared
-        existing_shares = db.collection('shared_files').where('file_id', '==', file_id).where('shared_with', '==', share_uid).get()
-        if len(existing_shares) > 0:
-            return jsonify({'success': False, 'message': 'File already shared with this user'})
-        
-        # Get file info
+        # Find the user to share with while fetching the file and the owner's
+        # user document (together, in one round trip)
         file_ref = db.collection('files').document(file_id)
-        file = file_ref.get()
+        owner_ref = db.collection('users').document(uid)
+        users, snapshots = gather(
+            lambda: db.collection('users').where('email', '==', share_email).limit(1).get(),
+            lambda: get_all(db, [file_ref, owner_ref])
+        )
+        file = snapshots[file_id]
+        owner = snapshots[uid]
+        
+        if len(users) == 0:
+            return jsonify({'success': False, 'message': 'User not found. Make sure the email is registered in the system.'})
+        
+        share_uid = users[0].id
+        
+        # Prevent sharing with yourself
+        if share_uid == uid:
+            return jsonify({'success': False, 'message': 'Cannot share with yourself'})
         
         if not file.exists:
             return jsonify({'success': False, 'message': 'File not found'})
@@ -456,26 +1604,36 @@ def share_file():
             return jsonify({'success': False, 'message': 'You cannot share a file you do not own'})
         
         # Verify file exists in storage
-        blob = bucket.blob(f"{uid}/{file_data['storage_path']}")
+        blob = bucket.blob(file_blob_name(uid, file_data))
         if not blob.exists():
             return jsonify({'success': False, 'message': 'File not found in storage'})
         
         # Get owner's email
-        owner = db.collection('users').document(uid).get()
-        owner_email = owner.to_dict().get('email', 'Unknown User')
+        owner_email = owner.to_dict().get('email', 'Unknown User') if owner.exists else 'Unknown User'
         
-        # Create share record
+        # Create share record, unless the file is already shared with this user (checked atomically)
+        existing_shares = db.collection('shared_files').where('file_id', '==', file_id).where('shared_with', '==', share_uid)
         share_ref = db.collection('shared_files').document()
-        share_ref.set({
+        created = create_unless_exists(db, existing_shares, [(share_ref, {
             'file_id': file_id,
             'owner_id': uid,
             'owner_email': owner_email,
             'shared_with': share_uid,
             'file_name': file_data['name'],
             'file_path': file_data['storage_path'],
+            'blob_name': blob.name,
             'created_at': firestore.SERVER_TIMESTAMP,
             'expires_at': expiration_date
-        })
+        })])
+        
+        if not created:
+            return jsonify({'success': False, 'message': 'File already shared with this user'})
+        
+        # The recipient's feed, so their shared files list picks it up
+        record_changes(db, share_uid, [change(
+            'share', 'share', share_ref.id, file_data['name'], '/shared',
+            file_id=file_id, owner_email=owner_email, expires_at=expiration_date
+        )])
         
         return jsonify({
             'success': True, 
@@ -484,7 +1642,7 @@ def share_file():
             'share_id': share_ref.id
         })
     except Exception as e:
-        print(f"Error sharing file: {str(e)}")
+        app.logger.error(f"Error sharing file: {str(e)}")
         return jsonify({'success': False, 'message': f'Error sharing file: {str(e)}'})
 
 @app.route('/get-shared-files', methods=['POST'])
@@ -499,83 +1657,43 @@ def get_shared_files():
     if not uid:
         return jsonify({'success': False, 'message': 'User ID is required'})
     
-    print(f"Fetching shared files for user: {uid}")
+    app.logger.info(f"Fetching shared files for user: {uid}")
+    
+    def log_error(e):
+        app.logger.error(f"Error getting shared files: {str(e)}")
+    
+    shared_files = iter_shared_files(uid)
+    if wants_ndjson():
+        return ndjson_response('shared_file', shared_files, on_error=log_error)
     
     try:
-        # Get current time for expiration check
-        current_time = datetime.datetime.now()
-        
-        # Get shared files
-        shared_files = db.collection('shared_files').where('shared_with', '==', uid).stream()
-        
-        result = []
-        expired_shares = []
-        
-        for shared in shared_files:
-            share_data = shared.to_dict()
-            share_data['id'] = shared.id
-            
-            print(f"Found shared file: {share_data.get('file_name', 'Unknown')} (ID: {shared.id})")
-            
-            # Check if share has expired
-            if 'expires_at' in share_data:
-                try:
-                    # Convert to datetime if it's a timestamp
-                    if isinstance(share_data['expires_at'], firestore.SERVER_TIMESTAMP.__class__):
-                        expiration = datetime.datetime.fromtimestamp(share_data['expires_at'].seconds)
-                    else:
-                        # Already a datetime
-                        expiration = share_data['expires_at']
-                        
-                    # If expired, mark for deletion
-                    if expiration < current_time:
-                        print(f"Share expired: {shared.id}")
-                        expired_shares.append(shared.id)
-                        continue
-                except Exception as e:
-                    print(f"Error checking expiration: {str(e)}")
-                    # Don't skip the file if there's an error with expiration
-            
-            # Add remaining time info for UI
-            if 'expires_at' in share_data:
-                try:
-                    # Try to convert the expiration date to a string
-                    if isinstance(share_data['expires_at'], datetime.datetime):
-                        share_data['expires_at_string'] = share_data['expires_at'].strftime("%Y-%m-%d")
-                    elif hasattr(share_data['expires_at'], 'seconds'):
-                        share_data['expires_at_string'] = datetime.datetime.fromtimestamp(
-                            share_data['expires_at'].seconds
-                        ).strftime("%Y-%m-%d")
-                except Exception as e:
-                    print(f"Error formatting expiration date: {str(e)}")
-                    # If conversion fails, provide a default
-                    share_data['expires_at_string'] = "Unknown"
-            
-            # Verify file still exists in storage before adding to results
-            try:
-                if 'owner_id' in share_data and 'file_path' in share_data:
-                    blob = bucket.blob(f"{share_data['owner_id']}/{share_data['file_path']}")
-                    if not blob.exists():
-                        print(f"Storage file doesn't exist for share: {shared.id}")
-                        # Add a flag to indicate the file is missing, but still show it
-                        share_data['file_missing'] = True
-            except Exception as e:
-                print(f"Error checking file existence: {str(e)}")
-                # Still include the file with a flag
-                share_data['file_missing'] = True
-            
-            result.append(share_data)
-        
-        # Delete expired shares
-        for share_id in expired_shares:
-            db.collection('shared_files').document(share_id).delete()
-        
-        print(f"Returning {len(result)} shared files to user {uid}")
+        result = list(shared_files)
+        app.logger.info(f"Returning {len(result)} shared files to user {uid}")
         return jsonify({'success': True, 'shared_files': result})
     except Exception as e:
-        print(f"Error getting shared files: {str(e)}")
+        log_error(e)
         return jsonify({'success': False, 'message': f'Error loading shared files: {str(e)}'})
 
+def iter_shared_files(uid):
+    """
+    Yield the unexpired shares with a user; expired ones are left to the sweeper.
+    
+    Shares of deleted files were flagged `file_missing` when the file was
+    deleted, so storage isn't checked here.
+    """
+    shared_files = active_shares_query(db, uid, utc_now()).stream()
+    
+    for shared in shared_files:
+        share_data = shared.to_dict()
+        share_data['id'] = shared.id
+        
+        # Add the expiry date for the UI
+        expiration = expiration_of(share_data)
+        if expiration is not None:
+            share_data['expires_at_string'] = expiration.strftime("%Y-%m-%d")
+        
+        yield share_data
+
 @app.route('/get-shared-file-url', methods=['POST'])
 def get_shared_file_url():
     """Get a download URL for a shared file"""
@@ -591,6 +1709,11 @@ def get_shared_file_url():
         return jsonify({'success': False, 'message': 'Missing required fields'})
     
     try:
+        # Reuse a URL signed for this share earlier
+        cached = signed_url_cache.get(share_key(share_id))
+        if cached is not None and cached['shared_with'] == uid:
+            return jsonify({'success': True, 'url': cached['url'], 'filename': cached['filename']})
+        
         # Get share record
         share_ref = db.collection('shared_files').document(share_id)
         share = share_ref.get()
@@ -604,29 +1727,13 @@ def get_shared_file_url():
         if share_data['shared_with'] != uid:
             return jsonify({'success': False, 'message': 'Access denied'})
         
-        # Check for expiration date
-        if 'expires_at' in share_data:
-            try:
-                # Convert to datetime if it's a timestamp
-                if isinstance(share_data['expires_at'], firestore.SERVER_TIMESTAMP.__class__):
-                    expiration = datetime.datetime.fromtimestamp(share_data['expires_at'].seconds)
-                else:
-                    # Already a datetime
-                    expiration = share_data['expires_at']
-                    
-                # If expired, don't allow download
-                current_time = datetime.datetime.now()
-                # Ensure both times are naive (no timezone) for consistent comparison
-                if hasattr(expiration, 'tzinfo') and expiration.tzinfo is not None:
-                    expiration = expiration.replace(tzinfo=None)
-                
-                if expiration < current_time:
-                    # Remove the share since it's expired
-                    share_ref.delete()
-                    return jsonify({'success': False, 'message': 'This shared file has expired and is no longer available'})
-            except Exception as e:
-                print(f"Error checking expiration: {str(e)}")
-                # Continue anyway if we can't check expiration
+        # Expired shares are deleted by the sweeper, not here
+        share_expiration = expiration_of(share_data)
+        if is_expired(share_data, utc_now()):
+            return jsonify({'success': False, 'message': 'This shared file has expired and is no longer available'})
+        
+        if share_data.get('file_missing'):
+            return jsonify({'success': False, 'message': 'The original file has been deleted by the owner'})
         
         # Check if the original file still exists
         file_ref = db.collection('files').document(share_data.get('file_id', ''))
@@ -634,28 +1741,36 @@ def get_shared_file_url():
         
         if not file.exists:
             return jsonify({'success': False, 'message': 'The original file has been deleted by the owner'})
+        
+        if file.to_dict().get('encoding'):
+            # Compressed blobs are decoded on the way out, so they're downloaded through the app
+            return jsonify({
+                'success': True,
+                'url': url_for('download_file', uid=uid, share_id=share_id),
+                'filename': share_data['file_name']
+            })
             
         # Check if the file still exists in storage
-        blob = bucket.blob(f"{share_data['owner_id']}/{share_data['file_path']}")
+        blob = bucket.blob(share_blob_name(share_data))
         
         # Verify the file exists
         if not blob.exists():
             return jsonify({'success': False, 'message': 'This file is no longer available. The owner may have deleted it.'})
         
-        # Generate download URL
-        download_url = blob.generate_signed_url(
-            version="v4",
-            expiration=300,  # 5 minutes
-            method="GET"
+        # Generate download URL, reused no later than the share expires
+        signed = signed_url_cache.sign(
+            share_key(share_id), blob, download_disposition(blob.name, share_data['file_name']),
+            extra={'filename': share_data['file_name'], 'shared_with': uid},
+            not_after=share_expiration.timestamp() if share_expiration else None
         )
         
         return jsonify({
             'success': True, 
-            'url': download_url, 
-            'filename': share_data['file_name']
+            'url': signed['url'], 
+            'filename': signed['filename']
         })
     except Exception as e:
-        print(f"Error getting shared file URL: {str(e)}")
+        app.logger.error(f"Error getting shared file URL: {str(e)}")
         return jsonify({'success': False, 'message': f'Error downloading file: {str(e)}'})
 
 @app.route('/remove-shared-file', methods=['POST'])
@@ -680,9 +1795,21 @@ def remove_shared_file():
     
     # Delete the share record
     share_ref.delete()
+    signed_url_cache.invalidate(share_key(share_id))
+    record_changes(db, uid, [change('unshare', 'share', share_id, share_data['file_name'], '/shared')])
     
     return jsonify({'success': True, 'message': 'File removed from shared files'})
 
+def create_app(storage_backend=None):
+    """
+    Return the app, optionally on another storage backend than configured.
+    
+    Nothing connects until the first request (or backend.warm_up()).
+    """
+    if storage_backend is not None:
+        backend.select(storage_backend)
+    return app
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,42 @@
+"""
+Concurrent backend calls for Dropbox Clone
+
+Firestore and Cloud Storage client calls block the calling thread for a
+whole network round trip. Calls that don't depend on each other can run on
+a shared thread pool instead, so a request waits for the slowest of them
+rather than for their sum.
+
+The Firebase clients are synchronous and thread-safe, so a thread pool gives
+the same overlap an asyncio event loop would, without wrapping every call.
+Calls run on the pool must not submit more work to it. They run in a copy
+of the submitting thread's context, so their backend calls count towards
+the request that submitted them (see metrics.py).
+"""
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+# Threads are started on first use, so the pool survives a pre-fork import
+_executor = ThreadPoolExecutor(max_workers=config.BACKEND_CONCURRENCY, thread_name_prefix='backend')
+
+
+def _submit(function, *args):
+    return _executor.submit(contextvars.copy_context().run, function, *args)
+
+
+def gather(*calls):
+    """
+    Run zero-argument callables concurrently and return their results in order.
+
+    If any call raises, the first exception (in argument order) is re-raised
+    once that call has finished.
+    """
+    futures = [_submit(call) for call in calls]
+    return [future.result() for future in futures]
+
+
+def map_concurrently(function, items):
+    """Apply `function` to each item concurrently, returning results in order"""
+    futures = [_submit(function, item) for item in items]
+    return [future.result() for future in futures]
@@ -0,0 +1,146 @@
+"""
+Storage and metadata backends for Dropbox Clone
+
+The app keeps metadata in a store it reaches through the Firestore client
+API, and file bytes in a store it reaches through the Cloud Storage bucket
+API. Those two APIs, as far as the app uses them, are the backend interface.
+A backend is a function returning a (db, bucket) pair:
+
+- 'firebase' (the default) connects to the project's Firestore and Storage
+  bucket with the service account from config.
+- 'local' keeps metadata in SQLite and bytes on local disk under
+  LOCAL_STORAGE_PATH (see local_store.py), for on-prem nodes and offline
+  runs. Sign-in still goes through Firebase Authentication in the browser.
+
+STORAGE_BACKEND picks one.
+
+Importing the app connects to nothing. Backend.db and Backend.bucket stand
+in for the clients and create them on first use, once per process. gRPC
+channels don't survive a fork, so a client made before gunicorn forks is
+never used by a worker: each worker makes its own. prepare() does the
+fork-safe part of connecting (loading client libraries and credentials) in
+gunicorn's master, and warm_up() opens the worker's connections before it
+takes requests (see gunicorn.conf.py). The first connection in a process
+also instruments the backend's client classes (see metrics.py).
+"""
+import os
+import threading
+
+import config
+import metrics
+
+
+def _firebase_app():
+    """The default Firebase app, initialized on first call"""
+    import firebase_admin
+    from firebase_admin import credentials
+
+    try:
+        return firebase_admin.get_app()
+    except ValueError:
+        pass
+    cred = credentials.Certificate({
+        "type": "service_account",
+        "project_id": config.GOOGLE_PROJECT_ID,
+        "private_key_id": config.GOOGLE_PRIVATE_KEY_ID,
+        "private_key": config.GOOGLE_PRIVATE_KEY,
+        "client_email": config.GOOGLE_CLIENT_EMAIL,
+        "client_id": config.GOOGLE_CLIENT_ID,
+        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+        "token_uri": "https://oauth2.googleapis.com/token",
+        "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
+        "client_x509_cert_url": config.GOOGLE_CLIENT_X509_CERT_URL
+    })
+    return firebase_admin.initialize_app(cred, {
+        'storageBucket': config.FIREBASE_STORAGE_BUCKET
+    })
+
+
+def firebase_backend():
+    from google.cloud import firestore, storage
+
+    # New clients rather than firebase_admin's, which are cached on the app
+    # and would be shared with the parent process after a fork
+    app = _firebase_app()
+    credentials = app.credential.get_credential()
+    db = firestore.Client(project=app.project_id, credentials=credentials)
+    bucket = storage.Client(project=app.project_id, credentials=credentials).bucket(config.FIREBASE_STORAGE_BUCKET)
+    return db, bucket
+
+
+def local_backend(root=None):
+    from local_store import LocalBucket, SQLiteFirestore, load_secret
+
+    root = root or config.LOCAL_STORAGE_PATH
+    os.makedirs(root, exist_ok=True)
+    secret = config.LOCAL_STORAGE_SECRET or load_secret(root)
+    return SQLiteFirestore(os.path.join(root, 'metadata.db')), LocalBucket(root, secret)
+
+
+BACKENDS = {
+    'firebase': firebase_backend,
+    'local': local_backend,
+}
+
+
+def _check(name):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown STORAGE_BACKEND {name!r}; expected one of {', '.join(BACKENDS)}")
+    return name
+
+
+def create_backend(name=None):
+    """Connect to the configured backend and return (db, bucket)"""
+    return BACKENDS[_check(name or config.STORAGE_BACKEND)]()
+
+
+class _Client:
+    """Stands in for one of a backend's clients, passing everything through to it"""
+
+    def __init__(self, backend, index):
+        self._backend = backend
+        self._index = index
+
+    def __getattr__(self, name):
+        return getattr(self._backend.clients()[self._index], name)
+
+
+class Backend:
+    """The configured backend's clients, created on first use in each process"""
+
+    def __init__(self, name=None):
+        self.name = _check(name or config.STORAGE_BACKEND)
+        self.db = _Client(self, 0)
+        self.bucket = _Client(self, 1)
+        self._clients = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def clients(self):
+        """The (db, bucket) pair for this process, connecting if need be"""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    metrics.instrument(self.name)
+                    self._clients = create_backend(self.name)
+                    self._pid = os.getpid()
+        return self._clients
+
+    def select(self, name):
+        """Switch to another backend; clients already handed out follow the switch"""
+        with self._lock:
+            self.name = _check(name)
+            self._clients = None
+            self._pid = None
+
+    def prepare(self):
+        """Do the fork-safe part of connecting: load client libraries and credentials"""
+        if self.name == 'firebase':
+            from google.cloud import firestore, storage  # noqa: F401
+            _firebase_app().credential.get_credential()
+
+    def warm_up(self, timeout=10):
+        """Connect now, with one round trip, so the first request doesn't pay for it"""
+        db, _ = self.clients()
+        if self.name == 'firebase':
+            db.collection('users').document('warm-up').get(retry=None, timeout=timeout)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Compression benchmark: stored size and throughput of each upload codec
+
+Generates log, CSV, JSON and random files, and compresses each the way
+streaming_upload.stream_to_blob() does, chunk by chunk: gzip on one thread
+and on --threads threads, and zstd if the zstandard package is installed.
+Also shows what the default policy would choose for each file, and checks
+that every result decompresses to the original.
+
+Usage: python benchmarks/bench_compression.py [--size-mb 32] [--threads 4]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def log_corpus(rng, size):
+    levels = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARNING', 'ERROR']
+    paths = ['/list-files', '/upload-file', '/get-download-url', '/search', '/list-changes']
+    lines = []
+    total = 0
+    while total < size:
+        line = (f"2026-10-18T12:{rng.randrange(60):02d}:{rng.randrange(60):02d}.{rng.randrange(1000):03d}Z "
+                f"{rng.choice(levels)} {rng.choice(paths)} user={rng.randrange(10000)} "
+                f"status={rng.choice([200, 200, 200, 304, 404, 500])} duration_ms={rng.randrange(1, 2000)}\n")
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def csv_corpus(rng, size):
+    rows = ['id,name,size,content_type,created_at\n']
+    total = len(rows[0])
+    while total < size:
+        row = (f"{rng.randrange(10**9)},report-{rng.randrange(10**5)}.pdf,{rng.randrange(10**7)},"
+               f"application/pdf,2026-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}\n")
+        rows.append(row)
+        total += len(row)
+    return ''.join(rows).encode()[:size]
+
+
+def json_corpus(rng, size):
+    items = []
+    total = 0
+    while total < size:
+        item = json.dumps({
+            'id': f"{rng.getrandbits(80):020x}", 'name': f"photo-{rng.randrange(10**6)}.jpg",
+            'size': rng.randrange(10**8), 'content_type': 'image/jpeg', 'path': f"/albums/{rng.randrange(100)}"
+        })
+        items.append(item)
+        total += len(item) + 1
+    return ('\n'.join(items) + '\n').encode()[:size]
+
+
+def run(data, make_compressor, decompress):
+    encoder = make_compressor()
+    started = time.perf_counter()
+    parts = [encoder.compress(data[start:start + CHUNK_SIZE]) for start in range(0, len(data), CHUNK_SIZE)]
+    parts.append(encoder.flush())
+    elapsed = time.perf_counter() - started
+    stored = b''.join(parts)
+    assert decompress(stored) == data
+    return len(stored), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size-mb', type=int, default=32)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--gzip-level', type=int, default=6)
+    parser.add_argument('--zstd-level', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    # Sizes the compression thread pool before it's imported
+    os.environ['COMPRESSION_THREADS'] = str(args.threads)
+    os.environ.setdefault('UPLOAD_COMPRESSION', 'gzip')
+    import compression
+    from compression import GzipCompressor, choose_codec, decompress, zstandard
+
+    rng = random.Random(args.seed)
+    size = args.size_mb * 1024 * 1024
+    corpora = {
+        'log': ('text/plain', log_corpus(rng, size)),
+        'csv': ('text/csv', csv_corpus(rng, size)),
+        'json': ('application/json', json_corpus(rng, size)),
+        'random': ('application/octet-stream', rng.randbytes(size)),
+    }
+
+    codecs = {
+        'gzip x1': (lambda: GzipCompressor(args.gzip_level, 1), compression.GZIP),
+        f"gzip x{args.threads}": (lambda: GzipCompressor(args.gzip_level, args.threads), compression.GZIP),
+    }
+    if zstandard is not None:
+        codecs[f"zstd x{args.threads}"] = (
+            lambda: zstandard.ZstdCompressor(level=args.zstd_level, threads=args.threads).compressobj(),
+            compression.ZSTD
+        )
+    else:
+        print('zstandard is not installed; skipping zstd\n')
+
+    print(f"{'file':<8} {'policy':<7} {'codec':<9} {'stored bytes':>13} {'ratio':>7} {'MiB/s':>8}")
+    for name, (content_type, data) in corpora.items():
+        chosen = choose_codec(content_type, data[:CHUNK_SIZE]) or 'off'
+        for label, (make_compressor, codec) in codecs.items():
+            stored, elapsed = run(data, make_compressor, lambda stored: decompress(stored, codec))
+            print(f"{name:<8} {chosen:<7} {label:<9} {stored:>13} {stored / len(data):>7.3f} "
+                  f"{len(data) / 2**20 / elapsed:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
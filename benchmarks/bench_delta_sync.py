@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Delta sync benchmark: bytes sent to re-upload a file after a 1% edit
+
+Chunks a random file, applies an edit, chunks it again and counts the bytes
+of the blocks the server would report as missing. Compares an in-place
+overwrite, an insertion and a deletion, against a full re-upload.
+
+Usage: python benchmarks/bench_delta_sync.py [--size-mb 16] [--edit-percent 1]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from chunking import chunk_hashes
+
+
+def transferred(old_manifest, new_manifest):
+    """Bytes of the new manifest's blocks that the old one didn't have"""
+    known = {block_hash for block_hash, _ in old_manifest}
+    sent = {}
+    for block_hash, size in new_manifest:
+        if block_hash not in known:
+            sent[block_hash] = size
+    return sum(sent.values()), len(sent)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size-mb', type=int, default=16)
+    parser.add_argument('--edit-percent', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    size = args.size_mb * 1024 * 1024
+    edit_size = int(size * args.edit_percent / 100)
+    edit_at = rng.randrange(0, size - edit_size)
+    original = rng.randbytes(size)
+    patch = rng.randbytes(edit_size)
+
+    started = time.perf_counter()
+    base_manifest = chunk_hashes(original)
+    elapsed = time.perf_counter() - started
+    print(f"File: {size / 2**20:.0f} MiB, {len(base_manifest)} blocks, "
+          f"chunked at {size / 2**20 / elapsed:.1f} MiB/s")
+    print(f"Edit: {edit_size} bytes at offset {edit_at}\n")
+
+    edits = {
+        'overwrite': original[:edit_at] + patch + original[edit_at + edit_size:],
+        'insert': original[:edit_at] + patch + original[edit_at:],
+        'delete': original[:edit_at] + original[edit_at + edit_size:],
+    }
+
+    print(f"{'edit':<10} {'file bytes':>12} {'sent bytes':>12} {'blocks':>7} {'sent %':>7}")
+    for name, edited in edits.items():
+        sent_bytes, sent_blocks = transferred(base_manifest, chunk_hashes(edited))
+        print(f"{name:<10} {len(edited):>12} {sent_bytes:>12} {sent_blocks:>7} "
+              f"{100 * sent_bytes / len(edited):>6.2f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Local backend benchmark: SQLite metadata queries and zero-copy downloads
+
+Fills the local backend's SQLite metadata store with one user's files spread
+over directories, then times the queries a directory listing makes, a
+single-document read, and a 500-write batch. It then serves one blob over a
+loopback TCP connection, once with sendfile() (the path gunicorn takes for
+send_file()) and once read and written through Python buffers, and reports
+throughput and CPU time for each. Everything runs in a temporary directory,
+so results are reproducible without a Firebase project.
+
+Usage: python benchmarks/bench_local_backend.py [--files 100000] [--directories 1000] [--blob-mb 512]
+"""
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from datastore import write_batch
+from local_store import LocalBucket, SQLiteFirestore
+
+UID = 'bench-user'
+READ_CHUNK = 1024 * 1024
+
+
+def build(db, files, directories):
+    operations = []
+    for index in range(directories):
+        operations.append(('set', db.collection('directories').document(f"dir{index:06d}"), {
+            'user_id': UID, 'name': f"dir{index:06d}", 'parent_id': 'root'
+        }))
+    for index in range(files):
+        operations.append(('set', db.collection('files').document(f"file{index:08d}"), {
+            'user_id': UID, 'name': f"file{index:08d}.txt", 'parent_id': f"dir{index % directories:06d}",
+            'size': index, 'hash': f"{index:032x}"
+        }))
+    write_batch(db, operations)
+
+
+def timed(run, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = run()
+    return (time.perf_counter() - started) / repeat, result
+
+
+def drain(sock, total):
+    received = 0
+    while received < total:
+        data = sock.recv(READ_CHUNK)
+        if not data:
+            break
+        received += len(data)
+
+
+def serve(path, use_sendfile):
+    """Send a file over a loopback TCP connection, returning (seconds, CPU seconds)"""
+    size = os.path.getsize(path)
+    listener = socket.create_server(('127.0.0.1', 0))
+    receiver = socket.create_connection(listener.getsockname())
+    sender, _ = listener.accept()
+    listener.close()
+    reader = threading.Thread(target=drain, args=(receiver, size))
+    reader.start()
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    with open(path, 'rb') as blob_file:
+        if use_sendfile:
+            offset = 0
+            while offset < size:
+                offset += os.sendfile(sender.fileno(), blob_file.fileno(), offset, size - offset)
+        else:
+            while True:
+                chunk = blob_file.read(READ_CHUNK)
+                if not chunk:
+                    break
+                sender.sendall(chunk)
+    reader.join()
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    sender.close()
+    receiver.close()
+    return elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--directories', type=int, default=1000)
+    parser.add_argument('--blob-mb', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        db = SQLiteFirestore(os.path.join(root, 'metadata.db'))
+        started = time.perf_counter()
+        build(db, args.files, args.directories)
+        print(f"Wrote {args.files} files in {args.directories} directories "
+              f"in {time.perf_counter() - started:.1f}s\n")
+
+        directory = f"dir{args.directories // 2:06d}"
+        files = db.collection('files').where('user_id', '==', UID).where('parent_id', '==', directory)
+        rows = [
+            ('list directory, first page', *timed(lambda: len(files.order_by('name').limit(100).get()), args.repeat)),
+            ('list directory, all', *timed(lambda: len(files.get()), args.repeat)),
+            ('count directory', *timed(lambda: files.count().get()[0][0].value, args.repeat)),
+            ('get one file', *timed(lambda: db.collection('files').document('file00000001').get().exists,
+                                    args.repeat)),
+        ]
+        batch = [('update', db.collection('files').document(f"file{index:08d}"), {'size': 0}) for index in range(500)]
+        rows.append(('500-write batch', *timed(lambda: write_batch(db, batch), max(1, args.repeat // 4))))
+
+        print(f"{'metadata operation':<28} {'ms':>9} {'result':>8}")
+        for name, seconds, result in rows:
+            print(f"{name:<28} {seconds * 1000:>9.2f} {str(result):>8}")
+
+        bucket = LocalBucket(root, b'bench')
+        blob = bucket.blob(f"{UID}/.files/large")
+        with blob.open('wb') as writer:
+            chunk = os.urandom(READ_CHUNK)
+            for _ in range(args.blob_mb):
+                writer.write(chunk)
+
+        print(f"\n{'download of ' + str(args.blob_mb) + ' MB':<28} {'MB/s':>9} {'CPU ms':>8}")
+        for name, use_sendfile in (('sendfile()', True), ('read + write', False)):
+            elapsed, cpu = serve(blob._path, use_sendfile)
+            print(f"{name:<28} {args.blob_mb / elapsed:>9.0f} {cpu * 1000:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
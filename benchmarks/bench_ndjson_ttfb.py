@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+NDJSON streaming benchmark: time to first byte and peak memory of bulk responses
+
+Serves the same synthetic Firestore stream as one jsonify() document and as
+a streamed NDJSON response, through Flask's test client, and reports the
+time until the first body chunk, the total time, and the peak Python memory
+allocated while producing the body. The stream yields documents in batches
+with a fixed delay, like Firestore's paged query responses.
+
+Usage: python benchmarks/bench_ndjson_ttfb.py [--results 20000] [--batch-latency-ms 20]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask, jsonify
+
+from ndjson import ndjson_response
+
+# Documents per Firestore query response batch
+STREAM_BATCH = 300
+
+
+def fake_stream(count, batch_latency):
+    """Yield share-like documents, pausing before each batch as a query stream would"""
+    for index in range(count):
+        if index % STREAM_BATCH == 0:
+            time.sleep(batch_latency)
+        yield {
+            'id': f'share{index:08d}',
+            'file_id': f'file{index:08d}',
+            'owner_id': 'owner-uid-0123456789',
+            'owner_email': 'owner@example.com',
+            'shared_with': 'user-uid-0123456789',
+            'file_name': f'document-{index}.pdf',
+            'file_path': f'owner-uid-0123456789/{index:08d}_document-{index}.pdf',
+            'expires_at_string': '2030-01-01'
+        }
+
+
+def create_app(count, batch_latency):
+    app = Flask(__name__)
+
+    @app.route('/buffered')
+    def buffered():
+        return jsonify({'success': True, 'shared_files': list(fake_stream(count, batch_latency))})
+
+    @app.route('/ndjson')
+    def streamed():
+        return ndjson_response('shared_file', fake_stream(count, batch_latency))
+
+    return app
+
+
+def measure(client, url):
+    """Return (ttfb, total, bytes, peak memory) of one request"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    response = client.get(url, buffered=False)
+    first_byte = None
+    received = 0
+    for chunk in response.response:
+        if first_byte is None and chunk:
+            first_byte = time.perf_counter() - started
+        received += len(chunk)
+    total = time.perf_counter() - started
+    response.close()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return first_byte, total, received, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--results', type=int, nargs='+', default=[1000, 20000, 100000])
+    parser.add_argument('--batch-latency-ms', type=float, default=20.0)
+    args = parser.parse_args()
+
+    print(f"{'mode':<10} {'results':>8} {'ttfb ms':>9} {'total ms':>9} {'MB sent':>8} {'peak MB':>8}")
+    for count in args.results:
+        client = create_app(count, args.batch_latency_ms / 1000).test_client()
+        for mode in ('buffered', 'ndjson'):
+            ttfb, total, received, peak = measure(client, f'/{mode}')
+            print(f"{mode:<10} {count:>8} {ttfb * 1000:>9.1f} {total * 1000:>9.1f} "
+                  f"{received / 2**20:>8.1f} {peak / 2**20:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
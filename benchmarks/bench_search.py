@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Search benchmark: query latency as a user's index grows
+
+Builds a search index of generated files and directories at each size, then
+times the queries /search runs: a name substring (the FTS5 trigram index),
+a name prefix, a substring with a type filter, filters alone, and a folder
+subtree, plus queries whose filters match far fewer entries than their name
+does: a common word in one small folder, tiny files, and a short query for
+one type. Names come from a small vocabulary, so a common word matches many
+entries and a rare one few. Also reports how long the build took and the
+index's size on disk.
+
+Usage: python benchmarks/bench_search.py [--sizes 10000,100000,1000000] [--repeat 50]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from search_index import SearchIndex
+
+WORDS = ['report', 'invoice', 'photo', 'holiday', 'budget', 'draft', 'final', 'scan', 'notes', 'backup',
+         'meeting', 'contract', 'summary', 'design', 'receipt', 'project', 'plan', 'slides', 'export', 'video']
+EXTENSIONS = [('.pdf', 'application/pdf'), ('.jpg', 'image/jpeg'), ('.png', 'image/png'),
+              ('.docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+              ('.mp4', 'video/mp4'), ('.txt', 'text/plain')]
+
+# Files per generated directory
+FILES_PER_DIRECTORY = 50
+
+# Stands for a directory two levels down, whose files are a tiny part of the index
+DEEP_FOLDER = object()
+
+QUERIES = [
+    ('substring, common', dict(query='report')),
+    ('substring, rare', dict(query='0004242')),
+    ('prefix', dict(query='budget', match='prefix')),
+    ('substring + type', dict(query='holiday', content_type='image/')),
+    ('filters only', dict(kind='file', min_size=1_000_000, created_after='2024-06-01')),
+    ('folder subtree', dict(query='final', path='/dir0003')),
+    ('deep folder', dict(query='report', path=DEEP_FOLDER)),
+    ('tiny files', dict(kind='file', max_size=150)),
+    ('short + type', dict(query='re', content_type='text/plain')),
+    ('type only', dict(content_type='text/plain')),
+]
+
+
+def generate(count, seed=0):
+    """Index rows for `count` entries: directories two levels deep, full of files"""
+    rng = random.Random(seed)
+    directories = []
+    start = time.mktime((2023, 1, 1, 0, 0, 0, 0, 0, 0))
+    for index in range(count):
+        created_at = start + rng.random() * 3 * 365 * 86400
+        if index % FILES_PER_DIRECTORY == 0:
+            top = len(directories) // 20
+            parent = '/' if len(directories) % 20 == 0 else f"/dir{top:04d}"
+            name = f"dir{top:04d}" if parent == '/' else f"{rng.choice(WORDS)}-{index:07d}"
+            directories.append(f"{parent.rstrip('/')}/{name}")
+            yield (f"d{index}", 'directory', name, parent, None, None, created_at)
+            continue
+        extension, content_type = rng.choice(EXTENSIONS)
+        name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{index:07d}{extension}"
+        yield (f"f{index}", 'file', name, directories[-1], content_type, rng.randint(100, 50_000_000), created_at)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='entries per index')
+    parser.add_argument('--repeat', type=int, default=50, help='runs of each query')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = SearchIndex(directory, None)
+        print(f"{'entries':>9} {'query':<18} {'results':>8} {'median ms':>10} {'p99 ms':>8}")
+        for size in (int(value) for value in args.sizes.split(',')):
+            uid = f"user{size}"
+            started = time.perf_counter()
+            index.load(uid, generate(size), 1)
+            build_seconds = time.perf_counter() - started
+            deep = index.search(uid, kind='directory', path='/dir0003', limit=1)[0]['full_path']
+            for label, query in QUERIES:
+                query = {key: deep if value is DEEP_FOLDER else value for key, value in query.items()}
+                timings = []
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    results = index.search(uid, limit=50, **query)
+                    timings.append(time.perf_counter() - started)
+                print(f"{size:>9} {label:<18} {len(results):>8} "
+                      f"{statistics.median(timings) * 1000:>10.2f} {percentile(timings, 0.99) * 1000:>8.2f}")
+            megabytes = os.path.getsize(os.path.join(directory, f"{uid}.db")) / 1e6
+            print(f"{size:>9} built in {build_seconds:.1f} s, {megabytes:.0f} MB on disk\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Serving benchmark: requests/sec and p99 latency of the worker models
+
+Runs gunicorn on a stand-in for /get-shared-files whose backend calls sleep
+for a fixed latency: one Firestore query, then one blob.exists() per share.
+Each configuration is loaded by concurrent keep-alive clients for a fixed
+time:
+
+  sync        sync workers (one request each at a time), existence checks one
+              after another (the old setup)
+  gthread     threaded workers (--threads each), checks one after another
+  concurrent  threaded workers, checks run together on the backend pool
+
+Usage: python benchmarks/bench_serving.py [--shares 20] [--latency-ms 30] [--clients 32]
+"""
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from flask import Flask, jsonify
+
+from backend_pool import map_concurrently
+
+CONFIGURATIONS = {
+    'sync': ('sync', 'sequential'),
+    'gthread': ('gthread', 'sequential'),
+    'concurrent': ('gthread', 'concurrent'),
+}
+
+# The app gunicorn serves, configured through the environment by main()
+app = Flask(__name__)
+SHARES = int(os.environ.get('BENCH_SHARES', 20))
+LATENCY = float(os.environ.get('BENCH_LATENCY_MS', 30)) / 1000
+FAN_OUT = os.environ.get('BENCH_FAN_OUT', 'sequential')
+
+
+def blob_exists(share):
+    time.sleep(LATENCY)
+    return True
+
+
+@app.route('/get-shared-files')
+def get_shared_files():
+    # The Firestore query for the user's shares
+    time.sleep(LATENCY)
+    shares = [{'id': f'share{index}'} for index in range(SHARES)]
+    if FAN_OUT == 'concurrent':
+        found = map_concurrently(blob_exists, shares)
+    else:
+        found = [blob_exists(share) for share in shares]
+    for share, exists in zip(shares, found):
+        share['file_missing'] = not exists
+    return jsonify({'success': True, 'shared_files': shares})
+
+
+def wait_for_server(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/get-shared-files')
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('gunicorn did not start')
+
+
+def load(port, clients, duration):
+    """Drive the server with keep-alive clients; return per-request latencies"""
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        measured = []
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            connection.request('GET', '/get-shared-files')
+            connection.getresponse().read()
+            measured.append(time.perf_counter() - started)
+        connection.close()
+        with lock:
+            latencies.extend(measured)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--shares', type=int, default=20)
+    parser.add_argument('--latency-ms', type=float, default=30.0)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    print(f"{args.shares} shares, {args.latency_ms:.0f} ms per backend call, "
+          f"{args.workers} workers, {args.clients} clients for {args.duration:.0f}s\n")
+    print(f"{'mode':<11} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    # An empty config file, as otherwise gunicorn picks up the repo's gunicorn.conf.py,
+    # which imports the app and connects to Firestore in every worker
+    with tempfile.NamedTemporaryFile('w', suffix='.py') as config_file:
+        for name, (worker_class, fan_out) in CONFIGURATIONS.items():
+            serve(name, worker_class, fan_out, config_file, args)
+
+
+def serve(name, worker_class, fan_out, config_file, args):
+    """Load one configuration and print its throughput and latency"""
+    env = dict(os.environ, BENCH_SHARES=str(args.shares), BENCH_LATENCY_MS=str(args.latency_ms),
+               BENCH_FAN_OUT=fan_out)
+    # gunicorn runs sync workers as gthread when given more than one thread
+    threads = 1 if worker_class == 'sync' else args.threads
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'bench_serving:app', '--config', config_file.name,
+         '--chdir', os.path.dirname(os.path.abspath(__file__)),
+         '--bind', f'127.0.0.1:{args.port}', '--workers', str(args.workers),
+         '--worker-class', worker_class, '--threads', str(threads),
+         '--timeout', '120', '--log-level', 'warning'],
+        env=env
+    )
+    try:
+        wait_for_server(args.port)
+        started = time.perf_counter()
+        latencies = load(args.port, args.clients, args.duration)
+        elapsed = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(f"{name:<11} {len(latencies) / elapsed:>8.1f} {percentile(latencies, 0.5) * 1000:>8.0f} "
+          f"{percentile(latencies, 0.99) * 1000:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
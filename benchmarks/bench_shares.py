@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Shared files benchmark: listing latency as a user's share count grows
+
+Lists the shares of recipients with more and more shares in an in-memory
+Firestore, the old way and the new way. The old way checked that every
+shared file still existed in Cloud Storage, with one HEAD request per share,
+50 shares at a time on the backend thread pool. The new way is one query:
+shares of deleted files were already flagged when the owner deleted them.
+Each Firestore round trip and Storage request sleeps for a fixed latency.
+The last line shows what flagging costs the owner who deletes a shared file.
+
+Usage: python benchmarks/bench_shares.py [--shares 10,100,1000,5000] [--rtt-ms 10] [--storage-ms 30]
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_firestore import FakeFirestore
+
+from backend_pool import map_concurrently
+from duplicate_index import create_file, delete_files
+from share_expiry import active_shares_query, utc_now
+
+# Shares checked concurrently per batch by the old listing
+SHARE_CHECK_BATCH = 50
+
+# Recipients of each file shared by the owner in the delete rows
+RECIPIENTS = 5
+
+
+class FakeBlob:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def exists(self):
+        time.sleep(self.latency)
+        return True
+
+
+def build_shares(db, uid, count):
+    expires_at = utc_now() + datetime.timedelta(days=365)
+    for index in range(count):
+        db.collection('shared_files').document().set({
+            'file_id': f"file{index:06d}", 'owner_id': 'owner', 'shared_with': uid,
+            'file_name': f"file{index:06d}.pdf", 'file_path': f"/file{index:06d}.pdf",
+            'expires_at': expires_at
+        })
+
+
+def list_checking_storage(db, uid, storage_latency):
+    """The old listing: the query, then a blob.exists() per share in concurrent batches"""
+    shares = [share.to_dict() for share in active_shares_query(db, uid, utc_now()).stream()]
+    for start in range(0, len(shares), SHARE_CHECK_BATCH):
+        map_concurrently(lambda share: FakeBlob(storage_latency).exists(), shares[start:start + SHARE_CHECK_BATCH])
+    return len(shares)
+
+
+def list_flagged(db, uid):
+    return len([share.to_dict() for share in active_shares_query(db, uid, utc_now()).stream()])
+
+
+def measure(db, run):
+    db.reset_counters()
+    started = time.perf_counter()
+    run()
+    return sum(db.round_trips.values()), time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--shares', default='10,100,1000,5000', help='share counts per recipient')
+    parser.add_argument('--rtt-ms', type=float, default=10.0, help='latency per Firestore round trip')
+    parser.add_argument('--storage-ms', type=float, default=30.0, help='latency per Storage request')
+    args = parser.parse_args()
+
+    db = FakeFirestore(latency=args.rtt_ms / 1000)
+    storage_latency = args.storage_ms / 1000
+    rows = []
+    for count in (int(value) for value in args.shares.split(',')):
+        uid = f"recipient{count}"
+        build_shares(db, uid, count)
+        trips, seconds = measure(db, lambda: list_checking_storage(db, uid, storage_latency))
+        rows.append((count, 'list, storage checks', trips, count, seconds))
+        trips, seconds = measure(db, lambda: list_flagged(db, uid))
+        rows.append((count, 'list, flags', trips, 0, seconds))
+
+    # The owner deletes a file shared with RECIPIENTS users
+    file_ref = db.collection('files').document()
+    create_file(db, file_ref, {'user_id': 'owner', 'path': '/', 'hash': 'h', 'name': 'shared.pdf'})
+    for index in range(RECIPIENTS):
+        db.collection('shared_files').document().set({'file_id': file_ref.id, 'shared_with': f"user{index}"})
+    snapshot = file_ref.get()
+    trips, seconds = measure(db, lambda: delete_files(db, 'owner', [snapshot]))
+
+    print(f"Firestore round trip {args.rtt_ms:.0f} ms, Storage request {args.storage_ms:.0f} ms, "
+          f"{SHARE_CHECK_BATCH} Storage checks at a time\n")
+    print(f"{'shares':>7} {'listing':<22} {'round trips':>12} {'Storage calls':>14} {'ms':>9}")
+    for count, mode, round_trips, calls, elapsed in rows:
+        print(f"{count:>7} {mode:<22} {round_trips:>12} {calls:>14} {elapsed * 1000:>9.1f}")
+    print(f"\nDeleting a file shared with {RECIPIENTS} users: {trips} round trips, "
+          f"{seconds * 1000:.1f} ms, shares flagged in the same transaction")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Signed URL benchmark: signing CPU and backend round trips per download click
+
+Signs real V4 URLs offline with a throwaway service-account key and replays
+a stream of download clicks, skewed towards popular files, at a fixed rate.
+Compares signing on every click (the old behaviour) with the signed URL
+cache, and with prefetching each folder's URLs through the batch endpoint.
+
+Usage: python benchmarks/bench_signed_urls.py [--files 500] [--clicks 5000] [--click-interval 0.2]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from google.cloud import storage
+from google.oauth2 import service_account
+
+from signed_urls import SignedUrlCache, file_key
+
+TTL = 300
+MARGIN = 60
+FOLDER_SIZE = 100
+
+
+def throwaway_bucket():
+    """A bucket handle whose credentials can sign URLs without any network access"""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+    credentials = service_account.Credentials.from_service_account_info({
+        'type': 'service_account',
+        'client_email': 'bench@bench.iam.gserviceaccount.com',
+        'private_key': pem,
+        'token_uri': 'https://oauth2.googleapis.com/token',
+    })
+    return storage.Client(project='bench', credentials=credentials).bucket('bench-bucket')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--files', type=int, default=500)
+    parser.add_argument('--clicks', type=int, default=5000)
+    parser.add_argument('--click-interval', type=float, default=0.2, help='seconds between clicks')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    bucket = throwaway_bucket()
+    rng = random.Random(args.seed)
+    # Popularity falls off with rank, like real download traffic
+    weights = [1 / (rank + 1) for rank in range(args.files)]
+    clicks = rng.choices(range(args.files), weights=weights, k=args.clicks)
+    disposition = 'attachment; filename="report.pdf"'
+
+    def sign(index):
+        blob = bucket.blob(f'user/files/file{index:06d}.pdf')
+        return blob.generate_signed_url(version='v4', expiration=TTL, method='GET',
+                                         response_disposition=disposition)
+
+    results = []
+
+    # Every click reads the file record and signs a new URL
+    started = time.process_time()
+    for index in clicks:
+        sign(index)
+    results.append(('uncached', args.clicks, args.clicks, time.process_time() - started))
+
+    # Clicks reuse cached URLs; a miss reads the record and signs
+    clock = Clock()
+    cache = SignedUrlCache(args.files, TTL, MARGIN, clock=clock)
+    round_trips = 0
+    for index in clicks:
+        clock.now += args.click_interval
+        if cache.get(file_key(index)) is None:
+            round_trips += 1
+            cache.sign(file_key(index), bucket.blob(f'user/files/file{index:06d}.pdf'), disposition)
+    results.append(('cached', round_trips, cache.signed, cache.sign_cpu_seconds))
+
+    # Each folder view prefetches its URLs in one batch request; clicks need no request
+    clock = Clock()
+    cache = SignedUrlCache(args.files, TTL, MARGIN, clock=clock)
+    round_trips = 0
+    folder_loaded = {}
+    for index in clicks:
+        clock.now += args.click_interval
+        folder = index // FOLDER_SIZE
+        if clock.now - folder_loaded.get(folder, -TTL) >= TTL - MARGIN:
+            folder_loaded[folder] = clock.now
+            members = range(folder * FOLDER_SIZE, min((folder + 1) * FOLDER_SIZE, args.files))
+            uncached = [member for member in members if cache.get(file_key(member)) is None]
+            if uncached:
+                round_trips += 1
+            for member in uncached:
+                cache.sign(file_key(member), bucket.blob(f'user/files/file{member:06d}.pdf'), disposition)
+    results.append(('prefetch', round_trips, cache.signed, cache.sign_cpu_seconds))
+
+    elapsed = args.clicks * args.click_interval
+    print(f"{args.clicks} clicks on {args.files} files over {elapsed:.0f}s, URLs valid {TTL}s\n")
+    print(f"{'mode':<10} {'round trips':>12} {'signatures':>11} {'sign CPU ms':>12} {'CPU ms/click':>13}")
+    for name, trips, signatures, cpu in results:
+        print(f"{name:<10} {trips:>12} {signatures:>11} {cpu * 1000:>12.0f} {cpu * 1000 / args.clicks:>13.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark: cold start and gunicorn worker boot time
+
+Cold start runs `import app` in fresh interpreters, and then the same import
+followed by creating the backend clients, which is what every import paid
+for before clients were created lazily. Worker boot mimics gunicorn: a
+parent process forks workers, and each one times from the fork until its
+clients are ready. With preloading, the parent has imported the app and
+called backend.prepare() first. Without it, each worker imports the app
+itself. The network round trip of backend.warm_up() is not included, so
+this runs offline.
+
+Usage: python benchmarks/bench_startup.py [--runs 10] [--backend firebase]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+COLD_START = '''
+import time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+{connect}
+print(imported - started, time.perf_counter() - started)
+'''
+
+WORKER_BOOT = '''
+import os, sys, time
+{preload}
+times = []
+for _ in range({runs}):
+    read_end, write_end = os.pipe()
+    forked = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        import app
+        app.backend.clients()
+        os.write(write_end, repr(time.perf_counter() - forked).encode())
+        os._exit(0)
+    os.close(write_end)
+    times.append(float(os.read(read_end, 64)))
+    os.close(read_end)
+    os.waitpid(pid, 0)
+print(' '.join(map(str, times)))
+'''
+
+
+def run_python(code, backend):
+    env = dict(os.environ, STORAGE_BACKEND=backend)
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+
+def cold_start(runs, backend, connect):
+    code = COLD_START.format(connect='app.backend.clients()' if connect else '')
+    samples = [tuple(map(float, run_python(code, backend))) for _ in range(runs)]
+    return [total for _, total in samples]
+
+
+def worker_boot(runs, backend, preload):
+    code = WORKER_BOOT.format(
+        runs=runs,
+        preload='import app\napp.backend.prepare()' if preload else ''
+    )
+    return [float(value) for value in run_python(code, backend)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--backend', default='firebase', choices=['firebase', 'local'])
+    args = parser.parse_args()
+
+    rows = [
+        ('import app (lazy clients)', cold_start(args.runs, args.backend, connect=False)),
+        ('import app + create clients', cold_start(args.runs, args.backend, connect=True)),
+        ('worker boot, preloaded', worker_boot(args.runs, args.backend, preload=True)),
+        ('worker boot, not preloaded', worker_boot(args.runs, args.backend, preload=False)),
+    ]
+
+    print(f"{args.backend} backend, {args.runs} runs each, times in ms\n")
+    print(f"{'phase':<30} {'median':>8} {'min':>8} {'max':>8}")
+    for name, samples in rows:
+        samples = [sample * 1000 for sample in samples]
+        print(f"{name:<30} {statistics.median(samples):>8.1f} {min(samples):>8.1f} {max(samples):>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
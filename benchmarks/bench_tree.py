@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Directory tree benchmark: listing, resolving and renaming on both schemas
+
+Builds one user's tree in an in-memory Firestore: a chain of directories
+--depth deep, holding --nodes directories and files in total spread evenly
+along it. Every document carries both its path and its parent link, as a
+migrated user's do. On each schema it then times listing the deepest
+directory, resolving paths to IDs and back, and renaming the top of the
+chain, which holds everything else. Round trips are counted and turned into
+an estimate at --rtt-ms each.
+
+Usage: python benchmarks/bench_tree.py [--nodes 1000000] [--depth 20] [--rtt-ms 10]
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_firestore import FakeFirestore
+
+from datastore import BATCH_LIMIT, write_batch
+from directory_tree import DirectoryTree, reparent_directory
+
+UID = 'bench-user'
+
+# Share of the entries at each level that are (empty) directories rather than files
+DIRECTORY_SHARE = 0.05
+
+
+def build_tree(db, nodes, depth):
+    """Create the tree and return the IDs of the chain, root first"""
+    directories = db.collection('directories')
+    files = db.collection('files')
+    db.collection('users').document(UID).set({'tree_schema': 'ids'})
+
+    chain = [directories.document()]
+    chain[0].set({'user_id': UID, 'name': '/', 'path': '/', 'parent_path': None, 'parent_id': None})
+    path = '/'
+    for level in range(1, depth + 1):
+        name = f"d{level:02d}"
+        child = directories.document()
+        child_path = f"{path.rstrip('/')}/{name}"
+        child.set({'user_id': UID, 'name': name, 'path': child_path, 'parent_path': path, 'parent_id': chain[-1].id})
+        chain.append(child)
+        path = child_path
+
+    remaining = nodes - depth - 1
+    for level in range(1, depth + 1):
+        parent = chain[level]
+        parent_path = '/' + '/'.join(f"d{index:02d}" for index in range(1, level + 1))
+        count = remaining // depth + (1 if level <= remaining % depth else 0)
+        subdirectories = int(count * DIRECTORY_SHARE)
+        for index in range(count):
+            if index < subdirectories:
+                name = f"sub{index:06d}"
+                directories.document().set({
+                    'user_id': UID, 'name': name, 'path': f"{parent_path}/{name}",
+                    'parent_path': parent_path, 'parent_id': parent.id
+                })
+            else:
+                files.document().set({
+                    'user_id': UID, 'name': f"file{index:06d}.txt", 'path': parent_path,
+                    'parent_id': parent.id, 'size': 1024, 'hash': f"{index:032x}"
+                })
+    return [ref.id for ref in chain]
+
+
+def measure(db, rows, schema, operation, run):
+    db.reset_counters()
+    started = time.process_time()
+    result = run()
+    cpu = time.process_time() - started
+    rows.append((schema, operation, sum(db.round_trips.values()), db.documents_read, db.documents_written, cpu))
+    return result
+
+
+def list_by_path(db, path):
+    directories = db.collection('directories').where('user_id', '==', UID).where('parent_path', '==', path).get()
+    files = db.collection('files').where('user_id', '==', UID).where('path', '==', path).get()
+    return len(directories) + len(files)
+
+
+def list_by_parent(db, tree, path):
+    parent_id = tree.resolve(UID, path)
+    directories = db.collection('directories').where('user_id', '==', UID).where('parent_id', '==', parent_id).get()
+    files = db.collection('files').where('user_id', '==', UID).where('parent_id', '==', parent_id).get()
+    return len(directories) + len(files)
+
+
+def rename_by_path(db, source, target):
+    """What a rename costs on the path schema: rewriting every path below the directory"""
+    operations = []
+    prefix = source + '/'
+    for collection, fields in (('directories', ['path', 'parent_path']), ('files', ['path'])):
+        documents = db.collection(collection).where('user_id', '==', UID)
+        for query in (documents.where('path', '==', source),
+                      documents.where('path', '>=', prefix).where('path', '<', prefix + '\uf8ff')):
+            for snapshot in query.select(fields).stream():
+                data = snapshot.to_dict()
+                updates = {field: target + data[field][len(source):] for field in fields
+                           if data.get(field) and (data[field] == source or data[field].startswith(prefix))}
+                operations.append(('update', snapshot.reference, updates))
+    write_batch(db, operations)
+    return len(operations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--nodes', type=int, default=1000000)
+    parser.add_argument('--depth', type=int, default=20)
+    parser.add_argument('--rtt-ms', type=float, default=10.0, help='latency per Firestore round trip')
+    args = parser.parse_args()
+
+    db = FakeFirestore()
+    started = time.perf_counter()
+    chain = build_tree(db, args.nodes, args.depth)
+    db.build_indexes('directories', 'user_id', 'path', 'parent_path', 'parent_id', 'name')
+    db.build_indexes('files', 'user_id', 'path', 'parent_id')
+    print(f"Built {args.nodes} nodes at depth {args.depth} in {time.perf_counter() - started:.1f}s\n")
+
+    deepest = '/' + '/'.join(f"d{level:02d}" for level in range(1, args.depth + 1))
+    rows = []
+
+    # Path schema
+    measure(db, rows, 'paths', 'list deepest', lambda: list_by_path(db, deepest))
+    measure(db, rows, 'paths', 'resolve deepest', lambda: db.collection('directories').where(
+        'user_id', '==', UID).where('path', '==', deepest).limit(1).get())
+    renamed = measure(db, rows, 'paths', 'rename top', lambda: rename_by_path(db, '/d01', '/r01'))
+    rename_by_path(db, '/r01', '/d01')
+
+    # ID schema, from a cold cache and then a warm one
+    tree = DirectoryTree(db, max_entries=100000, ttl=3600)
+    measure(db, rows, 'ids', 'list deepest, cold', lambda: list_by_parent(db, tree, deepest))
+    measure(db, rows, 'ids', 'list deepest, warm', lambda: list_by_parent(db, tree, deepest))
+    measure(db, rows, 'ids', 'resolve deepest, warm', lambda: tree.resolve(UID, deepest))
+    measure(db, rows, 'ids', 'resolve deepest, fresh', lambda: tree.resolve(UID, deepest, fresh=True))
+    measure(db, rows, 'ids', 'path of deepest, cold', lambda: DirectoryTree(db, 100000, 3600).path_of(UID, chain[-1]))
+    measure(db, rows, 'ids', 'path of deepest, warm', lambda: tree.path_of(UID, chain[-1]))
+
+    def rename():
+        reparent_directory(db, UID, chain[1], chain[0], 'r01')
+        tree.remember(UID, chain[1], chain[0], 'r01')
+    measure(db, rows, 'ids', 'rename top', rename)
+    moved = '/r01' + deepest[len('/d01'):]
+    measure(db, rows, 'ids', 'list renamed, warm', lambda: list_by_parent(db, tree, moved))
+    assert tree.path_of(UID, chain[-1]) == moved
+
+    print(f"Renaming the top directory rewrites {renamed} documents on the path schema\n")
+    print(f"{'schema':<7} {'operation':<24} {'round trips':>12} {'docs read':>10} {'written':>9} "
+          f"{'CPU ms':>9} {'est. ms @ ' + str(args.rtt_ms) + ' RTT':>18}")
+    for schema, operation, trips, read, written, cpu in rows:
+        estimate = cpu * 1000 + trips * args.rtt_ms
+        print(f"{schema:<7} {operation:<24} {trips:>12} {read:>10} {written:>9} {cpu * 1000:>9.1f} {estimate:>18.1f}")
+    print(f"\nPath-schema renames commit {BATCH_LIMIT} writes per batch: "
+          f"{math.ceil(renamed / BATCH_LIMIT)} batches here")
+
+
+if __name__ == '__main__':
+    main()
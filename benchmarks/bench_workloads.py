@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Workload benchmark: throughput, latency and backend calls per endpoint
+
+Runs the real app, in process, on an in-memory Firestore and Storage
+(fake_firestore.py and fake_storage.py) whose calls sleep for a fixed
+latency. Concurrent clients, one user each, run scripted workloads:
+
+  browse      list the root and a folder page by page, get download URLs
+  upload      upload new files into the user's folders
+  share       share a file, list and open it as the recipient, unshare it
+  duplicates  scan a folder, then the whole account, for duplicates
+
+Every user starts with the same number of folders and files, drawn from a
+small pool of contents so that duplicates exist. Each client runs a fixed
+number of iterations with its own seeded random choices, so two runs make
+the same requests. For each endpoint the benchmark reports requests,
+throughput, latency percentiles, failed requests and backend calls per
+request. Calls are counted by the app's own instrumentation (metrics.py),
+read back through /metrics.
+
+--output saves the results as JSON; --baseline compares p95 latency and
+backend calls with a saved run, to catch regressions.
+
+Usage: python benchmarks/bench_workloads.py [--workloads browse,upload,share,duplicates] [--clients 8] [--iterations 20] [--rtt-ms 10] [--storage-ms 30] [--output results.json] [--baseline results.json]
+"""
+import argparse
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict, namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_firestore import FakeFirestore
+from fake_storage import FakeBucket
+
+import app as app_module
+import backends
+import metrics
+
+# The fakes' methods that stand for backend calls, instrumented like the real clients'
+FAKE_METHODS = [
+    ('fake_firestore', 'FakeFirestore', 'firestore', {'get_all': 'read'}),
+    ('fake_firestore', 'FakeDocument', 'firestore', {
+        'get': 'read', 'create': 'write', 'set': 'write', 'update': 'write', 'delete': 'write'
+    }),
+    ('fake_firestore', 'FakeQuery', 'firestore', {'get': 'read', 'stream': 'read'}),
+    ('fake_firestore', 'FakeAggregation', 'firestore', {'get': 'read'}),
+    ('fake_firestore', 'FakeBatch', 'firestore', {'commit': 'write'}),
+    ('fake_firestore', 'FakeTransaction', 'firestore', {'get': 'read', 'get_all': 'read', '_commit': 'write'}),
+    ('fake_storage', 'FakeBlob', 'storage', {
+        'exists': 'head', 'reload': 'head', 'generate_signed_url': 'sign', 'download_as_bytes': 'read',
+        'upload_from_string': 'write', 'upload_from_file': 'write', 'delete': 'write', 'compose': 'write'
+    }),
+    ('fake_storage', 'FakeBucket', 'storage', {'get_blob': 'head', 'list_blobs': 'read', 'copy_blob': 'write'}),
+    ('fake_storage', '_Writer', 'storage', {'_upload_chunks_from_buffer': 'write', '_finish_upload': 'write'}),
+]
+
+# Columns of backend calls per request: (service, operation, heading)
+CALL_COLUMNS = [
+    ('firestore', 'read', 'fs rd'),
+    ('firestore', 'write', 'fs wr'),
+    ('storage', 'head', 'st hd'),
+    ('storage', 'read', 'st rd'),
+    ('storage', 'write', 'st wr'),
+    ('storage', 'sign', 'sign'),
+]
+
+CALLS_LINE = re.compile(
+    r'^backend_calls_total\{route="([^"]*)",service="([^"]*)",operation="([^"]*)",worker="\d+"\} (\d+)$', re.M
+)
+
+User = namedtuple('User', ['index', 'uid', 'email', 'directories', 'file_ids'])
+
+
+class Results:
+    """Latencies and failures of every request, by endpoint"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.failures = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, route, seconds, ok):
+        with self._lock:
+            self.latencies[route].append(seconds)
+            if not ok:
+                self.failures[route] += 1
+
+
+class Session:
+    """A client of the app, timing each request"""
+
+    def __init__(self, flask_app, results):
+        self.client = flask_app.test_client()
+        self.results = results
+
+    def post(self, route, **kwargs):
+        started = time.perf_counter()
+        response = self.client.post(route, **kwargs)
+        body = response.get_json()
+        # Closing the response is what finishes the request's metrics
+        response.close()
+        if self.results is not None:
+            self.results.add(route, time.perf_counter() - started, bool(body and body.get('success')))
+        return body
+
+
+def upload(session, user, path, name, content):
+    return session.post('/upload-file', data={
+        'uid': user.uid, 'path': path, 'file': (io.BytesIO(content), name)
+    }, content_type='multipart/form-data')
+
+
+def browse(session, user, rng, users, contents, iteration):
+    session.post('/list-directory', json={'uid': user.uid, 'path': '/'})
+    path = rng.choice(user.directories)
+    page = session.post('/list-directory', json={'uid': user.uid, 'path': path, 'page_size': 10})
+    if page.get('next_cursor'):
+        session.post('/list-directory', json={'uid': user.uid, 'path': path, 'page_size': 10,
+                                              'cursor': page['next_cursor']})
+    files = session.post('/get-files', json={'uid': user.uid, 'path': path})['files']
+    session.post('/get-download-url', json={'uid': user.uid, 'file_id': rng.choice(files)['id']})
+    session.post('/get-download-urls', json={
+        'uid': user.uid, 'file_ids': [file['id'] for file in rng.sample(files, min(10, len(files)))]
+    })
+
+
+def upload_files(session, user, rng, users, contents, iteration):
+    upload(session, user, rng.choice(user.directories), f"upload-{iteration:05d}.bin", rng.choice(contents))
+
+
+def share(session, user, rng, users, contents, iteration):
+    recipient = users[(user.index + 1) % len(users)]
+    shared = session.post('/share-file', json={
+        'uid': user.uid, 'file_id': rng.choice(user.file_ids), 'share_email': recipient.email
+    })
+    session.post('/get-shared-files', json={'uid': recipient.uid})
+    if shared.get('success'):
+        session.post('/get-shared-file-url', json={'uid': recipient.uid, 'share_id': shared['share_id']})
+        session.post('/remove-shared-file', json={'uid': recipient.uid, 'share_id': shared['share_id']})
+
+
+def duplicates(session, user, rng, users, contents, iteration):
+    session.post('/find-duplicates', json={'uid': user.uid, 'path': rng.choice(user.directories)})
+    session.post('/find-all-duplicates', json={'uid': user.uid})
+
+
+WORKLOADS = {
+    'browse': browse,
+    'upload': upload_files,
+    'share': share,
+    'duplicates': duplicates,
+}
+
+
+def seed(flask_app, clients, directories, files, contents):
+    """Create a user per client with its folders and files, through the app"""
+    session = Session(flask_app, None)
+    users = []
+    for index in range(clients):
+        uid = f"user{index:03d}"
+        email = f"{uid}@bench.example"
+        session.post('/init-user', json={'uid': uid, 'email': email})
+        paths = []
+        for directory in range(directories):
+            name = f"folder{directory:02d}"
+            session.post('/create-directory', json={'uid': uid, 'current_path': '/', 'directory_name': name})
+            paths.append(f"/{name}")
+            for number in range(files):
+                upload(session, User(index, uid, email, None, None), paths[-1], f"file{number:04d}.bin",
+                       contents[(index + directory * files + number) % len(contents)])
+        file_ids = [
+            file['id']
+            for path in paths
+            for file in session.post('/get-files', json={'uid': uid, 'path': path})['files']
+        ]
+        users.append(User(index, uid, email, paths, file_ids))
+    return users
+
+
+def backend_calls(flask_app):
+    """Backend calls so far, as {(route, service, operation): count}, read from /metrics"""
+    response = flask_app.test_client().get('/metrics')
+    text = response.get_data(as_text=True)
+    response.close()
+    return Counter({
+        (route, service, operation): int(count)
+        for route, service, operation, count in CALLS_LINE.findall(text)
+    })
+
+
+def run(flask_app, workload, users, contents, iterations, seed_value):
+    """Run one workload on every user at once; return (results, seconds, backend calls by endpoint)"""
+    results = Results()
+    calls_before = backend_calls(flask_app)
+
+    def client(user):
+        session = Session(flask_app, results)
+        rng = random.Random(f"{seed_value}-{workload}-{user.index}")
+        for iteration in range(iterations):
+            WORKLOADS[workload](session, user, rng, users, contents, iteration)
+
+    threads = [threading.Thread(target=client, args=(user,)) for user in users]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return results, elapsed, backend_calls(flask_app) - calls_before
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(results, elapsed, calls):
+    """Per-endpoint rows of the report, as plain dicts"""
+    rows = {}
+    for route, latencies in sorted(results.latencies.items()):
+        count = len(latencies)
+        rows[route] = {
+            'requests': count,
+            'requests_per_second': count / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'failed': results.failures[route],
+            'calls_per_request': {
+                f"{service} {operation}": calls[(route, service, operation)] / count
+                for service, operation, _ in CALL_COLUMNS
+            },
+        }
+    return rows
+
+
+def print_report(name, rows, elapsed, baseline):
+    total = sum(row['requests'] for row in rows.values())
+    print(f"\n{name}: {total} requests in {elapsed:.1f}s, {total / elapsed:.0f} req/s")
+    headings = ''.join(f" {heading:>6}" for _, _, heading in CALL_COLUMNS)
+    compare = f" {'p95 vs base':>12}" if baseline else ''
+    print(f"{'endpoint':<22} {'reqs':>5} {'req/s':>7} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'failed':>6}"
+          f"{headings}{compare}")
+    for route, row in rows.items():
+        calls = ''.join(
+            f" {row['calls_per_request'][f'{service} {operation}']:>6.1f}" for service, operation, _ in CALL_COLUMNS
+        )
+        line = (f"{route:<22} {row['requests']:>5} {row['requests_per_second']:>7.0f} {row['p50_ms']:>7.1f} "
+                f"{row['p95_ms']:>7.1f} {row['p99_ms']:>7.1f} {row['failed']:>6}{calls}")
+        previous = (baseline or {}).get(name, {}).get(route)
+        if previous:
+            change = (row['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] * 100
+            more_calls = any(
+                row['calls_per_request'][key] > previous['calls_per_request'].get(key, 0) + 0.05
+                for key in row['calls_per_request']
+            )
+            line += f" {change:>+11.0f}%" + (' more calls' if more_calls else '')
+        elif baseline:
+            line += f" {'new':>12}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--workloads', default=','.join(WORKLOADS))
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients, one user each')
+    parser.add_argument('--iterations', type=int, default=20, help='workload iterations per client')
+    parser.add_argument('--directories', type=int, default=4, help='folders per user')
+    parser.add_argument('--files', type=int, default=25, help='files per folder')
+    parser.add_argument('--file-kb', type=int, default=16)
+    parser.add_argument('--distinct', type=int, default=20, help='distinct file contents, so duplicates exist')
+    parser.add_argument('--rtt-ms', type=float, default=10.0, help='latency per Firestore round trip')
+    parser.add_argument('--storage-ms', type=float, default=30.0, help='latency per Storage request')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with results saved by --output')
+    args = parser.parse_args()
+
+    workloads = args.workloads.split(',')
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            parser.error(f"unknown workload {workload!r}; expected one of {', '.join(WORKLOADS)}")
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['workloads']
+
+    db = FakeFirestore()
+    bucket = FakeBucket()
+    backends.BACKENDS['fake'] = lambda: (db, bucket)
+    metrics.TRACED_METHODS['fake'] = FAKE_METHODS
+    flask_app = app_module.create_app('fake')
+
+    rng = random.Random(args.seed)
+    contents = [rng.randbytes(args.file_kb * 1024) for _ in range(args.distinct)]
+    started = time.perf_counter()
+    users = seed(flask_app, args.clients, args.directories, args.files, contents)
+    print(f"Seeded {args.clients} users with {args.directories} folders of {args.files} files "
+          f"in {time.perf_counter() - started:.1f}s")
+    print(f"Firestore round trip {args.rtt_ms:.0f} ms, Storage request {args.storage_ms:.0f} ms, "
+          f"{args.clients} clients x {args.iterations} iterations; calls are per request")
+
+    db.latency = args.rtt_ms / 1000
+    bucket.latency = args.storage_ms / 1000
+    report = {}
+    for workload in workloads:
+        results, elapsed, calls = run(flask_app, workload, users, contents, args.iterations, args.seed)
+        report[workload] = summarize(results, elapsed, calls)
+        print_report(workload, report[workload], elapsed, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'settings': vars(args), 'workloads': report}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+ZIP streaming benchmark: time to first byte, throughput and peak RSS
+
+Streams a synthetic folder through the ZIP builder and discards the output,
+as a client download would consume it. Blob reads are simulated with a fixed
+latency before each file's first chunk and per chunk after that. Each run
+happens in a fresh process so that its peak RSS is its own. Read-ahead is
+compared with reading one file at a time.
+
+Usage: python benchmarks/bench_zip_stream.py [--size-gb 10] [--files 1000] [--first-byte-ms 50]
+"""
+import argparse
+import datetime
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zip_stream import ZipEntry, iter_zip
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(args, read_ahead, results):
+    file_size = args.size_gb * 2**30 // args.files
+    chunk = os.urandom(CHUNK_SIZE)
+    entries = (
+        ZipEntry(f'folder/file{index:05d}.bin', file_size, datetime.datetime(2024, 1, 1), index)
+        for index in range(args.files)
+    )
+
+    def read_chunks(entry):
+        time.sleep(args.first_byte_ms / 1000)
+        for offset in range(0, entry.size, CHUNK_SIZE):
+            time.sleep(args.chunk_ms / 1000)
+            yield chunk[:min(CHUNK_SIZE, entry.size - offset)]
+
+    baseline = peak_rss_mb()
+    started = time.perf_counter()
+    first_byte = None
+    sent = 0
+    for data in iter_zip(entries, read_chunks, read_ahead=read_ahead, queue_depth=args.queue_depth):
+        if first_byte is None and data:
+            first_byte = time.perf_counter() - started
+        sent += len(data)
+    elapsed = time.perf_counter() - started
+    results.put((first_byte, elapsed, sent, baseline, peak_rss_mb()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size-gb', type=int, default=10)
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--first-byte-ms', type=float, default=50.0)
+    parser.add_argument('--chunk-ms', type=float, default=2.0, help='read latency per 1 MiB chunk')
+    parser.add_argument('--read-ahead', type=int, default=2)
+    parser.add_argument('--queue-depth', type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"{args.size_gb} GiB in {args.files} files, {args.first_byte_ms:.0f} ms to first byte, "
+          f"{args.chunk_ms:.1f} ms per MiB\n")
+    print(f"{'read-ahead':>10} {'ttfb ms':>9} {'total s':>8} {'MiB/s':>7} {'base RSS MB':>12} {'peak RSS MB':>12}")
+    context = multiprocessing.get_context('fork')
+    for read_ahead in (0, args.read_ahead):
+        results = context.Queue()
+        process = context.Process(target=run, args=(args, read_ahead, results))
+        process.start()
+        first_byte, elapsed, sent, baseline, peak = results.get()
+        process.join()
+        print(f"{read_ahead:>10} {first_byte * 1000:>9.1f} {elapsed:>8.1f} {sent / 2**20 / elapsed:>7.0f} "
+              f"{baseline:>12.1f} {peak:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,406 @@
+"""
+In-memory Firestore for benchmarks
+
+Implements the part of the Firestore client API the app uses: documents,
+equality/'in'/range filters, ordering, cursors, projections, batched writes,
+get_all() and transactions. Equality filters are answered from hash indexes
+built on first use, so queries stay fast with millions of documents.
+
+Every call that would be a network round trip to Firestore is counted, and
+can be slowed down by a fixed latency to mimic one. Reads and writes are
+safe to make from several threads; the round trip latency is spent outside
+the lock, so concurrent calls overlap as they would against Firestore.
+"""
+import copy
+import datetime
+import itertools
+import threading
+import time
+from collections import Counter, defaultdict
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud.firestore_v1 import transforms
+
+_ids = itertools.count()
+
+RANGE_OPERATORS = {
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '!=': lambda a, b: a != b,
+}
+
+
+def _hashable(value):
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def get(self, field):
+        if self._data is None or field not in self._data:
+            raise KeyError(field)
+        return self._data[field]
+
+    def to_dict(self):
+        return None if self._data is None else dict(self._data)
+
+
+class FakeDocument:
+    def __init__(self, db, collection, doc_id):
+        self._db = db
+        self._collection = collection
+        self.id = doc_id
+
+    @property
+    def path(self):
+        return f"{self._collection}/{self.id}"
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocument) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def collection(self, name):
+        return FakeCollection(self._db, f"{self.path}/{name}")
+
+    def get(self, transaction=None):
+        self._db._round_trip('get')
+        return self._db._snapshot(self)
+
+    def set(self, data, merge=False):
+        self._db._round_trip('write')
+        self._db._write(self, 'set', data, merge=merge)
+
+    def create(self, data):
+        self._db._round_trip('write')
+        self._db._write(self, 'create', data)
+
+    def update(self, data):
+        self._db._round_trip('write')
+        self._db._write(self, 'update', data)
+
+    def delete(self):
+        self._db._round_trip('write')
+        self._db._write(self, 'delete')
+
+
+class FakeQuery:
+    def __init__(self, db, collection, filters=(), orders=(), limit=None, fields=None, after=None):
+        self._db = db
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._fields = fields
+        self._after = after
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, orders=self._orders, limit=self._limit,
+                     fields=self._fields, after=self._after)
+        state.update(changes)
+        return FakeQuery(self._db, self._collection, **state)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def start_after(self, values):
+        return self._copy(after=values)
+
+    def count(self):
+        return FakeAggregation(self)
+
+    def _run(self):
+        return self._db._query(self)
+
+    def get(self, transaction=None):
+        self._db._round_trip('query')
+        return self._run()
+
+    def stream(self, transaction=None):
+        self._db._round_trip('query')
+        return iter(self._run())
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, name):
+        super().__init__(db, name)
+        self.id = name.rsplit('/', 1)[-1]
+
+    def document(self, doc_id=None):
+        return FakeDocument(self._db, self._collection, doc_id or f"doc{next(_ids):012d}")
+
+
+class _AggregationResult:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeAggregation:
+    def __init__(self, query):
+        self._query = query
+
+    def get(self, transaction=None):
+        self._query._db._round_trip('query')
+        return [[_AggregationResult(len(self._query.limit(None)._run()))]]
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self._db = db
+        self._operations = []
+
+    def set(self, ref, data, merge=False):
+        self._operations.append((ref, 'set', data, merge))
+
+    def create(self, ref, data):
+        self._operations.append((ref, 'create', data, False))
+
+    def update(self, ref, data):
+        self._operations.append((ref, 'update', data, False))
+
+    def delete(self, ref):
+        self._operations.append((ref, 'delete', None, False))
+
+    def commit(self):
+        self._db._round_trip('commit')
+        with self._db._lock:
+            # Check everything first, so a failed batch writes nothing
+            for ref, method, _, _ in self._operations:
+                exists = self._db._data(ref) is not None
+                if method == 'update' and not exists:
+                    raise NotFound(f"No document to update: {ref.path}")
+                if method == 'create' and exists:
+                    raise AlreadyExists(f"Document already exists: {ref.path}")
+            for ref, method, data, merge in self._operations:
+                self._db._write(ref, method, data, merge=merge)
+        self._operations = []
+
+
+class FakeTransaction(FakeBatch):
+    """Runs the transactional function once, without isolation from other threads"""
+
+    _read_only = False
+    _max_attempts = 1
+    _id = b'fake'
+
+    def _clean_up(self):
+        self._operations = []
+
+    def _begin(self, retry_id=None):
+        pass
+
+    def _commit(self):
+        if self._operations:
+            self.commit()
+        return []
+
+    def _rollback(self):
+        self._operations = []
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, FakeDocument):
+            return ref_or_query.get()
+        return ref_or_query.stream()
+
+    def get_all(self, refs):
+        return self._db.get_all(refs)
+
+
+class FakeFirestore:
+    """A Firestore client holding every document in memory"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.round_trips = Counter()
+        self.documents_read = 0
+        self.documents_written = 0
+        self._collections = defaultdict(dict)
+        # (collection, field) -> value -> set of document IDs
+        self._indexes = {}
+        self._lock = threading.RLock()
+
+    def _round_trip(self, kind):
+        self.round_trips[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset_counters(self):
+        self.round_trips.clear()
+        self.documents_read = 0
+        self.documents_written = 0
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def transaction(self, **kwargs):
+        return FakeTransaction(self)
+
+    def get_all(self, refs):
+        self._round_trip('get_all')
+        with self._lock:
+            return [self._snapshot(ref) for ref in refs]
+
+    def _data(self, ref):
+        return self._collections[ref._collection].get(ref.id)
+
+    def _snapshot(self, ref, fields=None):
+        with self._lock:
+            data = self._data(ref)
+            self.documents_read += 1
+            if data is not None and fields is not None:
+                data = {field: data[field] for field in fields if field in data}
+            return FakeSnapshot(ref, copy.copy(data))
+
+    def build_indexes(self, collection, *fields):
+        """Build equality indexes up front, so the first query that uses them isn't slower"""
+        with self._lock:
+            for field in fields:
+                self._index(collection, field)
+
+    def _index(self, collection, field):
+        key = (collection, field)
+        if key not in self._indexes:
+            index = defaultdict(set)
+            for doc_id, data in self._collections[collection].items():
+                value = data.get(field)
+                if _hashable(value):
+                    index[value].add(doc_id)
+            self._indexes[key] = index
+        return self._indexes[key]
+
+    def _reindex(self, collection, doc_id, old, new):
+        for (indexed, field), index in self._indexes.items():
+            if indexed != collection:
+                continue
+            old_value = old.get(field) if old else None
+            new_value = new.get(field) if new else None
+            if old is not None and _hashable(old_value):
+                index[old_value].discard(doc_id)
+            if new is not None and _hashable(new_value):
+                index[new_value].add(doc_id)
+
+    def _resolve(self, value, old):
+        if value is transforms.SERVER_TIMESTAMP:
+            return datetime.datetime.now(datetime.timezone.utc)
+        if isinstance(value, transforms.Increment):
+            return (old or 0) + value.value
+        if isinstance(value, datetime.datetime) and value.tzinfo is None:
+            # Firestore stores naive datetimes as UTC and reads them back timezone-aware
+            return value.replace(tzinfo=datetime.timezone.utc)
+        return value
+
+    def _write(self, ref, method, data=None, merge=False):
+        with self._lock:
+            documents = self._collections[ref._collection]
+            old = documents.get(ref.id)
+            if method == 'delete':
+                if old is not None:
+                    del documents[ref.id]
+                    self._reindex(ref._collection, ref.id, old, None)
+                self.documents_written += 1
+                return
+            if method == 'update' and old is None:
+                raise NotFound(f"No document to update: {ref.path}")
+            if method == 'create' and old is not None:
+                raise AlreadyExists(f"Document already exists: {ref.path}")
+            new = dict(old) if old is not None and (merge or method == 'update') else {}
+            for field, value in data.items():
+                if value is transforms.DELETE_FIELD:
+                    new.pop(field, None)
+                else:
+                    new[field] = self._resolve(value, new.get(field))
+            documents[ref.id] = new
+            self._reindex(ref._collection, ref.id, old, new)
+            self.documents_written += 1
+
+    def _query(self, query):
+        with self._lock:
+            documents = self._collections[query._collection]
+            candidates = None
+            rest = []
+            for field, op, value in query._filters:
+                if op == '==' and _hashable(value):
+                    matches = self._index(query._collection, field).get(value, set())
+                elif op == 'in':
+                    index = self._index(query._collection, field)
+                    matches = set().union(*(index.get(item, set()) for item in value))
+                else:
+                    rest.append((field, op, value))
+                    continue
+                candidates = matches if candidates is None else candidates & matches
+            ids = documents.keys() if candidates is None else candidates
+
+            results = []
+            for doc_id in ids:
+                data = documents.get(doc_id)
+                if data is None:
+                    continue
+                if all(self._matches(data, field, op, value) for field, op, value in rest):
+                    results.append((doc_id, data))
+
+            orders = list(query._orders)
+            if query._after is not None or not orders:
+                orders.append(('__name__', orders[-1][1] if orders else 'ASCENDING'))
+            for field, direction in reversed(orders):
+                results.sort(key=lambda item: self._sort_key(item, field), reverse=direction == 'DESCENDING')
+            if query._after is not None:
+                results = self._after(results, orders, query._after)
+            if query._limit is not None:
+                results = results[:query._limit]
+
+            collection = FakeCollection(self, query._collection)
+            return [self._snapshot(collection.document(doc_id), query._fields) for doc_id, _ in results]
+
+    def _matches(self, data, field, op, value):
+        if op == 'array_contains':
+            return value in data.get(field, [])
+        if field not in data or data[field] is None:
+            return False
+        return RANGE_OPERATORS[op](data[field], value)
+
+    def _sort_key(self, item, field):
+        doc_id, data = item
+        value = doc_id if field == '__name__' else data.get(field)
+        # Missing values sort first, as Firestore puts nulls first
+        return (value is not None, value)
+
+    def _after(self, results, orders, values):
+        def position(item):
+            return tuple(self._sort_key(item, field) for field, _ in orders)
+
+        cursor = tuple(
+            (True, values[field] if field != '__name__' or isinstance(values[field], str) else values[field].id)
+            for field, _ in orders
+        )
+        descending = orders[0][1] == 'DESCENDING'
+        return [
+            item for item in results
+            if (position(item) < cursor if descending else position(item) > cursor)
+        ]
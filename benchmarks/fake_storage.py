@@ -0,0 +1,226 @@
+"""
+In-memory Cloud Storage for benchmarks
+
+Implements the part of the Storage client API the app uses: blobs with
+generations, uploads from strings, files and streamed writers, chunked
+reads, deletes with generation preconditions, compose, server-side copies
+and signed URLs. Signing is an HMAC rather than an RSA signature, so it is
+cheaper than the real thing.
+
+Every call that would be an HTTP request to Storage is counted, and can be
+slowed down by a fixed latency to mimic one. Streamed reads and writes make
+one request per chunk, as the real client's resumable uploads and ranged
+downloads do.
+"""
+import contextlib
+import hashlib
+import hmac
+import io
+import itertools
+import threading
+import time
+from collections import Counter
+from urllib.parse import quote
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+_generations = itertools.count(1)
+
+
+class _Reader(io.RawIOBase):
+    """A blob opened for reading; fetches chunk_size bytes per request"""
+
+    def __init__(self, blob, chunk_size):
+        self._blob = blob
+        self._chunk_size = chunk_size
+        self._buffer = b''
+        self._position = 0
+        self._size = None
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if self._size is None:
+            self._blob.reload()
+            self._size = self._blob.size
+        while (size < 0 or len(self._buffer) < size) and self._position < self._size:
+            end = self._position + max(self._chunk_size, size) - 1
+            self._buffer += self._blob.download_as_bytes(start=self._position, end=end)
+            self._position = min(end + 1, self._size)
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class _Writer(io.RawIOBase):
+    """A blob opened for writing; uploads every full chunk, and the rest on close"""
+
+    def __init__(self, blob, chunk_size, content_type):
+        self._blob = blob
+        self._chunk_size = chunk_size
+        self._content_type = content_type
+        self._buffer = io.BytesIO()
+        self._uploaded = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer.write(data)
+        pending = self._buffer.tell() - self._uploaded
+        if pending >= self._chunk_size:
+            self._upload_chunks_from_buffer(pending // self._chunk_size)
+        return len(data)
+
+    def _upload_chunks_from_buffer(self, chunks):
+        self._blob.bucket._round_trip('write')
+        self._uploaded += chunks * self._chunk_size
+
+    def _finish_upload(self):
+        self._blob.bucket._round_trip('write')
+        self._blob.bucket._store(self._blob.name, self._buffer.getvalue(), self._content_type)
+
+    def close(self):
+        if not self.closed:
+            self._finish_upload()
+        super().close()
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            # An abandoned upload leaves nothing behind
+            super().close()
+            return False
+        return super().__exit__(exc_type, exc, traceback)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+        self.size = None
+        self.content_type = None
+
+    def _load(self):
+        stored = self.bucket._objects.get(self.name)
+        if stored is None:
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        data, self.generation, self.content_type = stored
+        self.size = len(data)
+        return data
+
+    def exists(self):
+        self.bucket._round_trip('head')
+        return self.name in self.bucket._objects
+
+    def reload(self):
+        self.bucket._round_trip('head')
+        self._load()
+
+    def download_as_bytes(self, start=None, end=None):
+        self.bucket._round_trip('read')
+        data = self._load()
+        start = start or 0
+        return data[start:] if end is None else data[start:end + 1]
+
+    def upload_from_string(self, data, content_type=None):
+        self.bucket._round_trip('write')
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.bucket._store(self.name, data, content_type)
+        self._load()
+
+    def upload_from_file(self, file_obj, content_type=None, **kwargs):
+        self.bucket._round_trip('write')
+        self.bucket._store(self.name, file_obj.read(), content_type)
+        self._load()
+
+    def open(self, mode='rb', chunk_size=None, content_type=None, **kwargs):
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        if 'w' in mode:
+            return _Writer(self, chunk_size, content_type)
+        return _Reader(self, chunk_size)
+
+    def delete(self, if_generation_match=None):
+        self.bucket._round_trip('write')
+        with self.bucket._lock:
+            stored = self.bucket._objects.get(self.name)
+            if stored is None:
+                raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+            if if_generation_match is not None and stored[1] != if_generation_match:
+                raise PreconditionFailed(f"Generation mismatch: {self.bucket.name}/{self.name}")
+            del self.bucket._objects[self.name]
+
+    def compose(self, sources):
+        self.bucket._round_trip('write')
+        self.bucket._store(self.name, b''.join(source._load() for source in sources), self.content_type)
+        self._load()
+
+    def generate_signed_url(self, version='v4', expiration=None, method='GET', response_disposition=None, **kwargs):
+        self.bucket.round_trips['sign'] += 1
+        expires = int(time.time()) + int(expiration or 3600)
+        message = f"{method}\n{self.bucket.name}/{self.name}\n{expires}\n{response_disposition or ''}"
+        signature = hmac.new(self.bucket.secret, message.encode('utf-8'), hashlib.sha256).hexdigest()
+        return (f"https://storage.example/{self.bucket.name}/{quote(self.name)}"
+                f"?expires={expires}&signature={signature}")
+
+
+class FakeBucket:
+    """A Storage bucket holding every object in memory"""
+
+    def __init__(self, latency=0.0, name='bench-bucket'):
+        self.latency = latency
+        self.name = name
+        self.secret = b'bench'
+        self.round_trips = Counter()
+        self.bytes_written = 0
+        # name -> (bytes, generation, content type)
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        return self
+
+    def batch(self):
+        return contextlib.nullcontext()
+
+    def _round_trip(self, kind):
+        self.round_trips[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset_counters(self):
+        self.round_trips.clear()
+        self.bytes_written = 0
+
+    def _store(self, name, data, content_type):
+        with self._lock:
+            self._objects[name] = (bytes(data), next(_generations), content_type)
+            self.bytes_written += len(data)
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        blob = self.blob(name)
+        try:
+            blob.reload()
+        except NotFound:
+            return None
+        return blob
+
+    def copy_blob(self, blob, destination_bucket, new_name):
+        self._round_trip('write')
+        copy = destination_bucket.blob(new_name)
+        destination_bucket._store(new_name, blob._load(), blob.content_type)
+        copy._load()
+        return copy
+
+    def list_blobs(self, prefix=''):
+        self._round_trip('read')
+        return [self.blob(name) for name in sorted(self._objects) if name.startswith(prefix)]
@@ -0,0 +1,302 @@
+"""
+Content-addressed blob store for Dropbox Clone
+
+When content-addressed storage is enabled, file bytes are stored once per
+distinct content hash under content/ and every `files` document that points
+at them holds a reference. The `blobs` collection keeps the reference count
+for each hash; the blob is only deleted when the last reference goes away.
+
+Content is keyed by its SHA-256 (the file's `content_hash`), which unlike
+MD5 can't be forged to collide with someone else's file. Content stored
+before that is keyed by the file's MD5 `hash`.
+
+Previews of a file (see previews.py) are blobs of their own. Previews of
+shared content sit next to its blob and go with it; other files' previews
+are named by file ID, since path-named blobs share their prefix with the
+user's own file names, and are deleted with the file.
+"""
+import unicodedata
+import uuid
+from collections import Counter
+from urllib.parse import quote
+
+from firebase_admin import firestore
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+CONTENT_PREFIX = 'content/'
+
+# Cloud Storage batch requests take at most 100 calls
+STORAGE_BATCH_LIMIT = 100
+
+# Preview images generated for a file, smallest first
+PREVIEW_VARIANTS = ('thumbnail', 'preview')
+
+
+def content_blob_name(file_hash):
+    """Storage name of the shared blob for a content hash"""
+    return f"{CONTENT_PREFIX}{file_hash[:2]}/{file_hash}"
+
+
+def content_key(file_data):
+    """The `blobs` document ID of a content-addressed file's content"""
+    return file_data.get('content_hash') or file_data['hash']
+
+
+def staging_blob_name(uid):
+    """Temporary name for an upload whose hash isn't known yet"""
+    return f"{uid}/.staging/{uuid.uuid4().hex}"
+
+
+def unique_blob_name(uid):
+    """Per-user name for a file's bytes that doesn't depend on where the file is"""
+    return f"{uid}/.files/{uuid.uuid4().hex}"
+
+
+def file_blob_name(uid, file_data):
+    """Storage name of a file's bytes, for both per-user and content-addressed files"""
+    return file_data.get('blob_name') or f"{uid}/{file_data['storage_path']}"
+
+
+def preview_blob_name(uid, file_id, blob_name, variant):
+    """Storage name of one preview image of a file"""
+    if blob_name.startswith(CONTENT_PREFIX):
+        return f"{blob_name}.{variant}.jpg"
+    return f"{uid}/.previews/{file_id}/{variant}.jpg"
+
+
+def share_blob_name(share_data):
+    """Storage name of a shared file's bytes"""
+    return share_data.get('blob_name') or f"{share_data['owner_id']}/{share_data['file_path']}"
+
+
+def download_disposition(name, filename):
+    """
+    Content-Disposition for a signed download URL. Content blobs and uniquely
+    named blobs need the file name spelled out; path-named blobs already end in it.
+    """
+    if name.endswith('/' + filename):
+        return None
+    return attachment_disposition(filename)
+
+
+def attachment_disposition(filename):
+    """
+    Content-Disposition to download a file as `filename`. Names that aren't
+    plain ASCII are sent as RFC 5987 `filename*`, with an ASCII `filename`
+    for clients that don't read it.
+    """
+    fallback = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+    fallback = ''.join(char for char in fallback if char.isprintable() and char not in '"\\')
+    if not fallback or fallback.startswith('.'):
+        fallback = 'download' + fallback
+    if fallback == filename:
+        return f'attachment; filename="{filename}"'
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+
+def delete_blobs(bucket, blobs):
+    """Delete many blobs, 100 per batched HTTP request"""
+    blobs = list(blobs)
+    for start in range(0, len(blobs), STORAGE_BATCH_LIMIT):
+        with bucket.client.batch():
+            for blob in blobs[start:start + STORAGE_BATCH_LIMIT]:
+                blob.delete()
+
+
+def find_reference(db, content_hash, size):
+    """
+    Add a reference to an existing blob with this hash and size, if there is one.
+
+    Returns the blob's `blobs` document, whose 'encoding' and 'stored_size'
+    say how its bytes are stored, or None if there is no such blob.
+    """
+    blob_ref = db.collection('blobs').document(content_hash)
+
+    @firestore.transactional
+    def add_if_present(transaction):
+        snapshot = blob_ref.get(transaction=transaction)
+        if not snapshot.exists or snapshot.to_dict().get('pending') or snapshot.to_dict().get('size') != size:
+            return None
+        transaction.update(blob_ref, {'refcount': firestore.Increment(1)})
+        return snapshot.to_dict()
+
+    return add_if_present(db.transaction())
+
+
+def add_reference(db, bucket, content_hash, size, staging_blob, encoding=None, stored_size=None):
+    """
+    Reference the content blob for `content_hash`, promoting `staging_blob` to it
+    if this is the first copy. The staging blob is removed, unless another
+    upload is still promoting the same content: then nothing is referenced
+    and the staging blob stays as the file's own copy.
+
+    `encoding` and `stored_size` describe the staging blob's bytes (see
+    compression.py). Returns (blob name, encoding, stored size) as the
+    file's blob holds them, which for an existing content blob may differ.
+    """
+    blob_ref = db.collection('blobs').document(content_hash)
+    name = content_blob_name(content_hash)
+
+    @firestore.transactional
+    def reference(transaction):
+        snapshot = blob_ref.get(transaction=transaction)
+        if snapshot.exists:
+            if snapshot.to_dict().get('pending'):
+                return False
+            transaction.update(blob_ref, {'refcount': firestore.Increment(1)})
+            return snapshot.to_dict()
+        # Pending until the bytes are copied, so no one references it before then
+        transaction.set(blob_ref, {
+            'refcount': 1,
+            'size': size,
+            'blob_name': name,
+            'encoding': encoding,
+            'stored_size': stored_size if stored_size is not None else size,
+            'pending': True,
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+        return None
+
+    existing = reference(db.transaction())
+    if existing is False:
+        return staging_blob.name, encoding, stored_size
+
+    if existing is None:
+        try:
+            content_blob = bucket.copy_blob(staging_blob, bucket, name)
+        except Exception:
+            # Don't leave a reference count pointing at bytes that never landed
+            _drop_pending_reference(db, blob_ref)
+            raise
+        # Remember the generation so a later release only deletes this copy
+        blob_ref.update({'pending': False, 'generation': content_blob.generation})
+
+    staging_blob.delete()
+    if existing is not None:
+        return name, existing.get('encoding'), existing.get('stored_size', existing.get('size'))
+    return name, encoding, stored_size
+
+
+def _drop_pending_reference(db, blob_ref):
+    """Undo the reference add_reference() took on content it failed to copy"""
+
+    @firestore.transactional
+    def drop(transaction):
+        snapshot = blob_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return
+        if snapshot.get('refcount') <= 1:
+            transaction.delete(blob_ref)
+        else:
+            transaction.update(blob_ref, {'refcount': firestore.Increment(-1)})
+
+    drop(db.transaction())
+
+
+def release_reference(db, bucket, file_hash, once_ref=None):
+    """
+    Drop one reference to a content blob, deleting it when none are left.
+
+    If `once_ref` is given, the release happens only if that document doesn't
+    exist yet, and creates it; a retried release is then a no-op.
+    """
+    blob_ref = db.collection('blobs').document(file_hash)
+
+    @firestore.transactional
+    def release(transaction):
+        if once_ref is not None:
+            if once_ref.get(transaction=transaction).exists:
+                return None
+            transaction.create(once_ref, {'hash': file_hash, 'released_at': firestore.SERVER_TIMESTAMP})
+        snapshot = blob_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return None
+        blob_data = snapshot.to_dict()
+        if blob_data.get('refcount', 0) > 1:
+            transaction.update(blob_ref, {'refcount': firestore.Increment(-1)})
+            return None
+        transaction.delete(blob_ref)
+        return blob_data
+
+    orphan = release(db.transaction())
+    if orphan is not None:
+        delete_orphan(bucket, orphan)
+
+
+def release_references(transaction, db, files):
+    """
+    Drop the references of the content-addressed files among `files` (file
+    data) to their content, as part of `transaction`.
+
+    Reads the `blobs` documents, so call it before the transaction writes.
+    Returns (writes to commit with the transaction, orphans); orphans are
+    the content left without references, to delete with delete_orphan()
+    once the transaction has committed.
+    """
+    # Only content-addressed files have a blob name under content/
+    counts = Counter(
+        content_key(file_data) for file_data in files
+        if (file_data.get('blob_name') or '').startswith(CONTENT_PREFIX)
+    )
+    if not counts:
+        return [], []
+    writes = []
+    orphans = []
+    refs = [db.collection('blobs').document(file_hash) for file_hash in counts]
+    for snapshot in transaction.get_all(refs):
+        if not snapshot.exists:
+            continue
+        blob_data = snapshot.to_dict()
+        count = counts[snapshot.id]
+        if blob_data.get('refcount', 0) > count:
+            writes.append(('update', snapshot.reference, {'refcount': firestore.Increment(-count)}))
+        else:
+            writes.append(('delete', snapshot.reference))
+            orphans.append({'blob_name': blob_data['blob_name'], 'generation': blob_data.get('generation')})
+    return writes, orphans
+
+
+def delete_orphan(bucket, orphan):
+    """Delete content whose last reference was dropped, with its previews"""
+    # If the same content was uploaded again meanwhile it has a new
+    # generation, and the precondition keeps the fresh copy alive
+    try:
+        bucket.blob(orphan['blob_name']).delete(if_generation_match=orphan.get('generation'))
+    except NotFound:
+        pass
+    except PreconditionFailed:
+        # The fresh copy has the same content, so it keeps the previews too
+        return
+    for variant in PREVIEW_VARIANTS:
+        try:
+            bucket.blob(preview_blob_name(None, None, orphan['blob_name'], variant)).delete()
+        except NotFound:
+            pass
+
+
+def delete_file_bytes(bucket, uid, file_data):
+    """
+    Delete a file's own blob and previews. Content-addressed files have
+    none; their content goes with its last reference (see release_references()).
+    """
+    name = file_blob_name(uid, file_data)
+    if name.startswith(CONTENT_PREFIX):
+        return
+    try:
+        bucket.blob(name).delete()
+    except NotFound:
+        pass
+    for preview in (file_data.get('previews') or {}).values():
+        try:
+            bucket.blob(preview['blob_name']).delete()
+        except NotFound:
+            pass
+
+
+def release_file_blob(db, bucket, uid, file_data, once_ref=None):
+    """Free a file's bytes: drop its reference if shared, otherwise delete the blob and its previews"""
+    name = file_blob_name(uid, file_data)
+    if name.startswith(CONTENT_PREFIX):
+        release_reference(db, bucket, content_key(file_data), once_ref)
+        return
+    delete_file_bytes(bucket, uid, file_data)
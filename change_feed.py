@@ -0,0 +1,327 @@
+"""
+Change feed for Dropbox Clone
+
+Each user has a journal of the changes made to their files, directories
+and shares. A client lists a directory once, remembers the journal's
+cursor, and from then on asks only for the changes after it, instead of
+listing every directory again.
+
+The journal is split into CHANGE_FEED_SHARDS shards so that one user's
+writes don't all contend for one document. A change goes to the shard its
+item ID hashes to, so the changes to any one item stay in order. Each shard
+numbers its changes 1, 2, 3, ... from a head document
+(`change_heads/{uid}_{shard}`), which is read and advanced in the same
+transaction that writes the changes, so two workers recording at once never
+hand out the same number. A cursor holds the last number seen in each shard,
+written as e.g. `12.0.7.3`; clients treat it as opaque. Changes from
+different shards are merged by the time they were recorded, so changes to
+different items made at nearly the same time may arrive out of order.
+
+Changes are recorded once the write they describe has committed; a worker
+that dies in between loses that change, which the client sees as a stale
+listing until its next full listing, as it would without the feed.
+
+Only the newest CHANGE_FEED_LENGTH changes per user are kept, split evenly
+between the shards. A client whose cursor is older than that, or isn't one
+this journal handed out, is told to `reset`: list again and carry on from
+the current cursor.
+
+Long polls and change streams wait for a worker's own writes through a
+condition variable, and for other workers' by reading the user's head
+documents every CHANGE_FEED_POLL_INTERVAL seconds. Each one holds a worker
+thread while it waits, so at most CHANGE_FEED_MAX_WAITERS wait at once per
+worker; the rest are turned away with ChangeFeedBusy.
+"""
+import json
+import threading
+import time
+import zlib
+
+from firebase_admin import firestore
+
+import config
+from datastore import delete_all, get_all
+
+HEADS = 'change_heads'
+CHANGES = 'changes'
+
+# Changes returned per /list-changes request
+MAX_PAGE_SIZE = 1000
+
+# Old changes are trimmed once every this many changes to a shard
+TRIM_EVERY = 100
+
+# Latest change number per user and shard recorded by this worker, and a
+# condition notified whenever one moves
+_latest = {}
+_recorded = threading.Condition()
+
+# Requests of this worker allowed to wait for changes at once
+_waiters = threading.BoundedSemaphore(config.CHANGE_FEED_MAX_WAITERS)
+
+
+class ChangeFeedReset(Exception):
+    """A cursor the journal can't continue from; the client has to list again"""
+
+    def __init__(self, cursor):
+        super().__init__('Cursor is too old or unknown, list again')
+        self.cursor = cursor
+
+
+class ChangeFeedBusy(Exception):
+    """Too many requests of this worker are already waiting for changes"""
+
+
+def journal_id(uid, shard):
+    return f"{uid}_{shard}"
+
+
+def head_ref(db, uid, shard):
+    return db.collection(HEADS).document(journal_id(uid, shard))
+
+
+def change_ref(db, uid, shard, seq):
+    # Zero-padded so document IDs sort in journal order
+    return db.collection(CHANGES).document(f"{journal_id(uid, shard)}_{seq:012d}")
+
+
+def shard_of(entry):
+    return zlib.crc32(str(entry['id']).encode()) % config.CHANGE_FEED_SHARDS
+
+
+def format_cursor(seqs):
+    return '.'.join(str(seq) for seq in seqs)
+
+
+def change(change_type, kind, item_id, name=None, path=None, **extra):
+    """
+    A change to record: `change_type` is 'create', 'delete', 'overwrite',
+    'move', 'share' or 'unshare', `kind` is 'file', 'directory' or 'share',
+    and `path` is the directory the item is (or was) in.
+    """
+    return dict(extra, type=change_type, kind=kind, id=item_id, name=name, path=path)
+
+
+def record_changes(db, uid, changes):
+    """Append changes to a user's journal"""
+    by_shard = {}
+    for entry in changes:
+        if entry is not None:
+            by_shard.setdefault(shard_of(entry), []).append(entry)
+    if not uid or not by_shard:
+        return
+    refs = {shard: head_ref(db, uid, shard) for shard in by_shard}
+
+    @firestore.transactional
+    def append(transaction):
+        heads = {snapshot.id: snapshot for snapshot in transaction.get_all(list(refs.values()))}
+        advanced = {}
+        for shard, entries in by_shard.items():
+            head = heads.get(refs[shard].id)
+            seq = head.get('seq') if head is not None and head.exists else 0
+            first = seq + 1
+            for entry in entries:
+                seq += 1
+                transaction.set(change_ref(db, uid, shard, seq), dict(
+                    entry, journal=journal_id(uid, shard), seq=seq, changed_at=firestore.SERVER_TIMESTAMP
+                ))
+            transaction.set(refs[shard], {'user_id': uid, 'shard': shard, 'seq': seq}, merge=True)
+            advanced[shard] = (first, seq)
+        return advanced
+
+    advanced = append(db.transaction())
+    _notify(uid, {shard: seq for shard, (first, seq) in advanced.items()})
+    keep = config.CHANGE_FEED_LENGTH // config.CHANGE_FEED_SHARDS
+    for shard, (first, seq) in advanced.items():
+        if (first - 1) // TRIM_EVERY != seq // TRIM_EVERY:
+            _trim(db, uid, shard, seq - keep)
+
+
+def _notify(uid, seqs):
+    with _recorded:
+        latest = _latest.setdefault(uid, {})
+        for shard, seq in seqs.items():
+            if seq > latest.get(shard, 0):
+                latest[shard] = seq
+        _recorded.notify_all()
+
+
+def _trim(db, uid, shard, through):
+    """Delete a shard's changes up to `through`, marking its head first so readers reset"""
+    if through <= 0:
+        return
+    head_ref(db, uid, shard).set({'trimmed_through': through}, merge=True)
+    old = (db.collection(CHANGES).where('journal', '==', journal_id(uid, shard))
+           .where('seq', '<=', through).select(['seq']).stream())
+    delete_all(db, (snapshot.reference for snapshot in old))
+    # Changes from before the journal was sharded have a user_id and no journal
+    legacy = db.collection(CHANGES).where('user_id', '==', uid).select(['seq']).stream()
+    delete_all(db, (snapshot.reference for snapshot in legacy))
+    db.collection(HEADS).document(uid).delete()
+
+
+def head(db, uid):
+    """(latest change number, number trimmed through) of each shard of a user's journal"""
+    refs = [head_ref(db, uid, shard) for shard in range(config.CHANGE_FEED_SHARDS)]
+    snapshots = get_all(db, refs)
+    seqs = []
+    trimmed = []
+    for ref in refs:
+        snapshot = snapshots[ref.id]
+        head_data = snapshot.to_dict() if snapshot.exists else {}
+        seqs.append(head_data.get('seq', 0))
+        trimmed.append(head_data.get('trimmed_through', 0))
+    _notify(uid, dict(enumerate(seqs)))
+    return seqs, trimmed
+
+
+def parse_cursor(value):
+    """A cursor from a request, or None if there is none; raises ValueError if it isn't one"""
+    if value in (None, ''):
+        return None
+    seqs = [int(part) for part in str(value).split('.')]
+    if any(seq < 0 for seq in seqs):
+        raise ValueError(value)
+    return seqs
+
+
+def _padded(cursor):
+    # Shards added since the cursor was handed out start from nothing
+    return list(cursor) + [0] * (config.CHANGE_FEED_SHARDS - len(cursor))
+
+
+def _ahead(uid, cursor):
+    latest = _latest.get(uid, {})
+    return any(latest.get(shard, 0) > seq for shard, seq in enumerate(cursor))
+
+
+def list_changes(db, uid, cursor, limit=MAX_PAGE_SIZE):
+    """
+    The changes after `cursor`, oldest first, at most `limit` of them.
+
+    Each change carries the cursor that follows it. Returns (changes, next
+    cursor, whether more are waiting). A cursor of None returns no changes
+    and the current cursor, to start following the journal from after a
+    full listing. Raises ChangeFeedReset if the journal can't continue from
+    `cursor`.
+    """
+    seqs, trimmed = head(db, uid)
+    if cursor is None:
+        return [], format_cursor(seqs), False
+    if len(cursor) > len(seqs):
+        raise ChangeFeedReset(format_cursor(seqs))
+    cursor = _padded(cursor)
+    if any(after > seq or after < through for after, seq, through in zip(cursor, seqs, trimmed)):
+        raise ChangeFeedReset(format_cursor(seqs))
+
+    pending = []
+    for shard, (after, seq) in enumerate(zip(cursor, seqs)):
+        if after == seq:
+            continue
+        query = (db.collection(CHANGES).where('journal', '==', journal_id(uid, shard))
+                 .where('seq', '>', after).order_by('seq').limit(limit))
+        for snapshot in query.stream():
+            change_data = snapshot.to_dict()
+            pending.append((change_data.get('changed_at'), shard, change_data['seq'], change_data))
+
+    # Each shard's changes are already in order, so this only interleaves them
+    pending.sort(key=lambda item: item[:3])
+    changes = []
+    for changed_at, shard, seq, change_data in pending[:limit]:
+        cursor[shard] = seq
+        change_data.pop('journal', None)
+        changes.append(dict(change_data, cursor=format_cursor(cursor)))
+    return changes, format_cursor(cursor), any(after < seq for after, seq in zip(cursor, seqs))
+
+
+def wait_for_changes(db, uid, cursor, timeout):
+    """
+    Block until the user's journal is past `cursor` or `timeout` seconds pass.
+
+    This worker's own writes wake it at once; other workers' are seen on the
+    next read of the head documents. Returns True if there are changes.
+    """
+    cursor = _padded(cursor)
+    deadline = time.monotonic() + timeout
+    next_poll = 0
+    while True:
+        now = time.monotonic()
+        if now >= next_poll:
+            head(db, uid)
+            next_poll = now + config.CHANGE_FEED_POLL_INTERVAL
+        with _recorded:
+            if _ahead(uid, cursor):
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            _recorded.wait(min(remaining, max(next_poll - time.monotonic(), 0)))
+
+
+def hold_waiter():
+    """
+    Take one of this worker's waiter slots, raising ChangeFeedBusy if none
+    is free. Give it back with release_waiter().
+    """
+    if not _waiters.acquire(blocking=False):
+        raise ChangeFeedBusy('Too many requests are waiting for changes, try again later')
+
+
+def release_waiter():
+    _waiters.release()
+
+
+def poll_changes(db, uid, cursor, wait=0):
+    """
+    list_changes(), first waiting up to `wait` seconds for a change if there
+    are none yet. Raises ChangeFeedBusy if it would wait and can't.
+    """
+    if cursor is not None and wait > 0 and _padded(cursor) == head(db, uid)[0]:
+        hold_waiter()
+        try:
+            wait_for_changes(db, uid, cursor, wait)
+        finally:
+            release_waiter()
+    return list_changes(db, uid, cursor)
+
+
+def _sse(event, data, event_id=None):
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, default=str, separators=(',', ':'))}")
+    return '\n'.join(lines) + '\n\n'
+
+
+def stream_changes(db, uid, cursor, duration):
+    """
+    Yield the journal as server-sent events for `duration` seconds.
+
+    Each change is a `change` event whose ID is the cursor after it, so a
+    browser reconnecting sends it back as Last-Event-ID and resumes after
+    it. A `reset` event carries the cursor to list again from, and comments
+    keep the connection open while nothing changes. The stream ends after
+    `duration` so it doesn't hold a worker thread indefinitely; EventSource
+    reconnects by itself. The caller holds a waiter slot for it.
+    """
+    deadline = time.monotonic() + duration
+    yield f"retry: {config.CHANGE_STREAM_RETRY_MS}\n\n"
+    if cursor is None:
+        cursor = head(db, uid)[0]
+        yield _sse('cursor', {'cursor': format_cursor(cursor)}, format_cursor(cursor))
+    while True:
+        try:
+            changes, next_cursor, more = list_changes(db, uid, cursor)
+        except ChangeFeedReset as e:
+            cursor = parse_cursor(e.cursor)
+            yield _sse('reset', {'cursor': e.cursor}, e.cursor)
+            continue
+        for change_data in changes:
+            yield _sse('change', change_data, change_data['cursor'])
+        cursor = parse_cursor(next_cursor)
+        if more:
+            continue
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if not wait_for_changes(db, uid, cursor, min(remaining, config.CHANGE_STREAM_HEARTBEAT)):
+            yield ': keep-alive\n\n'
@@ -0,0 +1,75 @@
+"""
+Content-defined chunking for Dropbox Clone delta sync
+
+Files are cut where a rolling gear hash of the preceding bytes matches a
+mask, so chunk boundaries move with the content rather than with byte
+offsets. An edit only changes the chunks it touches; every other chunk keeps
+its hash and never has to be uploaded again.
+
+public/js/app.js implements the same chunker; both generate the gear table
+from the same seed, so browsers and the server agree on every boundary.
+"""
+import hashlib
+
+MIN_CHUNK_SIZE = 64 * 1024
+AVG_CHUNK_BITS = 18  # 256 KiB average
+MAX_CHUNK_SIZE = 1024 * 1024
+
+GEAR_SEED = 0x9E3779B9
+_MASK32 = 0xFFFFFFFF
+
+# The gear hash shifts left once per byte, so its high bits depend on the
+# most recent 32 bytes; the boundary test looks at those bits
+BOUNDARY_MASK = ((1 << AVG_CHUNK_BITS) - 1) << (32 - AVG_CHUNK_BITS)
+
+
+def _mulberry32(seed):
+    """32-bit PRNG, bit-for-bit identical to the JavaScript version"""
+    state = seed
+    while True:
+        state = (state + 0x6D2B79F5) & _MASK32
+        t = ((state ^ (state >> 15)) * (state | 1)) & _MASK32
+        t = ((t + (((t ^ (t >> 7)) * (t | 61)) & _MASK32)) & _MASK32) ^ t
+        yield (t ^ (t >> 14)) & _MASK32
+
+
+def _gear_table():
+    numbers = _mulberry32(GEAR_SEED)
+    return [next(numbers) for _ in range(256)]
+
+
+GEAR = _gear_table()
+
+
+def find_boundary(data, start, end):
+    """Return the end offset of the chunk starting at `start` in data[:end]"""
+    if end - start <= MIN_CHUNK_SIZE:
+        return end
+
+    limit = min(end, start + MAX_CHUNK_SIZE)
+    gear = GEAR
+    h = 0
+    for offset in range(start + MIN_CHUNK_SIZE, limit):
+        h = ((h << 1) + gear[data[offset]]) & _MASK32
+        if not h & BOUNDARY_MASK:
+            return offset + 1
+    return limit
+
+
+def iter_chunks(data):
+    """Yield (offset, length) for each content-defined chunk of a bytes-like object"""
+    start = 0
+    end = len(data)
+    while start < end:
+        boundary = find_boundary(data, start, end)
+        yield start, boundary - start
+        start = boundary
+
+
+def chunk_hashes(data):
+    """Return the manifest of a bytes-like object: a list of (sha256 hex, size)"""
+    view = memoryview(data)
+    return [
+        (hashlib.sha256(view[offset:offset + length]).hexdigest(), length)
+        for offset, length in iter_chunks(data)
+    ]
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Delete delta sync blocks no file uses any more
+
+Deleting or overwriting a file synced block by block drops its references
+on its blocks (see delta_sync.py) but leaves the blocks. This deletes those
+no manifest references, for every user or the users given with --uid.
+Blocks uploaded in the last SYNC_BLOCK_GRACE_HOURS are kept, since a client
+may have uploaded them for a commit it is about to make. Run it from cron,
+e.g. daily.
+
+Usage: python collect_blocks.py [--uid UID ...] [--grace-hours HOURS]
+"""
+import argparse
+import datetime
+
+import config
+from app import bucket, db
+from delta_sync import collect_blocks
+from share_expiry import utc_now
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--uid', action='append', help='user to collect (repeatable; default: every user)')
+    parser.add_argument('--grace-hours', type=float, default=config.SYNC_BLOCK_GRACE_HOURS,
+                        help='keep unreferenced blocks younger than this')
+    args = parser.parse_args()
+
+    grace = datetime.timedelta(hours=args.grace_hours)
+    uids = args.uid or (user.id for user in db.collection('users').select(['email']).stream())
+    checked = removed = 0
+    for uid in uids:
+        checked += 1
+        removed += collect_blocks(db, bucket, uid, grace, utc_now())
+
+    print(f"Checked {checked} users, deleted {removed} unreferenced blocks")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+Transparent compression for Dropbox Clone
+
+With UPLOAD_COMPRESSION set, uploads streamed through the server (see
+streaming_upload.stream_to_blob()) can be stored compressed. Whether a file
+is compressed, and with which codec, depends on its content type:
+COMPRESSION_POLICY maps types to 'gzip', 'zstd', 'off' or 'sample', on top
+of a built-in policy that never compresses already-compressed formats
+(images, audio, video, archives) and samples everything else. 'sample'
+compresses the first COMPRESSION_SAMPLE_BYTES quickly and only stores the
+file compressed if that sample shrank to COMPRESSION_MAX_RATIO or less.
+
+Large files are compressed on several threads. zstd does that itself. Gzip
+is split into blocks that are deflated independently, each primed with the
+32 KiB before it, and joined into a single gzip member, as pigz does, so
+any gzip decoder reads it. zlib releases the GIL while it works, so the
+blocks really are compressed in parallel.
+
+The file record keeps the original `size` (quotas and listings count it),
+plus the `encoding` and `stored_size`. The blob holds the compressed bytes
+with no Content-Encoding of its own, so every read returns them as stored;
+downloads go through the app (/download-file), which passes them on with
+a Content-Encoding the client accepts or decompresses them as it streams.
+
+zstd needs the `zstandard` package (in requirements.txt). Without it, files
+are compressed with gzip instead, and files stored with zstd can't be read.
+"""
+import fnmatch
+import logging
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+CODECS = (GZIP, ZSTD)
+
+# Content types compressed by their own format, which compressing again doesn't shrink
+DEFAULT_POLICY = {
+    'image/*': 'off',
+    'image/svg+xml': 'sample',
+    'image/bmp': 'sample',
+    'image/tiff': 'sample',
+    'audio/*': 'off',
+    'video/*': 'off',
+    'application/zip': 'off',
+    'application/gzip': 'off',
+    'application/x-gzip': 'off',
+    'application/zstd': 'off',
+    'application/x-bzip2': 'off',
+    'application/x-xz': 'off',
+    'application/x-7z-compressed': 'off',
+    'application/x-rar-compressed': 'off',
+    'application/vnd.rar': 'off',
+    'application/java-archive': 'off',
+    'application/vnd.openxmlformats-officedocument.*': 'off',
+    'application/vnd.oasis.opendocument.*': 'off',
+    'application/epub+zip': 'off',
+    'application/pdf': 'sample',
+    '*': 'sample',
+}
+
+# Gzip blocks compressed per thread, and the window each is primed with
+GZIP_BLOCK_SIZE = 1024 * 1024
+GZIP_WINDOW = 32 * 1024
+
+# Fast level for compressibility samples
+SAMPLE_LEVEL = 1
+
+# Threads are started on first use, so the pool survives a pre-fork import
+_executor = ThreadPoolExecutor(max_workers=max(config.COMPRESSION_THREADS, 1), thread_name_prefix='compress')
+
+
+def parse_policy(text):
+    """Parse 'type=codec,type=codec' (types may end in '*') into a policy dict"""
+    policy = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        content_type, _, action = item.partition('=')
+        action = action.strip().lower()
+        if action not in CODECS + ('off', 'sample'):
+            raise ValueError(f"Unknown compression for {content_type}: {action}")
+        policy[content_type.strip().lower()] = action
+    return policy
+
+
+POLICY = dict(DEFAULT_POLICY, **parse_policy(config.COMPRESSION_POLICY))
+
+
+def default_codec():
+    """The codec 'sample' compresses with, or None if compression is off"""
+    codec = config.UPLOAD_COMPRESSION.lower()
+    if codec not in CODECS:
+        return None
+    return available(codec)
+
+
+def available(codec):
+    if codec == ZSTD and zstandard is None:
+        return GZIP
+    return codec
+
+
+def policy_for(content_type):
+    """What the policy says for a content type: a codec, 'off' or 'sample'"""
+    media_type = (content_type or '').split(';')[0].strip().lower()
+    if media_type in POLICY:
+        return POLICY[media_type]
+    # The most specific pattern wins, e.g. 'image/svg+xml' over 'image/*' over '*'
+    matches = [pattern for pattern in POLICY if '*' in pattern and fnmatch.fnmatchcase(media_type, pattern)]
+    return POLICY[max(matches, key=len)] if matches else 'sample'
+
+
+def compressible(sample):
+    """Check whether a sample shrinks enough to be worth compressing"""
+    if not sample:
+        return False
+    return len(zlib.compress(sample, SAMPLE_LEVEL)) <= len(sample) * config.COMPRESSION_MAX_RATIO
+
+
+def choose_codec(content_type, first_chunk):
+    """The codec to store a file with, judged by its type and first bytes, or None to store it as is"""
+    codec = default_codec()
+    if codec is None or len(first_chunk) < config.COMPRESSION_MIN_SIZE:
+        return None
+    action = policy_for(content_type)
+    if action == 'off':
+        return None
+    if action == 'sample':
+        return codec if compressible(first_chunk[:config.COMPRESSION_SAMPLE_BYTES]) else None
+    return available(action)
+
+
+class GzipCompressor:
+    """Gzip compressed in parallel blocks, written out as one gzip member"""
+
+    HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+    def __init__(self, level, threads):
+        self.level = level
+        self.threads = threads
+        self._crc = 0
+        self._size = 0
+        self._window = b''
+        self._started = False
+
+    def _deflate(self, block, window):
+        if window:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=window)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        # A sync flush ends the block on a byte boundary, so the next one can follow it
+        return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def compress(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        blocks = [data[start:start + GZIP_BLOCK_SIZE] for start in range(0, len(data), GZIP_BLOCK_SIZE)]
+        windows = []
+        for block in blocks:
+            windows.append(self._window)
+            self._window = (self._window + block)[-GZIP_WINDOW:]
+        if self.threads > 1 and len(blocks) > 1:
+            deflated = list(_executor.map(self._deflate, blocks, windows))
+        else:
+            deflated = [self._deflate(block, window) for block, window in zip(blocks, windows)]
+        header = b'' if self._started else self.HEADER
+        self._started = True
+        return header + b''.join(deflated)
+
+    def flush(self):
+        header = b'' if self._started else self.HEADER
+        self._started = True
+        # An empty final block ends the deflate stream
+        final = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH)
+        return header + final + struct.pack('<II', self._crc & 0xffffffff, self._size & 0xffffffff)
+
+
+def compressor(codec):
+    """A streaming compressor: compress(bytes) -> bytes for each chunk, then flush() -> bytes"""
+    if codec == ZSTD:
+        threads = config.COMPRESSION_THREADS if config.COMPRESSION_THREADS > 1 else 0
+        return zstandard.ZstdCompressor(level=config.ZSTD_LEVEL, threads=threads).compressobj()
+    return GzipCompressor(config.GZIP_LEVEL, config.COMPRESSION_THREADS)
+
+
+def decompressor(codec):
+    """A streaming decompressor: decompress(bytes) -> bytes for each chunk"""
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError('This file is stored with zstd, which needs the zstandard package')
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def decompress_chunks(chunks, encoding):
+    """Yield a stored file's original bytes from its stored chunks"""
+    if not encoding:
+        yield from chunks
+        return
+    decoder = decompressor(encoding)
+    for chunk in chunks:
+        data = decoder.decompress(chunk)
+        if data:
+            yield data
+    if encoding == GZIP:
+        data = decoder.flush()
+        if data:
+            yield data
+
+
+def decompress(data, encoding):
+    """A stored file's original bytes, from all of its stored bytes"""
+    return b''.join(decompress_chunks([data], encoding))
+
+
+if config.UPLOAD_COMPRESSION.lower() == ZSTD and zstandard is None:
+    logger.warning('UPLOAD_COMPRESSION=zstd needs the zstandard package; compressing with gzip instead')
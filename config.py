@@ -19,4 +19,105 @@ FIREBASE_AUTH_DOMAIN = os.environ.get('FIREBASE_AUTH_DOMAIN', local_constants.FI
 FIREBASE_PROJECT_ID = os.environ.get('FIREBASE_PROJECT_ID', local_constants.FIREBASE_PROJECT_ID)
 FIREBASE_MESSAGING_SENDER_ID = os.environ.get('FIREBASE_MESSAGING_SENDER_ID', local_constants.FIREBASE_MESSAGING_SENDER_ID)
 FIREBASE_APP_ID = os.environ.get('FIREBASE_APP_ID', local_constants.FIREBASE_APP_ID)
-FIREBASE_MEASUREMENT_ID = os.environ.get('FIREBASE_MEASUREMENT_ID', local_constants.FIREBASE_MEASUREMENT_ID) 
\ No newline at end of file
+FIREBASE_MEASUREMENT_ID = os.environ.get('FIREBASE_MEASUREMENT_ID', local_constants.FIREBASE_MEASUREMENT_ID) 
+
+# Upload pipeline
+# Chunk size must be a multiple of 256 KiB; the memory limit caps how many bytes
+# of a single upload a worker may hold at once
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+UPLOAD_MEMORY_LIMIT = int(os.environ.get('UPLOAD_MEMORY_LIMIT', 32 * 1024 * 1024))
+
+# Chunked upload sessions
+UPLOAD_SESSION_CHUNK_SIZE = int(os.environ.get('UPLOAD_SESSION_CHUNK_SIZE', 8 * 1024 * 1024))
+UPLOAD_SESSION_TTL_HOURS = int(os.environ.get('UPLOAD_SESSION_TTL_HOURS', 24))
+
+# Delta sync blocks no file references are kept this long before collect_blocks.py deletes
+# them, so blocks uploaded for a commit still to come survive
+SYNC_BLOCK_GRACE_HOURS = int(os.environ.get('SYNC_BLOCK_GRACE_HOURS', 24))
+
+# Store file bytes once per content hash, shared by every file with that content
+CONTENT_ADDRESSED_STORAGE = os.environ.get('CONTENT_ADDRESSED_STORAGE', 'false').lower() == 'true'
+
+# Directory listing cache; set LISTING_CACHE_PATH to share it between workers via SQLite
+LISTING_CACHE_SIZE = int(os.environ.get('LISTING_CACHE_SIZE', 10000))
+LISTING_CACHE_TTL = int(os.environ.get('LISTING_CACHE_TTL', 60))
+LISTING_CACHE_PATH = os.environ.get('LISTING_CACHE_PATH', '')
+
+# Threads per worker process for running independent Firestore/Storage calls concurrently
+BACKEND_CONCURRENCY = int(os.environ.get('BACKEND_CONCURRENCY', 16))
+
+# Signed download URLs: lifetime, and how long before expiry a cached one stops being reused
+SIGNED_URL_TTL = int(os.environ.get('SIGNED_URL_TTL', 300))
+SIGNED_URL_REUSE_MARGIN = int(os.environ.get('SIGNED_URL_REUSE_MARGIN', 60))
+SIGNED_URL_CACHE_SIZE = int(os.environ.get('SIGNED_URL_CACHE_SIZE', 10000))
+
+# Streamed ZIP downloads: bytes per Storage read, members read ahead, and chunks queued per member
+ZIP_READ_CHUNK_SIZE = int(os.environ.get('ZIP_READ_CHUNK_SIZE', 1024 * 1024))
+ZIP_READ_AHEAD = int(os.environ.get('ZIP_READ_AHEAD', 2))
+ZIP_QUEUE_DEPTH = int(os.environ.get('ZIP_QUEUE_DEPTH', 4))
+
+# Directory tree nodes cached per worker for resolving paths to directory IDs
+TREE_CACHE_SIZE = int(os.environ.get('TREE_CACHE_SIZE', 100000))
+TREE_CACHE_TTL = int(os.environ.get('TREE_CACHE_TTL', 60))
+
+# Seconds between runs of the expired share sweeper (sweep_shares.py)
+SHARE_SWEEP_INTERVAL = int(os.environ.get('SHARE_SWEEP_INTERVAL', 3600))
+
+# Where metadata and file bytes live: 'firebase' or 'local' (SQLite and files under LOCAL_STORAGE_PATH)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'firebase')
+LOCAL_STORAGE_PATH = os.environ.get('LOCAL_STORAGE_PATH', 'data')
+# Key for signing local download URLs; generated under LOCAL_STORAGE_PATH if unset
+LOCAL_STORAGE_SECRET = os.environ.get('LOCAL_STORAGE_SECRET', '')
+
+# Requests slower than this are logged with their backend call counts
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 1000))
+# Directory for flame graph data (folded stacks) of slow requests; empty turns the sampling profiler off
+PROFILE_PATH = os.environ.get('PROFILE_PATH', '')
+PROFILE_INTERVAL_MS = int(os.environ.get('PROFILE_INTERVAL_MS', 10))
+
+# Search indexes: one SQLite file per user in this directory, rebuilt from Firestore
+# once older than SEARCH_INDEX_MAX_AGE seconds (0: only when a change can't be applied in place)
+SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH', 'search-index')
+SEARCH_INDEX_MAX_AGE = int(os.environ.get('SEARCH_INDEX_MAX_AGE', 0))
+
+# Storage usage: counter shards per user and per directory (only ever raise it), and the
+# quota of users without their own `quota_bytes` (0: unlimited)
+USAGE_SHARDS = int(os.environ.get('USAGE_SHARDS', 10))
+DEFAULT_QUOTA_BYTES = int(os.environ.get('DEFAULT_QUOTA_BYTES', 0))
+
+# Change feed: changes kept per user, journal shards per user (only ever raise it), seconds
+# between checks for other workers' changes while waiting, the longest /list-changes wait,
+# requests per worker that may wait at once, whether /change-stream is served, and how long
+# a /change-stream connection stays open
+CHANGE_FEED_LENGTH = int(os.environ.get('CHANGE_FEED_LENGTH', 10000))
+CHANGE_FEED_SHARDS = int(os.environ.get('CHANGE_FEED_SHARDS', 4))
+CHANGE_FEED_POLL_INTERVAL = float(os.environ.get('CHANGE_FEED_POLL_INTERVAL', 1))
+CHANGE_FEED_MAX_WAIT = int(os.environ.get('CHANGE_FEED_MAX_WAIT', 30))
+CHANGE_FEED_MAX_WAITERS = int(os.environ.get('CHANGE_FEED_MAX_WAITERS', 4))
+CHANGE_STREAM_ENABLED = os.environ.get('CHANGE_STREAM_ENABLED', 'false').lower() == 'true'
+CHANGE_STREAM_DURATION = int(os.environ.get('CHANGE_STREAM_DURATION', 55))
+CHANGE_STREAM_HEARTBEAT = int(os.environ.get('CHANGE_STREAM_HEARTBEAT', 15))
+CHANGE_STREAM_RETRY_MS = int(os.environ.get('CHANGE_STREAM_RETRY_MS', 1000))
+
+# Previews: render processes (and dispatcher threads) per web worker, 0 to turn them off; jobs
+# queued at most; seconds a render may take; largest file previewed; longest edge of each
+# variant in pixels; and previews cached in each worker's memory
+PREVIEW_WORKERS = int(os.environ.get('PREVIEW_WORKERS', 2))
+PREVIEW_QUEUE_SIZE = int(os.environ.get('PREVIEW_QUEUE_SIZE', 64))
+PREVIEW_TIMEOUT = int(os.environ.get('PREVIEW_TIMEOUT', 30))
+PREVIEW_MAX_SOURCE_BYTES = int(os.environ.get('PREVIEW_MAX_SOURCE_BYTES', 50 * 1024 * 1024))
+PREVIEW_THUMBNAIL_SIZE = int(os.environ.get('PREVIEW_THUMBNAIL_SIZE', 256))
+PREVIEW_SIZE = int(os.environ.get('PREVIEW_SIZE', 1024))
+PREVIEW_CACHE_SIZE = int(os.environ.get('PREVIEW_CACHE_SIZE', 500))
+
+# Compression of uploads streamed through the server: 'gzip' or 'zstd' (empty: off); per content type
+# overrides as 'type=codec,...' with codecs gzip, zstd, off or sample; the bytes sampled and the ratio
+# they must shrink to; files smaller than COMPRESSION_MIN_SIZE are stored as they are
+UPLOAD_COMPRESSION = os.environ.get('UPLOAD_COMPRESSION', '')
+COMPRESSION_POLICY = os.environ.get('COMPRESSION_POLICY', '')
+COMPRESSION_SAMPLE_BYTES = int(os.environ.get('COMPRESSION_SAMPLE_BYTES', 64 * 1024))
+COMPRESSION_MAX_RATIO = float(os.environ.get('COMPRESSION_MAX_RATIO', 0.9))
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 4096))
+COMPRESSION_THREADS = int(os.environ.get('COMPRESSION_THREADS', 4))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+ZSTD_LEVEL = int(os.environ.get('ZSTD_LEVEL', 3))
@@ -0,0 +1,80 @@
+"""
+Batched Firestore access for Dropbox Clone
+
+Helpers that turn the per-document round trips the routes used to make
+into a single batched read, a chunked WriteBatch, or one transaction.
+"""
+from firebase_admin import firestore
+
+# Firestore batches and transactions take at most 500 writes
+BATCH_LIMIT = 500
+
+
+def get_all(db, refs):
+    """
+    Fetch many documents in one round trip.
+
+    Returns a dict of document ID to snapshot; documents that don't exist are
+    included with `exists == False`.
+    """
+    refs = list(refs)
+    if not refs:
+        return {}
+    return {snapshot.id: snapshot for snapshot in db.get_all(refs)}
+
+
+def exists(query):
+    """Check whether a query matches anything, reading at most one document"""
+    return len(query.limit(1).get()) > 0
+
+
+def write_batch(db, operations):
+    """
+    Apply write operations in as few batches as possible.
+
+    Each operation is a tuple of a WriteBatch method name and its arguments,
+    e.g. ('set', ref, data), ('update', ref, data) or ('delete', ref).
+    Every 500 operations are committed atomically.
+    """
+    operations = list(operations)
+    for start in range(0, len(operations), BATCH_LIMIT):
+        batch = db.batch()
+        for method, *args in operations[start:start + BATCH_LIMIT]:
+            getattr(batch, method)(*args)
+        batch.commit()
+
+
+def delete_all(db, refs):
+    """Delete many documents with batched writes"""
+    write_batch(db, (('delete', ref) for ref in refs))
+
+
+def create_unless_exists(db, query, writes):
+    """
+    Atomically run `writes` only if `query` matches no documents.
+
+    `writes` is a list of (ref, data) pairs. Returns True if they were
+    written, False if the query found an existing document.
+    """
+    @firestore.transactional
+    def check_and_create(transaction):
+        if len(list(transaction.get(query.limit(1)))) > 0:
+            return False
+        for ref, data in writes:
+            transaction.create(ref, data)
+        return True
+
+    return check_and_create(db.transaction())
+
+
+def create_unless_document_exists(db, ref, writes):
+    """Atomically run `writes` only if the document at `ref` doesn't exist yet"""
+    @firestore.transactional
+    def check_and_create(transaction):
+        if ref.get(transaction=transaction).exists:
+            return False
+        for write_ref, data in writes:
+            transaction.create(write_ref, data)
+        return True
+
+    return check_and_create(db.transaction())
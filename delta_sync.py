@@ -0,0 +1,262 @@
+"""
+Block-level delta sync for Dropbox Clone
+
+Clients split files with the content-defined chunker (see chunking.py), ask
+which block hashes the server is missing, upload only those, and commit a
+manifest. Blocks are kept per user under {uid}/.blocks/ and tracked in the
+`sync_blocks` collection; manifests are stored in pages next to the `files`
+document, under manifests/{file_id}.
+"""
+import hashlib
+import io
+import re
+from collections import Counter
+
+from firebase_admin import firestore
+from google.api_core.exceptions import Conflict, NotFound, PreconditionFailed
+
+from chunking import MAX_CHUNK_SIZE
+from datastore import BATCH_LIMIT, get_all, write_batch
+
+# Manifest entries per page document, well under Firestore's 1 MiB limit
+MANIFEST_PAGE_SIZE = 5000
+
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+class BlocksMissing(Exception):
+    """A manifest names blocks the user has no record of"""
+
+    def __init__(self, hashes):
+        super().__init__('Blocks are missing')
+        self.hashes = hashes
+
+
+def is_block_hash(value):
+    """Check that a value looks like a lowercase SHA-256 hex digest"""
+    return isinstance(value, str) and SHA256_PATTERN.match(value) is not None
+
+
+def block_blob_name(uid, block_hash):
+    """Storage name of a user's block"""
+    return f"{uid}/.blocks/{block_hash}"
+
+
+def block_ref(db, uid, block_hash):
+    """Firestore reference of a user's block record"""
+    return db.collection('sync_blocks').document(f"{uid}_{block_hash}")
+
+
+def is_collectable(block_data, grace, now):
+    """
+    Whether collect_blocks() may delete a block: nothing references it and
+    it wasn't uploaded in the `grace` (a timedelta) before `now`
+    """
+    touched_at = block_data.get('touched_at') or block_data.get('created_at')
+    return block_data.get('refcount', 0) <= 0 and (touched_at is None or touched_at <= now - grace)
+
+
+def missing_blocks(db, uid, hashes, grace, now):
+    """
+    Return the hashes, in request order, that the user has not uploaded yet.
+
+    Unreferenced blocks old enough to be collected count as missing, so the
+    client uploads them again rather than commit blocks about to go.
+    """
+    unique = list(dict.fromkeys(hashes))
+    snapshots = get_all(db, (block_ref(db, uid, block_hash) for block_hash in unique))
+    missing = []
+    for block_hash in unique:
+        snapshot = snapshots[f"{uid}_{block_hash}"]
+        if not snapshot.exists or is_collectable(snapshot.to_dict(), grace, now):
+            missing.append(block_hash)
+    return missing
+
+
+def store_block(db, bucket, uid, block_hash, data):
+    """Verify and store one uploaded block"""
+    if len(data) > MAX_CHUNK_SIZE:
+        raise ValueError(f'Blocks may be at most {MAX_CHUNK_SIZE} bytes')
+    if hashlib.sha256(data).hexdigest() != block_hash:
+        raise ValueError('Block failed hash verification')
+
+    # A block uploaded before is marked fresh first, so collect_blocks()
+    # leaves it alone while it is written again
+    ref = block_ref(db, uid, block_hash)
+    try:
+        ref.update({'touched_at': firestore.SERVER_TIMESTAMP})
+        recorded = True
+    except NotFound:
+        recorded = False
+
+    bucket.blob(block_blob_name(uid, block_hash)).upload_from_string(
+        data, content_type='application/octet-stream'
+    )
+    if recorded:
+        return
+    # Blocks start unreferenced until a manifest commits them
+    try:
+        ref.create({
+            'user_id': uid,
+            'hash': block_hash,
+            'size': len(data),
+            'refcount': 0,
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'touched_at': firestore.SERVER_TIMESTAMP
+        })
+    except Conflict:
+        ref.update({'touched_at': firestore.SERVER_TIMESTAMP})
+
+
+class ManifestReader(io.RawIOBase):
+    """Read-only stream over a user's blocks, concatenated in manifest order"""
+
+    def __init__(self, bucket, uid, block_hashes):
+        self._bucket = bucket
+        self._uid = uid
+        self._pending = iter(block_hashes)
+        self._current = b''
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._position >= len(self._current):
+            block_hash = next(self._pending, None)
+            if block_hash is None:
+                return 0
+            self._current = self._bucket.blob(block_blob_name(self._uid, block_hash)).download_as_bytes()
+            self._position = 0
+
+        count = min(len(buffer), len(self._current) - self._position)
+        buffer[:count] = self._current[self._position:self._position + count]
+        self._position += count
+        return count
+
+
+def save_manifest(db, uid, file_id, blocks):
+    """
+    Take a reference on each of a file's blocks and store its manifest.
+
+    Raises BlocksMissing, taking no references, if any block has no record,
+    e.g. because collect_blocks() deleted it since the client asked.
+    """
+    counts = Counter(block['hash'] for block in blocks)
+    _take_references(db, uid, counts)
+
+    manifest_ref = db.collection('manifests').document(file_id)
+    operations = [('set', manifest_ref, {
+        'user_id': uid,
+        'block_count': len(blocks),
+        'page_size': MANIFEST_PAGE_SIZE,
+        'created_at': firestore.SERVER_TIMESTAMP
+    })]
+
+    for page, start in enumerate(range(0, len(blocks), MANIFEST_PAGE_SIZE)):
+        entries = blocks[start:start + MANIFEST_PAGE_SIZE]
+        operations.append(('set', manifest_ref.collection('pages').document(f"{page:06d}"), {
+            'hashes': [block['hash'] for block in entries],
+            'sizes': [block['size'] for block in entries]
+        }))
+
+    try:
+        write_batch(db, operations)
+    except Exception:
+        _drop_references(db, uid, counts)
+        raise
+
+
+def _take_references(db, uid, counts):
+    """Add `counts` to the blocks' reference counts, a transaction per batch of blocks"""
+    items = list(counts.items())
+    for start in range(0, len(items), BATCH_LIMIT):
+        batch = items[start:start + BATCH_LIMIT]
+
+        # Each record is read again, so a block collect_blocks() deleted since
+        # it was checked is caught here instead of failing the update
+        @firestore.transactional
+        def take(transaction):
+            refs = [block_ref(db, uid, block_hash) for block_hash, count in batch]
+            found = {snapshot.id for snapshot in transaction.get_all(refs) if snapshot.exists}
+            missing = [block_hash for block_hash, count in batch if f"{uid}_{block_hash}" not in found]
+            if missing:
+                return missing
+            for ref, (block_hash, count) in zip(refs, batch):
+                transaction.update(ref, {'refcount': firestore.Increment(count)})
+            return []
+
+        missing = take(db.transaction())
+        if missing:
+            _drop_references(db, uid, dict(items[:start]))
+            raise BlocksMissing(missing)
+
+
+def _drop_references(db, uid, counts):
+    write_batch(db, [
+        ('update', block_ref(db, uid, block_hash), {'refcount': firestore.Increment(-count)})
+        for block_hash, count in counts.items()
+    ])
+
+
+def release_manifest(db, uid, file_id):
+    """Drop a file's manifest and its references on blocks, if it has one"""
+    manifest_ref = db.collection('manifests').document(file_id)
+    pages = list(manifest_ref.collection('pages').stream())
+
+    counts = Counter()
+    for page in pages:
+        counts.update(page.to_dict().get('hashes', []))
+
+    # Blocks left without references are removed by collect_blocks()
+    operations = [
+        ('update', block_ref(db, uid, block_hash), {'refcount': firestore.Increment(-count)})
+        for block_hash, count in counts.items()
+    ]
+    operations.extend(('delete', page.reference) for page in pages)
+    operations.append(('delete', manifest_ref))
+    write_batch(db, operations)
+
+
+def collect_blocks(db, bucket, uid, grace, now):
+    """
+    Delete a user's blocks that no manifest references any more.
+
+    Blocks uploaded less than `grace` (a timedelta) before `now` are kept, as
+    a client may have uploaded them for a commit it hasn't made yet. Returns
+    how many blocks were deleted.
+    """
+    orphans = db.collection('sync_blocks').where('user_id', '==', uid).where('refcount', '<=', 0).stream()
+    removed = 0
+    for snapshot in orphans:
+        if not is_collectable(snapshot.to_dict(), grace, now):
+            continue
+        name = block_blob_name(uid, snapshot.get('hash'))
+        blob = bucket.get_blob(name)
+        generation = blob.generation if blob is not None else None
+        if not _forget_block(db, snapshot.reference, grace, now):
+            continue
+        # store_block() marks a block fresh before writing it again, so the
+        # generation read above is older than any upload _forget_block() missed,
+        # and the precondition keeps that upload
+        if generation is not None:
+            try:
+                bucket.blob(name).delete(if_generation_match=generation)
+            except (NotFound, PreconditionFailed):
+                pass
+        removed += 1
+    return removed
+
+
+def _forget_block(db, ref, grace, now):
+    """Delete a block record if it can still be collected"""
+
+    @firestore.transactional
+    def forget(transaction):
+        snapshot = ref.get(transaction=transaction)
+        if not snapshot.exists or not is_collectable(snapshot.to_dict(), grace, now):
+            return False
+        transaction.delete(ref)
+        return True
+
+    return forget(db.transaction())
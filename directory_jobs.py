@@ -0,0 +1,515 @@
+"""
+Recursive directory jobs for Dropbox Clone
+
+Every directory and file stores its full path, so moving, renaming or
+deleting a directory means rewriting its whole subtree. Jobs do that in the
+background, one batch at a time: each step finds the next documents still
+under the source path with prefix range queries, then rewrites them in a
+single transaction together with the job's progress. It repeats until
+nothing is left. Because each step only looks at what remains, a job that
+stopped part-way (a crash or a redeploy) carries on where it left off.
+
+Side effects outside Firestore are recorded on the job in the same
+transaction and replayed if the job stops before finishing them. These are
+deleting a moved file's old blob and releasing a deleted file's bytes.
+
+A running job holds a lease. Once the lease lapses, the next status poll
+resumes the job in whichever worker serves it. Until a job is done, writes
+into the paths it covers are refused (see locked_path()).
+"""
+import datetime
+import logging
+from collections import defaultdict
+
+from firebase_admin import firestore
+from google.api_core.exceptions import NotFound
+
+from backend_pool import map_concurrently
+from blob_store import delete_file_bytes, delete_orphan, file_blob_name, release_file_blob
+from datastore import delete_all, write_batch
+from delta_sync import release_manifest
+from duplicate_index import update_files
+
+logger = logging.getLogger(__name__)
+
+# Files or directories rewritten per step
+JOB_BATCH_SIZE = 80
+
+# Writes a Firestore transaction may make
+TRANSACTION_WRITES = 500
+
+# Transaction writes per file moved or deleted, besides its shares: the file,
+# its duplicate index entry, two group counters, and its directory's usage
+# counter plus its content's reference, or a second usage counter for a move
+WRITES_PER_FILE = 6
+
+# Transaction writes per step whatever its files: the job and the user's usage total
+WRITES_PER_STEP = 2
+
+LEASE_SECONDS = 120
+
+# Values per Firestore 'in' filter
+IN_QUERY_LIMIT = 10
+
+UNFINISHED_STATES = ['pending', 'running', 'failed']
+
+PHASES = {
+    'move': ['directories', 'files'],
+    # Files go first so a stopped delete never leaves files without a directory
+    'delete': ['files', 'directories'],
+    # Deletes on the ID schema walk the tree by parent links (see _delete_tree())
+    'delete_tree': ['tree'],
+}
+
+
+def join_path(parent, name):
+    return f"{parent}/{name}".replace('//', '/')
+
+
+def is_within(path, root):
+    """Check whether `path` is `root` or below it"""
+    return path == root or path.startswith(root.rstrip('/') + '/')
+
+
+def rebase(path, source, target):
+    """Move a path at or below `source` to the same place below `target`"""
+    return target + path[len(source):]
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _lease():
+    return _now() + datetime.timedelta(seconds=LEASE_SECONDS)
+
+
+def subtree_queries(db, collection, uid, path):
+    """Queries for a user's documents whose `path` is at or below `path`"""
+    documents = db.collection(collection).where('user_id', '==', uid)
+    prefix = path.rstrip('/') + '/'
+    return [
+        documents.where('path', '==', path),
+        documents.where('path', '>=', prefix).where('path', '<', prefix + '\uf8ff')
+    ]
+
+
+def _next_batch(db, collection, uid, path):
+    batch = []
+    for query in subtree_queries(db, collection, uid, path):
+        batch.extend(query.limit(JOB_BATCH_SIZE - len(batch)).stream())
+        if len(batch) >= JOB_BATCH_SIZE:
+            break
+    return batch
+
+
+def _fit_batch(db, batch):
+    """
+    The start of a batch of files whose writes fit in one transaction, and
+    their shares by file ID.
+
+    The shares of the files count against the transaction's writes too, so
+    files with many shares make for shorter batches. A file with too many
+    shares to fit at all comes alone, and the third value is True: its
+    shares have to be written before the transaction instead of in it.
+    """
+    shares = defaultdict(list)
+    file_ids = [file.id for file in batch]
+    for start in range(0, len(file_ids), IN_QUERY_LIMIT):
+        chunk = file_ids[start:start + IN_QUERY_LIMIT]
+        for share in db.collection('shared_files').where('file_id', 'in', chunk).stream():
+            shares[share.get('file_id')].append(share)
+
+    room = TRANSACTION_WRITES - WRITES_PER_STEP
+    fitted = []
+    for file in batch:
+        room -= WRITES_PER_FILE + len(shares[file.id])
+        if room < 0 and fitted:
+            break
+        fitted.append(file)
+    return fitted, {file.id: shares[file.id] for file in fitted}, room < 0
+
+
+def _count(db, collection, uid, path):
+    return sum(
+        query.count().get()[0][0].value
+        for query in subtree_queries(db, collection, uid, path)
+    )
+
+
+def unfinished_jobs(db, uid):
+    return db.collection('jobs').where('user_id', '==', uid).where('state', 'in', UNFINISHED_STATES).stream()
+
+
+def locked_path(db, uid, path):
+    """Check whether an unfinished job covers `path`"""
+    for job in unfinished_jobs(db, uid):
+        roots = [job.get('source'), job.to_dict().get('target')]
+        if any(root and is_within(path, root) for root in roots):
+            return True
+    return False
+
+
+def overlapping_job(db, uid, *paths):
+    """Return an unfinished job whose paths overlap any of `paths`, or None"""
+    for job in unfinished_jobs(db, uid):
+        roots = [job.get('source'), job.to_dict().get('target')]
+        for root in filter(None, roots):
+            if any(is_within(path, root) or is_within(root, path) for path in paths):
+                return job
+    return None
+
+
+def create_job(db, uid, job_type, source, target=None, extra=None):
+    """Record a new job over the subtree at `source` and return its ID"""
+    if source == '/':
+        raise ValueError('A job cannot move or delete the root directory')
+    # Stored paths below a directory are only current on the path schema
+    counted = job_type != 'delete_tree'
+    job_ref = db.collection('jobs').document()
+    job_ref.set({
+        **(extra or {}),
+        'user_id': uid,
+        'type': job_type,
+        'source': source,
+        'target': target,
+        'state': 'pending',
+        'phase': PHASES[job_type][0],
+        'total_files': _count(db, 'files', uid, source) if counted else None,
+        'total_directories': _count(db, 'directories', uid, source) if counted else None,
+        'processed_files': 0,
+        'processed_directories': 0,
+        'pending_blob_deletes': [],
+        'pending_releases': [],
+        'pending_orphans': [],
+        'error': None,
+        'lease_until': None,
+        'created_at': firestore.SERVER_TIMESTAMP
+    })
+    return job_ref.id
+
+
+def job_status(job):
+    """The parts of a job document reported to the client"""
+    job_data = job.to_dict()
+    return {
+        'id': job.id,
+        'type': job_data['type'],
+        'state': job_data['state'],
+        'phase': job_data['phase'],
+        'source': job_data['source'],
+        'target': job_data.get('target'),
+        'processed_files': job_data['processed_files'],
+        'total_files': job_data['total_files'],
+        'processed_directories': job_data['processed_directories'],
+        'total_directories': job_data['total_directories'],
+        'error': job_data.get('error')
+    }
+
+
+def needs_runner(job):
+    """Check whether a job should be running but has no live lease"""
+    job_data = job.to_dict()
+    lease_until = job_data.get('lease_until')
+    return job_data['state'] in ('pending', 'running') and (lease_until is None or lease_until < _now())
+
+
+def _claim(db, job_ref, resume_failed):
+    @firestore.transactional
+    def claim(transaction):
+        job = job_ref.get(transaction=transaction)
+        if not job.exists:
+            return False
+        job_data = job.to_dict()
+        if job_data['state'] == 'done':
+            return False
+        if job_data['state'] == 'failed' and not resume_failed:
+            return False
+        lease_until = job_data.get('lease_until')
+        if job_data['state'] == 'running' and lease_until is not None and lease_until > _now():
+            return False
+        transaction.update(job_ref, {'state': 'running', 'error': None, 'lease_until': _lease()})
+        return True
+
+    return claim(db.transaction())
+
+
+def run_job(db, bucket, job_id, on_change=None, resume_failed=False, on_done=None):
+    """
+    Run a job to completion, unless another runner holds its lease.
+
+    `on_change(uid, file_ids, share_ids)` is called after each step, with the
+    files and shares it changed, and `on_done(job data)` once by the runner
+    that finishes the job.
+    """
+    job_ref = db.collection('jobs').document(job_id)
+    if not _claim(db, job_ref, resume_failed):
+        return
+
+    try:
+        while True:
+            job = job_ref.get().to_dict()
+            phases = PHASES[job['type']]
+            step = STEPS[job['type'], job['phase']]
+            changed = step(db, bucket, job_ref, job_id, job)
+            if changed is None:
+                index = phases.index(job['phase']) + 1
+                if index == len(phases):
+                    break
+                job_ref.update({'phase': phases[index], 'lease_until': _lease()})
+            elif on_change is not None:
+                on_change(job['user_id'], *changed)
+    except Exception as e:
+        logger.exception(f"Directory job {job_id} failed: {e}")
+        job_ref.update({'state': 'failed', 'error': str(e), 'lease_until': None})
+        return
+
+    job_ref.update({
+        'state': 'done',
+        'phase': None,
+        'lease_until': None,
+        'finished_at': firestore.SERVER_TIMESTAMP
+    })
+    if on_change is not None:
+        on_change(job['user_id'], [], [])
+    if on_done is not None:
+        on_done(job)
+
+
+def _delete_blob(bucket, name):
+    try:
+        bucket.blob(name).delete()
+    except NotFound:
+        pass
+
+
+def _finish_blob_deletes(bucket, job_ref, names):
+    if names:
+        map_concurrently(lambda name: _delete_blob(bucket, name), names)
+        job_ref.update({'pending_blob_deletes': []})
+
+
+def _move_directories(db, bucket, job_ref, job_id, job):
+    uid, source, target = job['user_id'], job['source'], job['target']
+    batch = _next_batch(db, 'directories', uid, source)
+    if not batch:
+        return None
+
+    operations = []
+    for directory in batch:
+        path = directory.get('path')
+        updates = {'path': rebase(path, source, target)}
+        if path == source:
+            parent, _, name = target.rpartition('/')
+            updates['name'] = name
+            updates['parent_path'] = parent or '/'
+            if job.get('target_parent_id'):
+                updates['parent_id'] = job['target_parent_id']
+        else:
+            updates['parent_path'] = rebase(directory.get('parent_path'), source, target)
+        operations.append(('update', directory.reference, updates))
+    operations.append(('update', job_ref, {
+        'processed_directories': firestore.Increment(len(batch)),
+        'lease_until': _lease()
+    }))
+    write_batch(db, operations)
+    return [], []
+
+
+def _move_files(db, bucket, job_ref, job_id, job):
+    uid, source, target = job['user_id'], job['source'], job['target']
+    _finish_blob_deletes(bucket, job_ref, job.get('pending_blob_deletes'))
+
+    batch = _next_batch(db, 'files', uid, source)
+    if not batch:
+        return None
+
+    batch, shares, crowded = _fit_batch(db, batch)
+    moved = []
+    copies = {}
+    storage_paths = {}
+    for file in batch:
+        file_data = file.to_dict()
+        path = rebase(file_data['path'], source, target)
+        storage_path = join_path(path, file_data['name'])
+        updates = {'path': path, 'storage_path': storage_path}
+        blob_name = file_blob_name(uid, file_data)
+        if blob_name == f"{uid}/{file_data['storage_path']}":
+            # Blobs named after the file's path move with it
+            updates['blob_name'] = f"{uid}/{storage_path}"
+            copies[file.id] = (blob_name, updates['blob_name'])
+        moved.append((file, updates))
+        storage_paths[file.id] = storage_path
+
+    # Copy first; the old blobs are deleted only once the records point at the copies
+    map_concurrently(
+        lambda names: bucket.copy_blob(bucket.blob(names[0]), bucket, names[1]),
+        list(copies.values())
+    )
+
+    # Shares keep their own copy of where the file lives
+    writes = []
+    share_ids = []
+    for file_id, file_shares in shares.items():
+        for share in file_shares:
+            updates = {'file_path': storage_paths[file_id]}
+            if file_id in copies:
+                updates['blob_name'] = copies[file_id][1]
+            writes.append(('update', share.reference, updates))
+            share_ids.append(share.id)
+    if crowded:
+        # Too many to commit with the move; the copies they point at exist already
+        write_batch(db, writes)
+        writes = []
+    old_names = [old_name for old_name, _ in copies.values()]
+    writes.append(('update', job_ref, {
+        'processed_files': firestore.Increment(len(batch)),
+        'pending_blob_deletes': old_names,
+        'lease_until': _lease()
+    }))
+    update_files(db, uid, moved=moved, writes=writes)
+
+    _finish_blob_deletes(bucket, job_ref, old_names)
+    return [file.id for file in batch], share_ids
+
+
+def _release_ref(db, job_id, file_id):
+    return db.collection('job_releases').document(f"{job_id}_{file_id}")
+
+
+def _finish_releases(db, bucket, job_ref, job_id, uid, releases, orphans=None):
+    if not releases and not orphans:
+        return
+
+    def release(file_data):
+        if file_data.get('released'):
+            # The delete transaction already dropped any reference to shared content
+            delete_file_bytes(bucket, uid, file_data)
+        else:
+            # Recorded by an older version, before the reference was dropped;
+            # the marker makes a replayed release of shared content a no-op
+            try:
+                release_file_blob(db, bucket, uid, file_data, once_ref=_release_ref(db, job_id, file_data['id']))
+            except NotFound:
+                pass
+        if file_data.get('has_manifest'):
+            release_manifest(db, uid, file_data['id'])
+
+    map_concurrently(release, releases or [])
+    map_concurrently(lambda orphan: delete_orphan(bucket, orphan), orphans or [])
+    job_ref.update({'pending_releases': [], 'pending_orphans': []})
+    delete_all(db, (
+        _release_ref(db, job_id, file_data['id']) for file_data in releases or [] if not file_data.get('released')
+    ))
+
+
+def _delete_files(db, bucket, job_ref, job_id, job):
+    uid, source = job['user_id'], job['source']
+    _finish_releases(db, bucket, job_ref, job_id, uid, job.get('pending_releases'), job.get('pending_orphans'))
+
+    batch = _next_batch(db, 'files', uid, source)
+    if not batch:
+        return None
+    return _delete_file_batch(db, bucket, job_ref, job_id, uid, batch)
+
+
+def _pending_releases(snapshots):
+    releases = []
+    for file in snapshots:
+        file_data = file.to_dict()
+        releases.append({
+            'id': file.id,
+            'blob_name': file_data.get('blob_name'),
+            'storage_path': file_data['storage_path'],
+            'hash': file_data['hash'],
+            'has_manifest': file_data.get('has_manifest', False),
+            'previews': file_data.get('previews'),
+            'released': True
+        })
+    return releases
+
+
+def _delete_file_batch(db, bucket, job_ref, job_id, uid, batch):
+    batch, shares, crowded = _fit_batch(db, batch)
+    if crowded:
+        # Too many to flag with the delete; update_files() skips shares already flagged
+        write_batch(db, [
+            ('update', share.reference, {'file_missing': True})
+            for file_shares in shares.values() for share in file_shares
+        ])
+
+    # Only the files still there when the transaction runs are deleted and released, so
+    # what is left to free in Storage is recorded from inside it
+    result = update_files(db, uid, deleted=batch, release=True, writes=lambda deleted, orphans: [
+        ('update', job_ref, {
+            'processed_files': firestore.Increment(len(deleted)),
+            'pending_releases': _pending_releases(deleted),
+            'pending_orphans': orphans,
+            'lease_until': _lease()
+        })
+    ])
+
+    _finish_releases(db, bucket, job_ref, job_id, uid, _pending_releases(result.deleted), result.orphans)
+    return [file.id for file in result.deleted], result.share_ids
+
+
+def _delete_directories(db, bucket, job_ref, job_id, job):
+    batch = _next_batch(db, 'directories', job['user_id'], job['source'])
+    if not batch:
+        return None
+
+    operations = [('delete', directory.reference) for directory in batch]
+    operations.append(('update', job_ref, {
+        'processed_directories': firestore.Increment(len(batch)),
+        'lease_until': _lease()
+    }))
+    write_batch(db, operations)
+    return [], []
+
+
+def _delete_tree(db, bucket, job_ref, job_id, job):
+    """
+    Delete a subtree on the ID schema, depth first, one step at a time.
+
+    The job keeps the chain of directories from the top of the subtree down
+    to the one being emptied (`stack`), so it stays as short as the tree is
+    deep. Each step descends into a subdirectory, deletes a batch of files,
+    or deletes the emptied directory and goes back up.
+    """
+    uid = job['user_id']
+    _finish_releases(db, bucket, job_ref, job_id, uid, job.get('pending_releases'), job.get('pending_orphans'))
+
+    stack = job['stack']
+    if not stack:
+        return None
+    current = stack[-1]
+
+    subdirectories = db.collection('directories').where('user_id', '==', uid).where('parent_id', '==', current)
+    child = subdirectories.limit(1).get()
+    if child:
+        job_ref.update({'stack': stack + [child[0].id], 'lease_until': _lease()})
+        return [], []
+
+    files = db.collection('files').where('user_id', '==', uid).where('parent_id', '==', current)
+    batch = list(files.limit(JOB_BATCH_SIZE).stream())
+    if batch:
+        return _delete_file_batch(db, bucket, job_ref, job_id, uid, batch)
+
+    write_batch(db, [
+        ('delete', db.collection('directories').document(current)),
+        ('update', job_ref, {
+            'stack': stack[:-1],
+            'processed_directories': firestore.Increment(1),
+            'lease_until': _lease()
+        })
+    ])
+    return [], []
+
+
+STEPS = {
+    ('move', 'directories'): _move_directories,
+    ('move', 'files'): _move_files,
+    ('delete', 'files'): _delete_files,
+    ('delete', 'directories'): _delete_directories,
+    ('delete_tree', 'tree'): _delete_tree,
+}
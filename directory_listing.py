@@ -0,0 +1,122 @@
+"""
+Paginated directory listings for Dropbox Clone
+
+Lists a directory's subdirectories and then its files as one sequence of
+pages. Each page is read with Firestore cursors (`start_after`) rather than
+offsets, so page N costs the same as page 1, and with a field projection
+(`select`) so only what the file browser renders is transferred.
+
+The cursor handed to the client is opaque: it records which collection the
+listing has reached and the sort value and document ID of the last entry.
+
+Directories on the ID schema (see directory_tree) are listed by their
+`parent_id` instead of their path.
+"""
+import base64
+import datetime
+import json
+
+from firebase_admin import firestore
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+SORT_FIELDS = ('name', 'size', 'created_at')
+
+# Fields the file browser renders for each kind of entry
+DIRECTORY_FIELDS = ['name', 'path']
+FILE_FIELDS = ['name', 'size', 'hash', 'content_type', 'preview_state']
+
+PHASES = ('directories', 'files')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(phase, value, doc_id):
+    """Pack the position after one entry into an opaque token"""
+    if isinstance(value, datetime.datetime):
+        value = {'ts': value.isoformat()}
+    payload = json.dumps([phase, value, doc_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(token):
+    """
+    Unpack a token from encode_cursor() into (phase, value, doc_id).
+
+    A doc_id of None means the listing continues from the start of `phase`.
+    """
+    try:
+        phase, value, doc_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        if isinstance(value, dict):
+            value = datetime.datetime.fromisoformat(value['ts'])
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor('Invalid cursor')
+    if phase not in PHASES or not isinstance(doc_id, (str, type(None))):
+        raise InvalidCursor('Invalid cursor')
+    return phase, value, doc_id
+
+
+def sort_field(phase, sort):
+    # Directories have no size, so they stay in name order when sorting by size
+    return 'name' if phase == 'directories' and sort == 'size' else sort
+
+
+def phase_query(db, uid, path, phase, sort, descending, parent_id=None):
+    """Query for one kind of entry in a directory, in listing order"""
+    field = sort_field(phase, sort)
+    if phase == 'directories':
+        query = db.collection('directories').where('user_id', '==', uid)
+        query = query.where('parent_path', '==', path) if parent_id is None else query.where('parent_id', '==', parent_id)
+        fields = DIRECTORY_FIELDS
+    else:
+        query = db.collection('files').where('user_id', '==', uid)
+        query = query.where('path', '==', path) if parent_id is None else query.where('parent_id', '==', parent_id)
+        fields = FILE_FIELDS
+
+    direction = firestore.Query.DESCENDING if descending else firestore.Query.ASCENDING
+    # The document ID breaks ties so that cursors never skip or repeat entries
+    query = query.order_by(field, direction=direction).order_by('__name__', direction=direction)
+    return query.select(sorted(set(fields) | {field})), field
+
+
+def list_page(db, uid, path, sort='name', descending=False, page_size=DEFAULT_PAGE_SIZE, cursor=None,
+              parent_id=None):
+    """
+    Read one page of a directory listing, by path or, if given, by `parent_id`.
+
+    Returns (directories, files, next_cursor); next_cursor is None once the
+    listing is complete.
+    """
+    if cursor:
+        phase, after_value, after_id = decode_cursor(cursor)
+    else:
+        phase, after_value, after_id = PHASES[0], None, None
+
+    entries = {name: [] for name in PHASES}
+    remaining = page_size
+    for phase in PHASES[PHASES.index(phase):]:
+        query, field = phase_query(db, uid, path, phase, sort, descending, parent_id)
+        if after_id is not None:
+            query = query.start_after({field: after_value, '__name__': after_id})
+
+        # One extra document tells whether this phase continues on the next page
+        snapshots = list(query.limit(remaining + 1).stream())
+        for snapshot in snapshots[:remaining]:
+            entry = snapshot.to_dict()
+            entry['id'] = snapshot.id
+            entries[phase].append(entry)
+
+        if len(snapshots) > remaining:
+            last = snapshots[remaining - 1]
+            return entries['directories'], entries['files'], encode_cursor(phase, last.get(field), last.id)
+
+        remaining -= len(snapshots)
+        after_value, after_id = None, None
+        if remaining == 0 and phase != PHASES[-1]:
+            # The page ended exactly at the last directory; files start the next page
+            return entries['directories'], entries['files'], encode_cursor(PHASES[-1], None, None)
+
+    return entries['directories'], entries['files'], None
@@ -0,0 +1,370 @@
+"""
+ID-linked directory tree for Dropbox Clone
+
+Besides their path strings, directories and files reference their parent
+directory by ID (`parent_id`; the root directory's is None). For users whose
+tree has been migrated (users/{uid} `tree_schema == 'ids'`), the parent links
+are authoritative: listings query `parent_id`, and moving or renaming a
+directory rewrites that one document however much is below it. Their `path`
+fields keep the value they were written with and go stale after a move.
+
+Clients still address directories by path, so paths are resolved to
+directory IDs, and back, through a cache of nodes: each directory's parent ID
+and name, plus the reverse (parent ID, name) -> ID. A cached child is only
+used if its node still names the same parent, so a rename or move updates one
+node and invalidates nothing else in the worker that made it. Other workers
+notice once their copies expire (TREE_CACHE_TTL), as with the listing cache;
+writes resolve with `fresh=True`, which re-reads the nodes along the path.
+
+Existing users are moved onto the new schema online by migrate_tree.py
+(see migrate_user()).
+"""
+import time
+
+from firebase_admin import firestore
+from google.api_core.exceptions import NotFound
+
+from datastore import BATCH_LIMIT, exists, get_all
+from directory_jobs import UNFINISHED_STATES
+from listing_cache import MemoryStore
+
+# Deepest directory chain followed before a tree is treated as corrupt
+MAX_DEPTH = 256
+
+# Values per Firestore 'in' filter
+IN_QUERY_LIMIT = 10
+
+# Once a user is on the ID schema they never go back, so that answer is kept longer
+SCHEMA_TTL = {'ids': 3600}
+
+
+class TreeConflict(ValueError):
+    pass
+
+
+def split_path(path):
+    """Names along a path, root first: '/a/b' -> ['a', 'b']"""
+    return [name for name in path.split('/') if name]
+
+
+def join_names(names):
+    return '/' + '/'.join(names)
+
+
+class DirectoryTree:
+    """Resolves paths and directory IDs through cached tree nodes"""
+
+    def __init__(self, db, max_entries, ttl, clock=time.monotonic):
+        self.db = db
+        self.ttl = ttl
+        self.clock = clock
+        # (uid, directory ID) -> (parent ID, name)
+        self.nodes = MemoryStore(max_entries)
+        # (uid, parent ID, name) -> directory ID, checked against `nodes` before use
+        self.children = MemoryStore(max_entries)
+        self.schemas = MemoryStore(max_entries)
+        self.hits = 0
+        self.misses = 0
+        self.reads = 0
+
+    def _directories(self, uid):
+        return self.db.collection('directories').where('user_id', '==', uid)
+
+    def schema(self, uid):
+        """The user's tree schema: 'ids', 'migrating', or 'paths' for users not migrated yet"""
+        schema = self.schemas.get(uid, self.clock())
+        if schema is None:
+            self.reads += 1
+            user = self.db.collection('users').document(uid).get()
+            schema = (user.to_dict().get('tree_schema') if user.exists else None) or 'paths'
+            self.schemas.put(uid, schema, self.clock() + SCHEMA_TTL.get(schema, self.ttl))
+        return schema
+
+    def uses_ids(self, uid):
+        return self.schema(uid) == 'ids'
+
+    def remember(self, uid, dir_id, parent_id, name):
+        """Cache one directory's place in the tree, e.g. after creating or moving it"""
+        expires_at = self.clock() + self.ttl
+        self.nodes.put(f"{uid}:{dir_id}", (parent_id, name), expires_at)
+        self.children.put(f"{uid}:{parent_id}/{name}", dir_id, expires_at)
+
+    def forget(self, uid, dir_id):
+        self.nodes.delete(f"{uid}:{dir_id}")
+
+    def _remember_snapshot(self, uid, snapshot):
+        if snapshot.exists and snapshot.get('user_id') == uid:
+            self.remember(uid, snapshot.id, snapshot.to_dict().get('parent_id'), snapshot.get('name'))
+            return True
+        return False
+
+    def _cached_child(self, uid, parent_id, name, now):
+        child_id = self.children.get(f"{uid}:{parent_id}/{name}", now)
+        # A moved or renamed directory leaves its old entry behind; its node tells
+        if child_id is not None and self.nodes.get(f"{uid}:{child_id}", now) == (parent_id, name):
+            return child_id
+        return None
+
+    def _cached_path(self, uid, dir_id):
+        """Path of a directory from cached nodes only, or None if any are missing"""
+        names = []
+        now = self.clock()
+        while dir_id is not None and len(names) <= MAX_DEPTH:
+            node = self.nodes.get(f"{uid}:{dir_id}", now)
+            if node is None:
+                return None
+            dir_id, name = node
+            names.append(name)
+        # The root directory's own name ('/') is not part of paths
+        return join_names(reversed(names[:-1])) if dir_id is None else None
+
+    def path_of(self, uid, dir_id):
+        """Current path of one of a user's directories, or None if it doesn't exist"""
+        path = self._cached_path(uid, dir_id)
+        if path is not None:
+            self.hits += 1
+            return path
+        self.misses += 1
+        names = []
+        while dir_id is not None:
+            if len(names) > MAX_DEPTH:
+                raise TreeConflict('Directory tree is too deep or has a cycle')
+            node = self.nodes.get(f"{uid}:{dir_id}", self.clock())
+            if node is None:
+                self.reads += 1
+                if not self._remember_snapshot(uid, self.db.collection('directories').document(dir_id).get()):
+                    return None
+                node = self.nodes.get(f"{uid}:{dir_id}", self.clock())
+            dir_id, name = node
+            names.append(name)
+        return join_names(reversed(names[:-1]))
+
+    def _root_id(self, uid):
+        root_id = self.children.get(f"{uid}:root", self.clock())
+        if root_id is None:
+            self.reads += 1
+            roots = self._directories(uid).where('path', '==', '/').limit(1).get()
+            if not roots:
+                return None
+            self._remember_snapshot(uid, roots[0])
+            root_id = roots[0].id
+            # The root never moves
+            self.children.put(f"{uid}:root", root_id, self.clock() + SCHEMA_TTL['ids'])
+        return root_id
+
+    def _walk(self, uid, names, use_cache):
+        """Follow `names` down from the root; returns (directory ID or None, whether all of it was cached)"""
+        dir_id = self._root_id(uid)
+        cached = True
+        now = self.clock()
+        for name in names:
+            if dir_id is None:
+                break
+            child_id = self._cached_child(uid, dir_id, name, now) if use_cache else None
+            if child_id is None:
+                cached = False
+                self.reads += 1
+                children = self._directories(uid).where('parent_id', '==', dir_id).where('name', '==', name).limit(1).get()
+                if children:
+                    self._remember_snapshot(uid, children[0])
+                child_id = children[0].id if children else None
+            dir_id = child_id
+        return dir_id, cached
+
+    def resolve(self, uid, path, fresh=False):
+        """
+        ID of the directory at `path`, or None if there is none.
+
+        With `fresh`, cached nodes along the path are checked against the
+        stored ones in one batched read before they are trusted, as writes
+        into the directory need it to be current.
+        """
+        names = split_path(path)
+        dir_id, cached = self._walk(uid, names, use_cache=True)
+        if cached:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if fresh and cached and dir_id is not None and not self._verify(uid, dir_id):
+            dir_id, _ = self._walk(uid, names, use_cache=False)
+        return dir_id
+
+    def _verify(self, uid, dir_id):
+        """Re-read the nodes from `dir_id` up to the root and check the cache agrees"""
+        chain = []
+        now = self.clock()
+        while dir_id is not None:
+            node = self.nodes.get(f"{uid}:{dir_id}", now)
+            if node is None:
+                return False
+            chain.append((dir_id, node))
+            dir_id = node[0]
+        self.reads += 1
+        snapshots = get_all(self.db, (self.db.collection('directories').document(node_id) for node_id, _ in chain))
+        for node_id, node in chain:
+            snapshot = snapshots[node_id]
+            if not snapshot.exists or (snapshot.to_dict().get('parent_id'), snapshot.get('name')) != node:
+                if not self._remember_snapshot(uid, snapshot):
+                    self.forget(uid, node_id)
+                return False
+        return True
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'nodes': len(self.nodes),
+            'children': len(self.children),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'reads': self.reads,
+            'ttl_seconds': self.ttl
+        }
+
+
+def subtree_directories(db, uid, dir_id):
+    """
+    Yield (relative path, directory ID) for a directory and everything below it.
+
+    The tree is walked a level at a time, with one query per 10 directories.
+    """
+    level = [('', dir_id)]
+    while level:
+        yield from level
+        relative = {dir_id: path for path, dir_id in level}
+        ids = list(relative)
+        next_level = []
+        for start in range(0, len(ids), IN_QUERY_LIMIT):
+            chunk = ids[start:start + IN_QUERY_LIMIT]
+            children = db.collection('directories').where('user_id', '==', uid).where('parent_id', 'in', chunk)
+            for child in children.select(['name', 'parent_id']).stream():
+                parent = relative[child.get('parent_id')]
+                next_level.append((f"{parent}/{child.get('name')}".lstrip('/'), child.id))
+        level = next_level
+
+
+def reparent_directory(db, uid, dir_id, parent_id, name):
+    """
+    Give a directory a new parent and/or name by rewriting only its own document.
+
+    Runs in a transaction that walks up from the new parent to the root, so a
+    directory can never be moved below itself even by concurrent moves.
+    Raises TreeConflict if the move is not possible.
+    """
+    if parent_id is None:
+        raise TreeConflict('Target directory not found')
+    directories = db.collection('directories')
+    dir_ref = directories.document(dir_id)
+
+    @firestore.transactional
+    def move(transaction):
+        directory = dir_ref.get(transaction=transaction)
+        if not directory.exists or directory.get('user_id') != uid:
+            raise TreeConflict('Directory not found')
+        if directory.to_dict().get('parent_id') is None:
+            raise TreeConflict('Cannot move the root directory')
+
+        ancestor_id = parent_id
+        for _ in range(MAX_DEPTH):
+            if ancestor_id is None:
+                break
+            if ancestor_id == dir_id:
+                raise TreeConflict('Cannot move a directory into itself')
+            ancestor = directories.document(ancestor_id).get(transaction=transaction)
+            if not ancestor.exists or ancestor.get('user_id') != uid:
+                raise TreeConflict('Target directory not found')
+            ancestor_id = ancestor.to_dict().get('parent_id')
+        else:
+            raise TreeConflict('Directory tree is too deep or has a cycle')
+
+        siblings = directories.where('user_id', '==', uid).where('parent_id', '==', parent_id).where('name', '==', name)
+        if len(list(transaction.get(siblings.limit(1)))) > 0:
+            raise TreeConflict('Directory already exists')
+
+        transaction.update(dir_ref, {'parent_id': parent_id, 'name': name})
+
+    move(db.transaction())
+
+
+def _update_existing(db, operations):
+    """Apply ('update', ref, data) operations, skipping documents deleted meanwhile"""
+    for start in range(0, len(operations), BATCH_LIMIT):
+        chunk = operations[start:start + BATCH_LIMIT]
+        batch = db.batch()
+        for _, ref, data in chunk:
+            batch.update(ref, data)
+        try:
+            batch.commit()
+        except NotFound:
+            for _, ref, data in chunk:
+                try:
+                    ref.update(data)
+                except NotFound:
+                    pass
+
+
+def start_migration(db, uid):
+    """
+    Put a user into the 'migrating' state, or return False if already migrated.
+
+    Path-based moves are refused in that state, which keeps the paths that
+    migrate_user() reads from stable. Wait at least TREE_CACHE_TTL before
+    migrating, so that every worker has seen the state.
+    """
+    user_ref = db.collection('users').document(uid)
+    user = user_ref.get()
+    if user.exists and user.to_dict().get('tree_schema') == 'ids':
+        return False
+
+    _check_no_jobs(db, uid)
+    user_ref.set({'tree_schema': 'migrating'}, merge=True)
+    return True
+
+
+def _check_no_jobs(db, uid):
+    if exists(db.collection('jobs').where('user_id', '==', uid).where('state', 'in', UNFINISHED_STATES)):
+        raise RuntimeError(f"{uid}: has unfinished directory jobs; finish or resume them first")
+
+
+def migrate_user(db, uid, log=print):
+    """
+    Move a user in the 'migrating' state onto the ID schema while the app keeps serving them.
+
+    New directories and files already get a `parent_id`, so this backfills
+    the ones written before that from their paths, then switches the user over.
+    """
+    # A move may have started in a worker that hadn't seen the state yet
+    _check_no_jobs(db, uid)
+
+    directories = {
+        directory.get('path'): directory
+        for directory in db.collection('directories').where('user_id', '==', uid)
+        .select(['path', 'parent_path', 'parent_id']).stream()
+    }
+    operations = []
+    orphans = 0
+    for directory in directories.values():
+        dir_data = directory.to_dict()
+        parent_path = dir_data.get('parent_path')
+        if parent_path is None:
+            parent_id = None
+        elif parent_path in directories:
+            parent_id = directories[parent_path].id
+        else:
+            orphans += 1
+            continue
+        if 'parent_id' not in dir_data or dir_data['parent_id'] != parent_id:
+            operations.append(('update', directory.reference, {'parent_id': parent_id}))
+
+    for file in db.collection('files').where('user_id', '==', uid).select(['path', 'parent_id']).stream():
+        file_data = file.to_dict()
+        if file_data.get('path') not in directories:
+            orphans += 1
+            continue
+        parent_id = directories[file_data['path']].id
+        if file_data.get('parent_id') != parent_id:
+            operations.append(('update', file.reference, {'parent_id': parent_id}))
+
+    _update_existing(db, operations)
+    db.collection('users').document(uid).set({'tree_schema': 'ids'}, merge=True)
+    log(f"{uid}: linked {len(operations)} documents, skipped {orphans} without a parent directory")
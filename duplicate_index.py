@@ -0,0 +1,320 @@
+"""
+Duplicate file index for Dropbox Clone
+
+Keeps one `hash_files/{uid}_{hash}_{file_id}` document per file, recording
+its content hash and the directory it is in, plus counters of how many of a
+user's files have each hash (`hash_groups/{uid}_{hash}`) and how many of
+those are in each directory (`hash_group_paths`). Index documents are written
+in the same transaction that creates, moves or deletes the file record, and
+counters only ever get increments, so files with the same content never
+contend for one document and no document grows with the number of files.
+Finding duplicates reads the counters above 1 and then just those groups'
+files, instead of scanning every file the user has.
+
+Users whose files predate the index (or its per-file layout) are indexed on
+their first duplicate search (see ensure_index()).
+
+Deleting a file also flags the shares of it as `file_missing` in the same
+transaction, so listing a user's shares never has to check storage, and
+creating or deleting one updates the user's usage counters (see usage.py).
+"""
+import hashlib
+from collections import Counter, defaultdict, namedtuple
+
+from firebase_admin import firestore
+
+from blob_store import release_references
+from datastore import get_all
+from usage import counter_writes
+
+# Value of the user's `duplicate_index` field once their files are indexed
+INDEX_READY = 'per_file'
+
+# Files indexed per transaction when rebuilding a user's index
+REBUILD_BATCH = 100
+
+# Values per Firestore 'in' filter
+IN_QUERY_LIMIT = 10
+
+# What update_files() did: the file snapshots it deleted, the IDs of the
+# shares it flagged, and content left without references (see blob_store.py)
+FileUpdate = namedtuple('FileUpdate', ['deleted', 'share_ids', 'orphans'])
+
+
+def entry_ref(db, uid, file_hash, file_id):
+    """Firestore reference of a file's index entry"""
+    return db.collection('hash_files').document(f"{uid}_{file_hash}_{file_id}")
+
+
+def group_ref(db, uid, file_hash):
+    """Firestore reference of the counter of a user's files with one hash"""
+    return db.collection('hash_groups').document(f"{uid}_{file_hash}")
+
+
+def group_path_ref(db, uid, file_hash, path):
+    """Firestore reference of the counter of a user's files with one hash in one directory"""
+    # Paths contain slashes, which document IDs can't
+    path_key = hashlib.md5(path.encode()).hexdigest()
+    return db.collection('hash_group_paths').document(f"{uid}_{file_hash}_{path_key}")
+
+
+def _count_writes(db, uid, changes):
+    """
+    Transaction writes applying (hash, path, files) deltas to the group counters.
+
+    Returns ('set', ref, data, True) operations, as counter_writes() does.
+    """
+    groups = Counter()
+    paths = Counter()
+    for file_hash, path, count in changes:
+        groups[file_hash] += count
+        paths[file_hash, path] += count
+    writes = [
+        ('set', group_ref(db, uid, file_hash),
+         {'user_id': uid, 'hash': file_hash, 'count': firestore.Increment(count)}, True)
+        for file_hash, count in groups.items() if count
+    ]
+    writes.extend(
+        ('set', group_path_ref(db, uid, file_hash, path),
+         {'user_id': uid, 'hash': file_hash, 'path': path, 'count': firestore.Increment(count)}, True)
+        for (file_hash, path), count in paths.items() if count
+    )
+    return writes
+
+
+def _entry(uid, file_hash, file_id, path):
+    return {'user_id': uid, 'hash': file_hash, 'file_id': file_id, 'path': path}
+
+
+def create_file(db, file_ref, file_data):
+    """Create a file record, adding it to the duplicate index and the usage counters, atomically"""
+    uid = file_data['user_id']
+    file_hash = file_data['hash']
+    ref = entry_ref(db, uid, file_hash, file_ref.id)
+
+    @firestore.transactional
+    def create(transaction):
+        # Reading only this file's own entry keeps a retried create from counting it twice
+        entry = ref.get(transaction=transaction)
+        changes = [(file_hash, file_data['path'], 1)]
+        if entry.exists:
+            changes.append((file_hash, entry.get('path'), -1))
+        transaction.set(file_ref, file_data)
+        transaction.set(ref, _entry(uid, file_hash, file_ref.id, file_data['path']))
+        writes = _count_writes(db, uid, changes)
+        if not entry.exists:
+            writes += counter_writes(db, uid, [(file_data.get('parent_id'), file_data.get('size'), 1)])
+        for method, *args in writes:
+            getattr(transaction, method)(*args)
+
+    create(db.transaction())
+
+
+def delete_files(db, uid, snapshots):
+    """
+    Delete file records, removing them from the index, flagging their shares
+    and dropping their references to shared content, atomically.
+
+    Returns a FileUpdate; only the files in its `deleted` were deleted by
+    this call, so only their bytes are the caller's to delete.
+    """
+    return update_files(db, uid, deleted=snapshots, release=True)
+
+
+def _share_queries(db, file_ids):
+    for start in range(0, len(file_ids), IN_QUERY_LIMIT):
+        yield db.collection('shared_files').where('file_id', 'in', file_ids[start:start + IN_QUERY_LIMIT])
+
+
+def update_files(db, uid, deleted=(), moved=(), writes=(), release=False):
+    """
+    Delete and move file records, keeping the index in step, in one transaction.
+
+    `deleted` holds file snapshots to delete; shares of them are flagged
+    `file_missing` and their sizes come off the usage counters. `moved` holds
+    (snapshot, updates) pairs, where `updates` includes the file's new 'path'.
+    `writes` are extra WriteBatch-style operations, e.g. ('update', ref,
+    data), committed with them, or a function of the file snapshots deleted
+    and the orphaned content that returns them. With `release`, the deleted
+    files' references to content-addressed blobs are dropped too.
+
+    The files are read again in the transaction, and files already deleted
+    meanwhile (e.g. by a retried or concurrent request) are skipped, so they
+    are never counted off or released twice.
+
+    Returns a FileUpdate.
+    """
+    deleted = list(deleted)
+    moved = list(moved)
+    if not deleted and not moved and not writes:
+        return FileUpdate([], [], [])
+    updates_of = {snapshot.id: updates for snapshot, updates in moved}
+
+    @firestore.transactional
+    def update(transaction):
+        # Transactions must read everything before writing
+        files = deleted + [snapshot for snapshot, _ in moved]
+        current = {
+            snapshot.id: snapshot
+            for snapshot in transaction.get_all([snapshot.reference for snapshot in files]) if snapshot.exists
+        }
+        gone = [current[snapshot.id] for snapshot in deleted if snapshot.id in current]
+        moving = [(current[snapshot.id], updates_of[snapshot.id]) for snapshot, _ in moved if snapshot.id in current]
+        refs = [entry_ref(db, uid, snapshot.get('hash'), snapshot.id) for snapshot in current.values()]
+        entries = {entry.get('file_id'): entry for entry in transaction.get_all(refs) if entry.exists}
+        shares = [
+            share for query in _share_queries(db, [snapshot.id for snapshot in gone])
+            for share in transaction.get(query)
+        ]
+        release_writes, orphans = release_references(
+            transaction, db, [snapshot.to_dict() for snapshot in gone]
+        ) if release else ([], [])
+
+        usage_changes = []
+        count_changes = []
+        for snapshot in gone:
+            file_data = snapshot.to_dict()
+            transaction.delete(snapshot.reference)
+            usage_changes.append((file_data.get('parent_id'), -(file_data.get('size') or 0), -1))
+            entry = entries.get(snapshot.id)
+            if entry is not None:
+                transaction.delete(entry.reference)
+                count_changes.append((entry.get('hash'), entry.get('path'), -1))
+        for share in shares:
+            if not share.to_dict().get('file_missing'):
+                transaction.update(share.reference, {'file_missing': True})
+        for snapshot, updates in moving:
+            file_data = snapshot.to_dict()
+            transaction.update(snapshot.reference, updates)
+            if updates.get('parent_id', file_data.get('parent_id')) != file_data.get('parent_id'):
+                # Only the directories' counters change; the user's total nets out
+                usage_changes.append((file_data.get('parent_id'), -(file_data.get('size') or 0), -1))
+                usage_changes.append((updates['parent_id'], file_data.get('size') or 0, 1))
+            entry = entries.get(snapshot.id)
+            if entry is not None and entry.get('path') != updates['path']:
+                transaction.update(entry.reference, {'path': updates['path']})
+                count_changes.append((entry.get('hash'), entry.get('path'), -1))
+                count_changes.append((entry.get('hash'), updates['path'], 1))
+        operations = writes(gone, orphans) if callable(writes) else list(writes)
+        operations += release_writes + counter_writes(db, uid, usage_changes) + _count_writes(db, uid, count_changes)
+        for method, *args in operations:
+            getattr(transaction, method)(*args)
+        return FileUpdate(gone, [share.id for share in shares], orphans)
+
+    return update(db.transaction())
+
+
+def _forget(db, uid, entries):
+    """Drop index entries of files that no longer exist"""
+    @firestore.transactional
+    def forget(transaction):
+        current = [entry for entry in transaction.get_all([entry.reference for entry in entries]) if entry.exists]
+        for entry in current:
+            transaction.delete(entry.reference)
+        for method, *args in _count_writes(db, uid, [(entry.get('hash'), entry.get('path'), -1) for entry in current]):
+            getattr(transaction, method)(*args)
+
+    forget(db.transaction())
+
+
+def _entries(db, uid, file_hashes, path=None):
+    """Index entries of a user's files with any of `file_hashes`, optionally only those in one directory"""
+    for start in range(0, len(file_hashes), IN_QUERY_LIMIT):
+        query = (db.collection('hash_files').where('user_id', '==', uid)
+                 .where('hash', 'in', file_hashes[start:start + IN_QUERY_LIMIT]))
+        if path is not None:
+            query = query.where('path', '==', path)
+        yield from query.stream()
+
+
+def _expand(db, uid, file_hashes, path=None):
+    """
+    Turn the hashes of groups into lists of file data, batching reads.
+
+    Entries whose file record is gone are dropped from the index; groups
+    left with fewer than 2 files are skipped.
+    """
+    entries = list(_entries(db, uid, file_hashes, path))
+    snapshots = get_all(db, (db.collection('files').document(entry.get('file_id')) for entry in entries))
+    groups = defaultdict(list)
+    missing = []
+    for entry in entries:
+        snapshot = snapshots[entry.get('file_id')]
+        if snapshot.exists:
+            file_data = snapshot.to_dict()
+            file_data['id'] = snapshot.id
+            groups[entry.get('hash')].append(file_data)
+        else:
+            missing.append(entry)
+    if missing:
+        _forget(db, uid, missing)
+    for file_hash in file_hashes:
+        if len(groups[file_hash]) > 1:
+            yield groups[file_hash]
+
+
+def _batched(db, uid, counters, path=None):
+    batch = []
+    for counter in counters:
+        batch.append(counter.get('hash'))
+        if len(batch) >= IN_QUERY_LIMIT:
+            yield from _expand(db, uid, batch, path)
+            batch = []
+    if batch:
+        yield from _expand(db, uid, batch, path)
+
+
+def duplicate_groups(db, uid):
+    """Yield lists of a user's files that share a hash, 2 or more per list"""
+    counters = db.collection('hash_groups').where('user_id', '==', uid).where('count', '>', 1).stream()
+    return _batched(db, uid, counters)
+
+
+def directory_duplicates(db, uid, path):
+    """Yield lists of files in one directory that share a hash, 2 or more per list"""
+    counters = (db.collection('hash_group_paths').where('user_id', '==', uid).where('path', '==', path)
+                .where('count', '>', 1).stream())
+    return _batched(db, uid, counters, path)
+
+
+def _index_batch(db, uid, scanned):
+    """Add entries for scanned (file ID, hash, path) triples that have none yet"""
+    @firestore.transactional
+    def merge(transaction):
+        refs = [entry_ref(db, uid, file_hash, file_id) for file_id, file_hash, _ in scanned]
+        known = {entry.id for entry in transaction.get_all(refs) if entry.exists}
+        added = [
+            (ref, file_id, file_hash, path) for ref, (file_id, file_hash, path) in zip(refs, scanned)
+            if ref.id not in known
+        ]
+        for ref, file_id, file_hash, path in added:
+            transaction.set(ref, _entry(uid, file_hash, file_id, path))
+        for method, *args in _count_writes(db, uid, [(file_hash, path, 1) for _, _, file_hash, path in added]):
+            getattr(transaction, method)(*args)
+
+    merge(db.transaction())
+
+
+def rebuild_index(db, uid):
+    """Index every file a user has, merging with entries written meanwhile"""
+    scanned = []
+    for file in db.collection('files').where('user_id', '==', uid).select(['hash', 'path']).stream():
+        scanned.append((file.id, file.get('hash'), file.get('path')))
+        if len(scanned) >= REBUILD_BATCH:
+            _index_batch(db, uid, scanned)
+            scanned = []
+    if scanned:
+        _index_batch(db, uid, scanned)
+
+
+def ensure_index(db, uid):
+    """Build a user's index on first use if their files predate it"""
+    user_ref = db.collection('users').document(uid)
+    user = user_ref.get()
+    if user.exists and user.to_dict().get('duplicate_index') == INDEX_READY:
+        return
+    # Writes keep the index up to date from here on, so a file added during
+    # the scan is either seen by it or merged in by create_file()
+    user_ref.set({'duplicate_index': 'building'}, merge=True)
+    rebuild_index(db, uid)
+    user_ref.set({'duplicate_index': INDEX_READY}, merge=True)
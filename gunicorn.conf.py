@@ -0,0 +1,39 @@
+"""
+Gunicorn settings for Dropbox Clone
+
+Workers are threaded (gthread) by default: a request blocked on a Firestore
+or Storage round trip holds one thread, not the whole worker process.
+GUNICORN_WORKER_CLASS=sync restores one request per worker at a time.
+
+The app is imported once, in the master, and workers are forked from it
+with the code already loaded (GUNICORN_PRELOAD=false imports it in each
+worker instead). Importing the app opens no connections. The master loads
+the client libraries and credentials, and each worker opens its own
+connections as soon as it is forked, before it takes requests.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Streamed downloads and long uploads keep a request open well past 30s
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        from app import backend
+        backend.prepare()
+
+
+def post_fork(server, worker):
+    from app import backend
+    try:
+        backend.warm_up()
+    except Exception as e:
+        # The first request connects instead
+        server.log.warning(f"Worker {worker.pid} could not warm up its connections: {e}")
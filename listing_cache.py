@@ -0,0 +1,193 @@
+"""
+Directory listing cache for Dropbox Clone
+
+Caches each user's directory and file listings, keyed by (uid, kind, path),
+so browsing a tree that hasn't changed costs no Firestore reads. Entries
+expire after a TTL and the cache holds a bounded number of them. Routes
+that change a directory's contents invalidate its entries.
+
+By default the cache lives in each worker's memory, so a change made through
+one worker can be served stale by another for up to the TTL. Setting
+LISTING_CACHE_PATH puts the cache in a SQLite file shared by every worker on
+the host instead, which makes invalidation visible to all of them.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import json
+
+
+class MemoryStore:
+    """In-process LRU store"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, expires_at):
+        """Store a value, returning how many entries were evicted to make room"""
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            evicted = 0
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteStore:
+    """Store in a SQLite file shared by every worker process on the host"""
+
+    # Trimming counts the table, so it only runs every this many writes
+    TRIM_INTERVAL = 64
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connection(self):
+        # One connection per thread, and a fresh one after a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS listing_cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key, now):
+        row = self._connection().execute(
+            'SELECT value FROM listing_cache WHERE key = ? AND expires_at > ?', (key, now)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, value, expires_at):
+        connection = self._connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO listing_cache (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(value), expires_at)
+        )
+        self._writes += 1
+        if self._writes % self.TRIM_INTERVAL:
+            return 0
+
+        # Trim the entries closest to expiry once the table is over its bound
+        evicted = connection.execute(
+            'DELETE FROM listing_cache WHERE key IN ('
+            'SELECT key FROM listing_cache ORDER BY expires_at LIMIT '
+            'max(0, (SELECT count(*) FROM listing_cache) - ?))', (self.max_entries,)
+        ).rowcount
+        return max(evicted, 0)
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM listing_cache WHERE key = ?', (key,))
+
+    def delete_prefix(self, prefix):
+        self._connection().execute(
+            'DELETE FROM listing_cache WHERE substr(key, 1, ?) = ?', (len(prefix), prefix)
+        )
+
+    def __len__(self):
+        return self._connection().execute('SELECT count(*) FROM listing_cache').fetchone()[0]
+
+
+class ListingCache:
+    """TTL cache of per-user listings with hit/miss counters"""
+
+    # Separates key parts; can't appear in a uid or a path
+    SEPARATOR = '\x1f'
+
+    def __init__(self, store, ttl, clock=time.monotonic):
+        self.store = store
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _key(self, uid, kind, path):
+        return self.SEPARATOR.join((uid, kind, path)) if kind else uid + self.SEPARATOR
+
+    def get(self, uid, kind, path):
+        """Return a cached listing, or None on a miss"""
+        value = self.store.get(self._key(uid, kind, path), self.clock())
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, uid, kind, path, value):
+        self.evictions += self.store.put(self._key(uid, kind, path), value, self.clock() + self.ttl)
+
+    def get_or_load(self, uid, kind, path, load):
+        """Return a cached listing, calling `load()` to fill it on a miss"""
+        value = self.get(uid, kind, path)
+        if value is None:
+            value = load()
+            self.put(uid, kind, path, value)
+        return value
+
+    def invalidate(self, uid, kind=None, path=None):
+        """Drop one cached listing, or every listing of a user if no kind is given"""
+        self.invalidations += 1
+        if kind is None:
+            self.store.delete_prefix(self._key(uid, None, None))
+        else:
+            self.store.delete(self._key(uid, kind, path))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.store),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'ttl_seconds': self.ttl
+        }
+
+
+def create_listing_cache(max_entries, ttl, path=None):
+    """Build the listing cache, shared through SQLite if a path is given"""
+    store = SQLiteStore(path, max_entries) if path else MemoryStore(max_entries)
+    # A shared store compares expiry times across processes, so it needs wall-clock time
+    return ListingCache(store, ttl, clock=time.time if path else time.monotonic)
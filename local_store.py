@@ -0,0 +1,627 @@
+"""
+Local disk backend for Dropbox Clone
+
+Runs the app without Firebase. The metadata goes in a SQLite database and the
+file bytes go in a directory tree on local disk. Each side implements the
+part of the Firestore client API or the Cloud Storage bucket API that the
+app uses, so the routes and helpers work unchanged (see backends.py).
+
+SQLiteFirestore keeps each document as JSON in one table. Filters, ordering
+and cursors become SQL over json_extract(), and expression indexes cover
+the fields the app filters on. Batches and transactions run inside
+BEGIN IMMEDIATE. This serializes them across every worker process on the
+host, so the atomicity the app relies on in Firestore holds here too.
+
+LocalBucket stores each blob as a file and writes through a temporary file,
+so readers never see a partial blob. Its signed URLs point back at the app
+(/local-storage), which checks their HMAC signature and expiry and serves
+the file with send_file(). Under gunicorn that goes out through sendfile(),
+so the bytes never pass through Python. Copies use shutil.copyfile(), which
+uses the kernel's zero-copy path on Linux as well.
+"""
+import contextlib
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import quote, urlencode
+
+from google.api_core.exceptions import AlreadyExists, NotFound, PreconditionFailed
+from google.cloud.firestore_v1 import transforms
+
+# Datetimes are stored as tagged UTC strings of fixed width, which sort in time order
+TIME_TAG = '\x1ftime:'
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Fields queried together; each gets an expression index
+INDEXED_FIELDS = [
+    ('user_id', 'parent_id'),
+    ('user_id', 'path'),
+    ('user_id', 'parent_path'),
+    ('user_id', 'state'),
+    ('user_id', 'count'),
+    ('shared_with', 'expires_at'),
+    ('expires_at',),
+    ('file_id',),
+    ('email',),
+]
+
+RANGE_OPERATORS = {'<', '<=', '>', '>=', '!='}
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return TIME_TAG + value.strftime(TIME_FORMAT)
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, str) and value.startswith(TIME_TAG):
+        parsed = datetime.datetime.strptime(value[len(TIME_TAG):], TIME_FORMAT)
+        return parsed.replace(tzinfo=datetime.timezone.utc)
+    if isinstance(value, dict):
+        return {key: _decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+def _field(field):
+    if field == '__name__':
+        return 'id'
+    return f"json_extract(data, '$.\"{field}\"')"
+
+
+class Snapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def get(self, field):
+        value = self._data
+        for part in field.split('.'):
+            if not isinstance(value, dict) or part not in value:
+                raise KeyError(field)
+            value = value[part]
+        return value
+
+    def to_dict(self):
+        return None if self._data is None else dict(self._data)
+
+
+class DocumentReference:
+    def __init__(self, db, collection, doc_id):
+        self._db = db
+        self._collection = collection
+        self.id = doc_id
+
+    @property
+    def path(self):
+        return f"{self._collection}/{self.id}"
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def collection(self, name):
+        return CollectionReference(self._db, f"{self.path}/{name}")
+
+    def get(self, transaction=None):
+        return self._db.get_all([self])[0]
+
+    def set(self, data, merge=False):
+        self._db._apply([(self, 'set', data, merge)])
+
+    def create(self, data):
+        self._db._apply([(self, 'create', data, False)])
+
+    def update(self, data):
+        self._db._apply([(self, 'update', data, False)])
+
+    def delete(self):
+        self._db._apply([(self, 'delete', None, False)])
+
+
+class Query:
+    def __init__(self, db, collection, filters=(), orders=(), limit=None, fields=None, after=None):
+        self._db = db
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._fields = fields
+        self._after = after
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, orders=self._orders, limit=self._limit,
+                     fields=self._fields, after=self._after)
+        state.update(changes)
+        return Query(self._db, self._collection, **state)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def start_after(self, values):
+        return self._copy(after=values)
+
+    def count(self):
+        return Aggregation(self)
+
+    def _sql(self, columns):
+        """The SELECT statement and its parameters"""
+        clauses = ['collection = ?']
+        params = [self._collection]
+        for field, op, value in self._filters:
+            expression = _field(field)
+            if op == '==' and value is None:
+                clauses.append(f"json_type(data, '$.\"{field}\"') = 'null'")
+            elif op == '==':
+                clauses.append(f"{expression} = ?")
+                params.append(_encode(value))
+            elif op == 'in':
+                values = list(value)
+                clauses.append(f"{expression} IN ({', '.join('?' * len(values))})" if values else '0')
+                params.extend(_encode(item) for item in values)
+            elif op == 'array_contains':
+                clauses.append(f"EXISTS (SELECT 1 FROM json_each(data, '$.\"{field}\"') WHERE value = ?)")
+                params.append(_encode(value))
+            elif op in RANGE_OPERATORS:
+                clauses.append(f"{expression} IS NOT NULL AND {expression} {op} ?")
+                params.append(_encode(value))
+            else:
+                raise ValueError(f"Unsupported operator: {op}")
+
+        # Like Firestore, ordering on a field leaves out documents without it,
+        # and the document ID breaks ties in the direction of the last order
+        orders = list(self._orders)
+        if not orders or orders[-1][0] != '__name__':
+            orders.append(('__name__', orders[-1][1] if orders else 'ASCENDING'))
+        for field, _ in orders:
+            if field != '__name__':
+                clauses.append(f"json_type(data, '$.\"{field}\"') IS NOT NULL")
+
+        if self._after is not None:
+            # Cursors assume every order runs in the same direction, as the app's queries do
+            values = []
+            for field, _ in orders:
+                value = self._after[field]
+                values.append(getattr(value, 'id', value) if field == '__name__' else _encode(value))
+            op = '<' if orders[0][1] == 'DESCENDING' else '>'
+            expressions = ', '.join(_field(field) for field, _ in orders)
+            clauses.append(f"({expressions}) {op} ({', '.join('?' * len(values))})")
+            params.extend(values)
+
+        # Unary + keeps SQLite from walking the primary key in ID order instead of using a filter's index
+        sql = f"SELECT {columns} FROM documents WHERE {' AND '.join(clauses)} ORDER BY " + ', '.join(
+            f"+{_field(field)} {'DESC' if direction == 'DESCENDING' else 'ASC'}" for field, direction in orders
+        )
+        if self._limit is not None:
+            sql += ' LIMIT ?'
+            params.append(self._limit)
+        return sql, params
+
+    def _run(self):
+        sql, params = self._sql('id, data')
+        rows = self._db._connection().execute(sql, params).fetchall()
+        collection = CollectionReference(self._db, self._collection)
+        return [self._db._snapshot(collection.document(doc_id), data, self._fields) for doc_id, data in rows]
+
+    def get(self, transaction=None):
+        return self._run()
+
+    def stream(self, transaction=None):
+        return iter(self._run())
+
+
+class CollectionReference(Query):
+    def __init__(self, db, name):
+        super().__init__(db, name)
+        self.id = name.rsplit('/', 1)[-1]
+
+    def document(self, doc_id=None):
+        return DocumentReference(self._db, self._collection, doc_id or uuid.uuid4().hex[:20])
+
+
+class _AggregationResult:
+    def __init__(self, value):
+        self.value = value
+
+
+class Aggregation:
+    def __init__(self, query):
+        self._query = query
+
+    def get(self, transaction=None):
+        sql, params = self._query._sql('1')
+        count = self._query._db._connection().execute(f"SELECT count(*) FROM ({sql})", params).fetchone()[0]
+        return [[_AggregationResult(count)]]
+
+
+class WriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._operations = []
+
+    def set(self, ref, data, merge=False):
+        self._operations.append((ref, 'set', data, merge))
+
+    def create(self, ref, data):
+        self._operations.append((ref, 'create', data, False))
+
+    def update(self, ref, data):
+        self._operations.append((ref, 'update', data, False))
+
+    def delete(self, ref):
+        self._operations.append((ref, 'delete', None, False))
+
+    def commit(self):
+        self._db._apply(self._operations)
+        self._operations = []
+
+
+class Transaction(WriteBatch):
+    """
+    A transaction that firestore.transactional can drive.
+
+    It holds the database's write lock from the first read to the commit, so
+    it never conflicts and never needs retrying.
+    """
+
+    _read_only = False
+    _max_attempts = 1
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._id = None
+
+    def _clean_up(self):
+        self._operations = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._db._connection().execute('BEGIN IMMEDIATE')
+        self._id = uuid.uuid4().bytes
+
+    def _commit(self):
+        self._db._apply(self._operations)
+        self._db._connection().execute('COMMIT')
+        self._clean_up()
+        return []
+
+    def _rollback(self):
+        connection = self._db._connection()
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        self._clean_up()
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, DocumentReference):
+            return ref_or_query.get()
+        return ref_or_query.stream()
+
+    def get_all(self, refs):
+        return self._db.get_all(refs)
+
+
+class SQLiteFirestore:
+    """A Firestore client keeping every document in a SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # One connection per thread, and a fresh one after a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS documents ('
+                'collection TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL, '
+                'PRIMARY KEY (collection, id))'
+            )
+            for fields in INDEXED_FIELDS:
+                connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS by_{'_'.join(fields)} ON documents "
+                    f"(collection, {', '.join(_field(field) for field in fields)})"
+                )
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def collection(self, name):
+        return CollectionReference(self, name)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return Transaction(self)
+
+    def _snapshot(self, ref, data, fields=None):
+        data = None if data is None else _decode(json.loads(data))
+        if data is not None and fields is not None:
+            data = {field: data[field] for field in fields if field in data}
+        return Snapshot(ref, data)
+
+    def _read(self, ref):
+        row = self._connection().execute(
+            'SELECT data FROM documents WHERE collection = ? AND id = ?', (ref._collection, ref.id)
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_all(self, refs):
+        return [self._snapshot(ref, self._read(ref)) for ref in refs]
+
+    def _resolve(self, value, old):
+        if value is transforms.SERVER_TIMESTAMP:
+            return datetime.datetime.now(datetime.timezone.utc)
+        if isinstance(value, transforms.Increment):
+            return (old or 0) + value.value
+        return value
+
+    def _apply(self, operations):
+        """Apply (ref, method, data, merge) writes atomically, inside the open transaction if there is one"""
+        connection = self._connection()
+        own = not connection.in_transaction
+        if own:
+            connection.execute('BEGIN IMMEDIATE')
+        try:
+            for ref, method, data, merge in operations:
+                self._write(connection, ref, method, data, merge)
+            if own:
+                connection.execute('COMMIT')
+        except BaseException:
+            if own:
+                connection.execute('ROLLBACK')
+            raise
+
+    def _write(self, connection, ref, method, data, merge):
+        old = self._read(ref)
+        if method == 'delete':
+            connection.execute('DELETE FROM documents WHERE collection = ? AND id = ?', (ref._collection, ref.id))
+            return
+        if method == 'update' and old is None:
+            raise NotFound(f"No document to update: {ref.path}")
+        if method == 'create' and old is not None:
+            raise AlreadyExists(f"Document already exists: {ref.path}")
+        new = _decode(json.loads(old)) if old is not None and (merge or method == 'update') else {}
+        for field, value in data.items():
+            if value is transforms.DELETE_FIELD:
+                new.pop(field, None)
+            else:
+                new[field] = self._resolve(value, new.get(field))
+        connection.execute(
+            'INSERT OR REPLACE INTO documents (collection, id, data) VALUES (?, ?, ?)',
+            (ref._collection, ref.id, json.dumps(_encode(new)))
+        )
+
+
+def _blob_path(root, name):
+    """
+    File path of a blob. Each part of the name is escaped, so names that differ
+    only in empty or dot parts (e.g. 'uid//a' and 'uid/a') stay apart.
+    """
+    parts = []
+    for part in name.split('/'):
+        part = quote(part, safe='')
+        parts.append('@' if part == '' else part.replace('.', '%2E') if part in ('.', '..') else part)
+    return os.path.join(root, *parts)
+
+
+class _AtomicWriter:
+    """Write to a temporary file and move it into place on close, so readers never see a partial blob"""
+
+    def __init__(self, path, temp_dir):
+        self._path = path
+        self._temp = os.path.join(temp_dir, uuid.uuid4().hex)
+        self._file = open(self._temp, 'wb')
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        os.replace(self._temp, self._path)
+
+    def discard(self):
+        self._file.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._temp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+
+    @property
+    def _path(self):
+        return _blob_path(self.bucket.blob_root, self.name)
+
+    @property
+    def generation(self):
+        """The file's modification time stands in for Cloud Storage's generation number"""
+        try:
+            return os.stat(self._path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @property
+    def size(self):
+        try:
+            return os.stat(self._path).st_size
+        except FileNotFoundError:
+            return None
+
+    def exists(self):
+        return os.path.exists(self._path)
+
+    def delete(self, if_generation_match=None):
+        if if_generation_match is not None and self.generation not in (None, if_generation_match):
+            raise PreconditionFailed(f"Generation of {self.name} has changed")
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            raise NotFound(f"No such blob: {self.name}")
+
+    def open(self, mode='rb', chunk_size=None, content_type=None):
+        if mode == 'rb':
+            try:
+                return open(self._path, 'rb')
+            except FileNotFoundError:
+                raise NotFound(f"No such blob: {self.name}")
+        if mode == 'wb':
+            return _AtomicWriter(self._path, self.bucket.temp_root)
+        raise ValueError(f"Unsupported mode: {mode}")
+
+    def upload_from_string(self, data, content_type=None):
+        if isinstance(data, str):
+            data = data.encode()
+        with self.open('wb') as writer:
+            writer.write(data)
+
+    def download_as_bytes(self):
+        with self.open('rb') as reader:
+            return reader.read()
+
+    def compose(self, sources):
+        with self.open('wb') as writer:
+            for source in sources:
+                with source.open('rb') as reader:
+                    shutil.copyfileobj(reader, writer._file)
+
+    def generate_signed_url(self, version='v4', expiration=None, method='GET', response_disposition=None):
+        if isinstance(expiration, datetime.timedelta):
+            expiration = expiration.total_seconds()
+        expires = int(time.time() + (expiration or 3600))
+        return self.bucket.signed_url(self.name, expires, response_disposition)
+
+
+class LocalBucket:
+    """A Cloud Storage bucket keeping every blob as a file under `root`"""
+
+    def __init__(self, root, secret, url_path='/local-storage'):
+        self.blob_root = os.path.join(root, 'blobs')
+        self.temp_root = os.path.join(root, 'tmp')
+        os.makedirs(self.blob_root, exist_ok=True)
+        os.makedirs(self.temp_root, exist_ok=True)
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.url_path = url_path
+        # Stands in for bucket.client, which only batches deletes
+        self.client = self
+
+    def batch(self):
+        return contextlib.nullcontext()
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        blob = LocalBlob(self, name)
+        return blob if blob.exists() else None
+
+    def copy_blob(self, blob, destination_bucket, new_name):
+        copy = destination_bucket.blob(new_name)
+        temp = os.path.join(self.temp_root, uuid.uuid4().hex)
+        try:
+            shutil.copyfile(blob._path, temp)
+        except FileNotFoundError:
+            raise NotFound(f"No such blob: {blob.name}")
+        os.makedirs(os.path.dirname(copy._path), exist_ok=True)
+        os.replace(temp, copy._path)
+        return copy
+
+    def _signature(self, name, expires, disposition):
+        message = f"{name}\n{expires}\n{disposition or ''}".encode()
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def signed_url(self, name, expires, disposition=None):
+        params = {'name': name, 'expires': expires, 'signature': self._signature(name, expires, disposition)}
+        if disposition:
+            params['disposition'] = disposition
+        return f"{self.url_path}?{urlencode(params)}"
+
+    def verify(self, args):
+        """
+        Check a signed URL's query arguments.
+
+        Returns (file path, Content-Disposition) for a valid, unexpired URL
+        whose blob exists, otherwise None.
+        """
+        name = args.get('name', '')
+        disposition = args.get('disposition')
+        try:
+            expires = int(args.get('expires', ''))
+        except ValueError:
+            return None
+        expected = self._signature(name, expires, disposition)
+        if not hmac.compare_digest(expected, args.get('signature', '')) or expires < time.time():
+            return None
+        path = _blob_path(self.blob_root, name)
+        if not os.path.isfile(path):
+            return None
+        return path, disposition
+
+
+def load_secret(root):
+    """The URL signing key shared by every worker, created on first use"""
+    path = os.path.join(root, 'signing.key')
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Another worker may still be writing it
+        for _ in range(50):
+            with open(path, 'rb') as key_file:
+                secret = key_file.read()
+            if secret:
+                return secret
+            time.sleep(0.01)
+        raise RuntimeError(f"Empty signing key: {path}")
+    secret = os.urandom(32).hex().encode()
+    with os.fdopen(fd, 'wb') as key_file:
+        key_file.write(secret)
+    return secret
@@ -0,0 +1,326 @@
+"""
+Request and backend call metrics for Dropbox Clone
+
+Every Firestore and Storage call the app makes is a method call on one of
+the backend's client classes. instrument() wraps the methods that go to the
+backend, so each call is timed and counted as a read, write, head (an
+existence or metadata check) or sign (a signed URL), without touching the
+code that makes the calls. A call made inside another wrapped call, such as
+the get_all() behind a document get(), is part of it and isn't counted
+again.
+
+Calls made while a request is being served are counted against that
+request, including calls run on the backend thread pool for it, and added
+to its route's totals when the request finishes. Calls made anywhere else,
+such as by directory jobs, are counted under the route "background".
+
+Background pipelines report their jobs with observe_job(), timed per stage,
+and their queues with register_queue().
+
+render() formats everything in the Prometheus text format for /metrics.
+Like /cache-stats, the numbers are per worker process; every series carries
+the worker's pid, so scrapes landing on different workers don't look like
+counter resets.
+
+Requests slower than SLOW_REQUEST_MS are logged with their call counts.
+With PROFILE_PATH set, every request is sampled by a SamplingProfiler and
+slow ones leave a flame graph file there.
+"""
+import bisect
+import contextvars
+import functools
+import importlib
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from collections.abc import Iterator
+
+import config
+from sampling_profiler import SamplingProfiler
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Route label for backend calls made outside any request
+BACKGROUND = 'background'
+
+
+def _open_operation(blob, mode='rb', *args, **kwargs):
+    return 'write' if 'w' in mode else 'read'
+
+
+# Client methods that call the backend, per backend:
+# (module, class, service, {method: operation, or a function of the call's arguments})
+TRACED_METHODS = {
+    'firebase': [
+        ('google.cloud.firestore_v1.client', 'Client', 'firestore', {'get_all': 'read'}),
+        ('google.cloud.firestore_v1.document', 'DocumentReference', 'firestore', {
+            'get': 'read', 'create': 'write', 'set': 'write', 'update': 'write', 'delete': 'write'
+        }),
+        ('google.cloud.firestore_v1.query', 'Query', 'firestore', {'get': 'read', 'stream': 'read'}),
+        ('google.cloud.firestore_v1.collection', 'CollectionReference', 'firestore', {
+            'get': 'read', 'stream': 'read', 'add': 'write'
+        }),
+        ('google.cloud.firestore_v1.aggregation', 'AggregationQuery', 'firestore', {'get': 'read', 'stream': 'read'}),
+        ('google.cloud.firestore_v1.batch', 'WriteBatch', 'firestore', {'commit': 'write'}),
+        ('google.cloud.firestore_v1.transaction', 'Transaction', 'firestore', {
+            'get': 'read', 'get_all': 'read', '_commit': 'write'
+        }),
+        ('google.cloud.storage.blob', 'Blob', 'storage', {
+            'exists': 'head', 'reload': 'head', 'generate_signed_url': 'sign',
+            'download_as_bytes': 'read', 'download_as_string': 'read', 'download_as_text': 'read',
+            'download_to_file': 'read', 'download_to_filename': 'read',
+            'upload_from_string': 'write', 'upload_from_file': 'write', 'upload_from_filename': 'write',
+            'delete': 'write', 'compose': 'write', 'rewrite': 'write'
+        }),
+        ('google.cloud.storage.bucket', 'Bucket', 'storage', {
+            'get_blob': 'head', 'list_blobs': 'read', 'copy_blob': 'write', 'delete_blob': 'write', 'delete_blobs': 'write'
+        }),
+        # Files opened for writing upload as they are written
+        ('google.cloud.storage.fileio', 'BlobWriter', 'storage', {
+            '_initiate_upload': 'write', '_upload_chunks_from_buffer': 'write'
+        }),
+    ],
+    'local': [
+        ('local_store', 'SQLiteFirestore', 'firestore', {'get_all': 'read'}),
+        ('local_store', 'DocumentReference', 'firestore', {
+            'get': 'read', 'create': 'write', 'set': 'write', 'update': 'write', 'delete': 'write'
+        }),
+        ('local_store', 'Query', 'firestore', {'get': 'read', 'stream': 'read'}),
+        ('local_store', 'Aggregation', 'firestore', {'get': 'read'}),
+        ('local_store', 'WriteBatch', 'firestore', {'commit': 'write'}),
+        ('local_store', 'Transaction', 'firestore', {'get': 'read', 'get_all': 'read', '_commit': 'write'}),
+        ('local_store', 'LocalBlob', 'storage', {
+            'exists': 'head', 'generate_signed_url': 'sign', 'download_as_bytes': 'read',
+            'upload_from_string': 'write', 'delete': 'write', 'compose': 'write', 'open': _open_operation
+        }),
+        ('local_store', 'LocalBucket', 'storage', {'copy_blob': 'write'}),
+    ],
+}
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+
+class _Request:
+    """Backend calls made while serving one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.calls = Counter()
+
+
+_lock = threading.Lock()
+_request_seconds = defaultdict(_Histogram)  # (route, method)
+_slow_requests = Counter()                  # (route, method)
+_calls = Counter()                          # (route, service, operation)
+_call_seconds = defaultdict(_Histogram)     # (service, operation)
+_jobs = Counter()                           # (job, outcome)
+_job_seconds = defaultdict(_Histogram)      # (job, stage)
+_queues = {}                                # queue name: function returning its depth
+
+_current_request = contextvars.ContextVar('current_request', default=None)
+_inside_call = contextvars.ContextVar('inside_call', default=False)
+
+_instrumented = set()
+_instrument_lock = threading.Lock()
+
+profiler = SamplingProfiler(config.PROFILE_INTERVAL_MS / 1000, config.PROFILE_PATH) if config.PROFILE_PATH else None
+
+
+def _record(service, operation, seconds):
+    request = _current_request.get()
+    with _lock:
+        _call_seconds[(service, operation)].observe(seconds)
+        if request is None:
+            _calls[(BACKGROUND, service, operation)] += 1
+        else:
+            request.calls[(service, operation)] += 1
+
+
+def _traced_stream(results, service, operation, elapsed):
+    """Pass a query's results through, timing only the time spent fetching them"""
+    try:
+        while True:
+            token = _inside_call.set(True)
+            started = time.perf_counter()
+            try:
+                result = next(results)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - started
+                _inside_call.reset(token)
+            yield result
+    finally:
+        _record(service, operation, elapsed)
+
+
+def _traced(method, service, operation):
+    @functools.wraps(method)
+    def traced(*args, **kwargs):
+        if _inside_call.get():
+            return method(*args, **kwargs)
+        kind = operation(*args, **kwargs) if callable(operation) else operation
+        token = _inside_call.set(True)
+        started = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except BaseException:
+            _record(service, kind, time.perf_counter() - started)
+            raise
+        finally:
+            _inside_call.reset(token)
+        # Streamed query results are fetched while they are iterated
+        if service == 'firestore' and isinstance(result, Iterator):
+            return _traced_stream(result, service, kind, time.perf_counter() - started)
+        _record(service, kind, time.perf_counter() - started)
+        return result
+    return traced
+
+
+def instrument(backend):
+    """Wrap the client methods of a backend ('firebase' or 'local') that call it; idempotent"""
+    with _instrument_lock:
+        if backend in _instrumented:
+            return
+        for module_name, class_name, service, methods in TRACED_METHODS[backend]:
+            try:
+                cls = getattr(importlib.import_module(module_name), class_name)
+            except (ImportError, AttributeError):
+                # Not in this version of the client library
+                continue
+            for name, operation in methods.items():
+                if name in vars(cls):
+                    setattr(cls, name, _traced(vars(cls)[name], service, operation))
+        _instrumented.add(backend)
+
+
+def start_request():
+    """Start counting the current request's backend calls"""
+    _current_request.set(_Request())
+    if profiler:
+        profiler.watch(threading.get_ident())
+
+
+def finish_request(route, method):
+    """Add the current request to its route's metrics, logging and profiling it if it was slow"""
+    request = _current_request.get()
+    if request is None:
+        return
+    _current_request.set(None)
+    elapsed = time.perf_counter() - request.started
+    slow = elapsed * 1000 >= config.SLOW_REQUEST_MS
+    with _lock:
+        _request_seconds[(route, method)].observe(elapsed)
+        for (service, operation), count in request.calls.items():
+            _calls[(route, service, operation)] += count
+        if slow:
+            _slow_requests[(route, method)] += 1
+    samples = profiler.unwatch(threading.get_ident()) if profiler else None
+    if not slow:
+        return
+
+    calls = ', '.join(f"{service} {operation} x{count}" for (service, operation), count in sorted(request.calls.items()))
+    logger.warning(f"Slow request {method} {route}: {elapsed * 1000:.0f} ms, backend calls: {calls or 'none'}")
+    if samples:
+        path = profiler.dump(samples, f"{method} {route} {elapsed * 1000:.0f}ms")
+        logger.warning(f"Flame graph data for {method} {route} written to {path}")
+
+
+def observe_job(job, outcome, stages):
+    """Count a finished background job and time its stages, given as {stage: seconds}"""
+    with _lock:
+        _jobs[(job, outcome)] += 1
+        for stage, seconds in stages.items():
+            _job_seconds[(job, stage)].observe(seconds)
+
+
+def register_queue(name, depth):
+    """Report a queue's depth, read from `depth()` whenever metrics are rendered"""
+    with _lock:
+        _queues[name] = depth
+
+
+def _labels(names, values):
+    pairs = zip(names + ('worker',), values + (str(os.getpid()),))
+    escaped = (
+        (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _histogram_lines(name, help_text, label_names, histograms):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for key, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), histogram.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f"{name}_bucket{_labels(label_names + ('le',), key + (le,))} {cumulative}")
+        lines.append(f"{name}_sum{_labels(label_names, key)} {histogram.sum}")
+        lines.append(f"{name}_count{_labels(label_names, key)} {cumulative}")
+    return lines
+
+
+def _counter_lines(name, help_text, label_names, counts):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+    for key, count in sorted(counts.items()):
+        lines.append(f"{name}{_labels(label_names, key)} {count}")
+    return lines
+
+
+def _gauge_lines(name, help_text, label_names, values):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    for key, value in sorted(values.items()):
+        lines.append(f"{name}{_labels(label_names, key)} {value}")
+    return lines
+
+
+def _copy(histogram):
+    copy = _Histogram()
+    copy.counts = list(histogram.counts)
+    copy.sum = histogram.sum
+    return copy
+
+
+def render():
+    """All metrics of this worker in the Prometheus text format"""
+    with _lock:
+        request_seconds = {key: _copy(histogram) for key, histogram in _request_seconds.items()}
+        call_seconds = {key: _copy(histogram) for key, histogram in _call_seconds.items()}
+        calls = dict(_calls)
+        slow_requests = dict(_slow_requests)
+        jobs = dict(_jobs)
+        job_seconds = {key: _copy(histogram) for key, histogram in _job_seconds.items()}
+        queues = dict(_queues)
+    queue_depths = {(name,): depth() for name, depth in queues.items()}
+    lines = (
+        _histogram_lines('http_request_duration_seconds', 'Time to serve a request, until its body was sent.',
+                         ('route', 'method'), request_seconds)
+        + _counter_lines('http_slow_requests_total', f"Requests that took at least {config.SLOW_REQUEST_MS} ms.",
+                         ('route', 'method'), slow_requests)
+        + _counter_lines('backend_calls_total', 'Firestore and Storage calls, by the route that made them.',
+                         ('route', 'service', 'operation'), calls)
+        + _histogram_lines('backend_call_duration_seconds', 'Time taken by one Firestore or Storage call.',
+                           ('service', 'operation'), call_seconds)
+        + _counter_lines('background_jobs_total', 'Background jobs finished, by outcome.',
+                         ('job', 'outcome'), jobs)
+        + _histogram_lines('background_job_stage_duration_seconds', 'Time a background job spent in each stage.',
+                           ('job', 'stage'), job_seconds)
+        + _gauge_lines('background_queue_depth', 'Jobs waiting in a background queue.',
+                       ('queue',), queue_depths)
+    )
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Move users onto the ID-linked directory tree schema
+
+Backfills `parent_id` on the directories and files of each user written
+before it existed, then switches the user over, while the app keeps serving
+them (see directory_tree.migrate_user()). Users created since the schema was
+introduced are already on it and are skipped.
+
+Usage: python migrate_tree.py (--all | --uid UID [--uid UID ...]) [--settle SECONDS]
+"""
+import argparse
+import sys
+import time
+
+import config
+from app import db
+from directory_tree import start_migration, migrate_user
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    users = parser.add_mutually_exclusive_group(required=True)
+    users.add_argument('--uid', action='append', help='user to migrate (repeatable)')
+    users.add_argument('--all', action='store_true', help='migrate every user')
+    parser.add_argument('--settle', type=float, default=config.TREE_CACHE_TTL,
+                        help='seconds to wait for workers to see the migrating state')
+    args = parser.parse_args()
+
+    uids = args.uid or [user.id for user in db.collection('users').select([]).stream()]
+    pending = []
+    failed = 0
+    for uid in uids:
+        try:
+            if start_migration(db, uid):
+                pending.append(uid)
+        except RuntimeError as e:
+            print(e)
+            failed += 1
+
+    if pending:
+        print(f"Waiting {args.settle:.0f}s for workers to see {len(pending)} users migrating")
+        time.sleep(args.settle)
+    for uid in pending:
+        try:
+            migrate_user(db, uid)
+        except RuntimeError as e:
+            print(e)
+            failed += 1
+
+    print(f"{len(uids) - failed} of {len(uids)} users on the ID schema")
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Streaming NDJSON responses for Dropbox Clone
+
+Bulk endpoints can answer with newline-delimited JSON instead of one JSON
+document: each result is written to the response as soon as the Firestore
+stream yields it, so a worker holds one result at a time rather than the
+user's whole account, and the client sees the first result without waiting
+for the last.
+
+Every line is a JSON object. Result lines carry the result under the
+endpoint's key (e.g. {"shared_file": {...}}); the last line is a trailer,
+{"success": true, "done": true, "count": N}, or {"success": false,
+"message": ...} if the stream failed part-way. A response without a
+trailer was cut off.
+"""
+import time
+
+from flask import Response, current_app, request, stream_with_context
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Lines are sent in writes of about this many bytes, or sooner if this many
+# seconds have passed since the last write; the first line goes out alone
+FLUSH_BYTES = 64 * 1024
+FLUSH_INTERVAL = 0.05
+
+
+def wants_ndjson():
+    """Check whether the client asked for a streamed NDJSON response"""
+    return request.accept_mimetypes.best == NDJSON_MIMETYPE or bool((request.json or {}).get('stream'))
+
+
+def ndjson_lines(key, results, on_error=None):
+    """Encode results as NDJSON lines, ending with a trailer"""
+    # One encoder for the whole stream; flask.json.dumps() builds one per call
+    encode = current_app.json_encoder(separators=(',', ':')).encode
+    count = 0
+    pending = []
+    pending_bytes = 0
+    flushed_at = time.monotonic()
+    try:
+        for result in results:
+            line = encode({key: result}) + '\n'
+            count += 1
+            pending.append(line)
+            pending_bytes += len(line)
+            if count == 1 or pending_bytes >= FLUSH_BYTES or time.monotonic() - flushed_at >= FLUSH_INTERVAL:
+                yield ''.join(pending)
+                pending = []
+                pending_bytes = 0
+                flushed_at = time.monotonic()
+    except Exception as e:
+        # Headers are already sent, so the error goes in the body
+        if on_error is not None:
+            on_error(e)
+        pending.append(encode({'success': False, 'message': str(e)}) + '\n')
+        yield ''.join(pending)
+        return
+    pending.append(encode({'success': True, 'done': True, 'count': count}) + '\n')
+    yield ''.join(pending)
+
+
+def ndjson_response(key, results, on_error=None):
+    """Stream results to the client as NDJSON while they are produced"""
+    return Response(
+        stream_with_context(ndjson_lines(key, results, on_error)),
+        mimetype=NDJSON_MIMETYPE,
+        # Ask proxies such as nginx not to buffer the stream
+        headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'}
+    )
@@ -0,0 +1,308 @@
+"""
+Thumbnails and previews for Dropbox Clone
+
+Images and PDFs get two JPEG renditions when they are uploaded: a thumbnail
+for listings and a larger preview, each fitted into a square of
+PREVIEW_THUMBNAIL_SIZE and PREVIEW_SIZE pixels. They are stored as blobs of
+their own (see blob_store.preview_blob_name()) and recorded on the file as
+`previews`, so /preview serves them without reading the original.
+
+Rendering is CPU-bound, so it never runs on a request thread. Uploads add
+a job to a bounded queue and return. A few dispatcher threads take jobs
+off it, download the original, hand the bytes to a process pool for
+decoding and scaling, and upload the results. When the queue is full the
+job is dropped and the file stays `pending`; the first request for its
+preview queues it again. Every job is counted and timed per stage
+(queueing, download, render, upload) in /metrics.
+
+Images are rendered with Pillow and PDFs (their first page) with poppler's
+pdftoppm. Without them, files of that type are marked `unsupported`.
+
+Previews of content-addressed files are shared by every file with that
+content and recorded on its `blobs` document, so a second upload of the
+same bytes reuses them instead of rendering again.
+"""
+import concurrent.futures
+import io
+import logging
+import multiprocessing
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+from google.api_core.exceptions import NotFound
+
+import config
+import metrics
+from blob_store import CONTENT_PREFIX, content_key, file_blob_name, preview_blob_name
+from compression import decompress
+from listing_cache import MemoryStore
+
+logger = logging.getLogger(__name__)
+
+IMAGE_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff'}
+PDF_TYPE = 'application/pdf'
+
+PREVIEW_MIMETYPE = 'image/jpeg'
+JPEG_QUALITY = 80
+
+
+class PreviewUnavailable(Exception):
+    """A file this host can't render a preview of"""
+
+
+def _media_type(content_type):
+    return (content_type or '').split(';')[0].strip().lower()
+
+
+def previewable(content_type, size):
+    """Check whether a file of this type and size gets previews"""
+    media_type = _media_type(content_type)
+    return (media_type in IMAGE_TYPES or media_type == PDF_TYPE) and 0 < (size or 0) <= config.PREVIEW_MAX_SOURCE_BYTES
+
+
+def variant_sizes():
+    """Longest edge in pixels of each preview variant"""
+    return {'thumbnail': config.PREVIEW_THUMBNAIL_SIZE, 'preview': config.PREVIEW_SIZE}
+
+
+# Rendering, in the pool's worker processes
+
+def _pdf_first_page(data, size, timeout):
+    """The first page of a PDF as a PNG, fitted into `size` pixels"""
+    if shutil.which('pdftoppm') is None:
+        raise PreviewUnavailable('pdftoppm is not installed')
+    try:
+        result = subprocess.run(
+            ['pdftoppm', '-png', '-singlefile', '-f', '1', '-scale-to', str(size), '-'],
+            input=data, capture_output=True, timeout=timeout, check=True
+        )
+    except subprocess.CalledProcessError as e:
+        raise PreviewUnavailable(f"Unreadable PDF: {e.stderr.decode(errors='replace').strip()}")
+    return result.stdout
+
+
+def render_previews(data, content_type, sizes, timeout):
+    """
+    Render an image or PDF as one JPEG per variant.
+
+    Returns {variant: (bytes, width, height)}. Raises PreviewUnavailable for
+    files that can't be decoded here.
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        raise PreviewUnavailable('Pillow is not installed')
+
+    largest = max(sizes.values())
+    if _media_type(content_type) == PDF_TYPE:
+        data = _pdf_first_page(data, largest, timeout)
+    try:
+        image = Image.open(io.BytesIO(data))
+        # JPEGs can be decoded at a fraction of their size, which is much faster
+        image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image)
+    except (Image.DecompressionBombError, OSError, SyntaxError) as e:
+        raise PreviewUnavailable(f"Unreadable image: {e}")
+
+    if image.mode != 'RGB':
+        # JPEG has no transparency, so flatten onto white
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+
+    rendered = {}
+    # Largest first, so each variant is scaled down from the one before
+    for variant, size in sorted(sizes.items(), key=lambda item: -item[1]):
+        image.thumbnail((size, size))
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+        rendered[variant] = (output.getvalue(), image.width, image.height)
+    return rendered
+
+
+# Pipeline, in the web worker
+
+class PreviewPipeline:
+    """Bounded queue of preview jobs, run by dispatcher threads on a process pool"""
+
+    def __init__(self, db, bucket, workers, queue_size, timeout, cache_size, on_ready=None):
+        self.db = db
+        self.bucket = bucket
+        self.workers = workers
+        self.timeout = timeout
+        self.on_ready = on_ready
+        self.rejected = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        # Files queued or being rendered, so a file is never queued twice
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._threads = []
+        # Rendered previews never change, so cached bytes are only ever evicted
+        self._cache = MemoryStore(cache_size)
+        metrics.register_queue('previews', self._queue.qsize)
+
+    def _start(self):
+        # Started on first use, so nothing runs in a gunicorn master before it forks
+        if self._threads:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"preview-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # Forking a threaded web worker can copy held locks, so start clean processes
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._pool
+
+    def _reset_executor(self, pool, kill=False):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        if kill:
+            # A render past its timeout would hold its process for good
+            for process in list((pool._processes or {}).values()):
+                process.kill()
+        pool.shutdown(wait=False, cancel_futures=kill)
+
+    def submit(self, uid, file_id, file_data):
+        """
+        Queue a file's previews without waiting for room.
+
+        Returns False if previews are turned off or the queue is full; the
+        file then stays `pending` until its preview is asked for.
+        """
+        if not self.workers:
+            return False
+        with self._lock:
+            if file_id in self._queued:
+                return True
+            try:
+                self._queue.put_nowait((uid, file_id, file_data, time.perf_counter()))
+            except queue.Full:
+                self.rejected += 1
+                metrics.observe_job('preview', 'rejected', {})
+                return False
+            self._queued.add(file_id)
+            self._start()
+        return True
+
+    def _run(self):
+        while True:
+            uid, file_id, file_data, queued_at = self._queue.get()
+            try:
+                self._generate(uid, file_id, file_data, queued_at)
+            except Exception as e:
+                logger.warning(f"Preview job for file {file_id} failed: {e}")
+            finally:
+                with self._lock:
+                    self._queued.discard(file_id)
+
+    def _render(self, data, content_type):
+        pool = self._executor()
+        future = pool.submit(render_previews, data, content_type, variant_sizes(), self.timeout)
+        try:
+            return future.result(timeout=self.timeout)
+        except BrokenProcessPool:
+            # A worker process died (e.g. out of memory); the next job starts a new pool
+            self._reset_executor(pool)
+            raise
+        except concurrent.futures.TimeoutError:
+            # The render can't be interrupted, so its process is killed and
+            # the pool replaced; renders still running in it fail too
+            self._reset_executor(pool, kill=True)
+            raise
+
+    def _generate(self, uid, file_id, file_data, queued_at):
+        stages = {'queue': time.perf_counter() - queued_at}
+        file_ref = self.db.collection('files').document(file_id)
+        blob_name = file_blob_name(uid, file_data)
+        shared = blob_name.startswith(CONTENT_PREFIX)
+        blob_ref = self.db.collection('blobs').document(content_key(file_data)) if shared else None
+        previews = None
+        outcome = 'ready'
+        try:
+            if shared:
+                content = blob_ref.get()
+                previews = content.to_dict().get('previews') if content.exists else None
+                outcome = 'reused' if previews else outcome
+            if previews is None:
+                started = time.perf_counter()
+                data = decompress(self.bucket.blob(blob_name).download_as_bytes(), file_data.get('encoding'))
+                stages['download'] = time.perf_counter() - started
+
+                started = time.perf_counter()
+                rendered = self._render(data, file_data.get('content_type'))
+                stages['render'] = time.perf_counter() - started
+
+                started = time.perf_counter()
+                previews = {}
+                for variant, (image, width, height) in rendered.items():
+                    name = preview_blob_name(uid, file_id, blob_name, variant)
+                    self.bucket.blob(name).upload_from_string(image, content_type=PREVIEW_MIMETYPE)
+                    previews[variant] = {'blob_name': name, 'width': width, 'height': height, 'size': len(image)}
+                stages['upload'] = time.perf_counter() - started
+                if shared:
+                    blob_ref.update({'previews': previews})
+            file_ref.update({'previews': previews, 'preview_state': 'ready'})
+        except NotFound:
+            # The file (or its content) was deleted meanwhile; its previews go too
+            outcome = 'deleted'
+            if previews and not shared:
+                for preview in previews.values():
+                    self._delete_blob(preview['blob_name'])
+        except PreviewUnavailable as e:
+            outcome = 'unsupported'
+            logger.info(f"No preview for file {file_id}: {e}")
+            self._set_state(file_ref, 'unsupported')
+        except concurrent.futures.TimeoutError:
+            outcome = 'timeout'
+            self._set_state(file_ref, 'failed')
+        except Exception:
+            outcome = 'failed'
+            self._set_state(file_ref, 'failed')
+            raise
+        finally:
+            metrics.observe_job('preview', outcome, stages)
+
+        if self.on_ready is not None and outcome != 'deleted':
+            self.on_ready(uid, file_data)
+
+    def _set_state(self, file_ref, state):
+        try:
+            file_ref.update({'preview_state': state})
+        except NotFound:
+            pass
+
+    def _delete_blob(self, name):
+        try:
+            self.bucket.blob(name).delete()
+        except NotFound:
+            pass
+
+    def read(self, name):
+        """A preview's bytes, from this worker's cache or Storage"""
+        data = self._cache.get(name, 0)
+        if data is None:
+            data = self.bucket.blob(name).download_as_bytes()
+            self._cache.put(name, data, float('inf'))
+        return data
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queued': self._queue.qsize(),
+            'capacity': self._queue.maxsize,
+            'rejected': self.rejected,
+            'cached': len(self._cache)
+        }
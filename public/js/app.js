@@ -16,6 +16,37 @@ const duplicatesContainer = document.getElementById('duplicates-container');
 const allDuplicatesContainer = document.getElementById('all-duplicates-container');
 const sharedFilesContainer = document.getElementById('shared-files-container');
 
+// Directory listing pagination
+const LISTING_PAGE_SIZE = 100;
+let listingCursor = null;
+let listingLoading = false;
+let listingGeneration = 0;
+let listingSort = 'name';
+let listingOrder = 'asc';
+let duplicateFileIds = new Set();
+
+// Change feed cursor and poll timer, and the pending refresh of the listing on screen.
+// The feed is polled without waiting, so an open tab never holds a server thread
+let changeCursor = null;
+let changePollTimer = null;
+let changeRefreshTimer = null;
+const CHANGE_REFRESH_DELAY = 300;
+const CHANGE_POLL_INTERVAL = 10000;
+
+// Download URLs prefetched for the files on screen, by file ID
+const downloadUrls = new Map();
+// Seconds before a prefetched URL expires that it stops being used
+const DOWNLOAD_URL_MARGIN = 30;
+
+// Marks the end of what has been loaded; scrolling it into view loads the next page
+const listingSentinel = document.createElement('div');
+listingSentinel.className = 'listing-sentinel';
+const listingObserver = new IntersectionObserver(entries => {
+  if (entries.some(entry => entry.isIntersecting) && listingCursor) {
+    loadListingPage();
+  }
+});
+
 // Detect network status changes
 window.addEventListener('online', handleNetworkChange);
 window.addEventListener('offline', handleNetworkChange);
@@ -42,6 +73,58 @@ function checkNetworkBeforeRequest() {
   return true;
 }
 
+// POST to a bulk endpoint that streams NDJSON, collecting each line's `key`
+// entry into `listKey` so the result looks like the endpoint's JSON response
+function fetchNdjson(url, body, key, listKey) {
+  return fetch(url, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      'Accept': 'application/x-ndjson',
+    },
+    body: JSON.stringify(body),
+  })
+  .then(async response => {
+    if (!response.ok) {
+      throw new Error(`Server returned ${response.status}: ${response.statusText}`);
+    }
+    
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    const results = [];
+    let buffered = '';
+    let trailer = null;
+    
+    const handleLine = line => {
+      if (!line.trim()) return;
+      const record = JSON.parse(line);
+      if (key in record) {
+        results.push(record[key]);
+      } else {
+        trailer = record;
+      }
+    };
+    
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffered += decoder.decode(value, { stream: true });
+      const lines = buffered.split('\n');
+      buffered = lines.pop();
+      lines.forEach(handleLine);
+    }
+    handleLine(buffered + decoder.decode());
+    
+    if (!trailer) {
+      return { success: false, message: 'Response ended early' };
+    }
+    if (!trailer.success) {
+      return trailer;
+    }
+    return { success: true, [listKey]: results };
+  });
+}
+
 // Load contents of the current directory
 function loadCurrentDirectory(path) {
   // Check network status
@@ -57,6 +140,7 @@ function loadCurrentDirectory(path) {
   
   // If we're in the shared directory, load shared files
   if (isInSharedDirectory) {
+    resetListing();
     loadSharedFiles();
     return;
   }
@@ -64,47 +148,183 @@ function loadCurrentDirectory(path) {
   // Remove shared-files-layout class when not in shared directory
   fileList.classList.remove('shared-files-layout');
   
-  // Load directories
-  loadDirectories();
-  
-  // Load files
-  loadFiles();
+  // Load directories and files
+  loadListing();
   
   // Update breadcrumb navigation
   updateBreadcrumbs();
 }
 
-// Load directories in the current path
-function loadDirectories() {
+// Forget the loaded pages and ignore any page still in flight
+function resetListing() {
+  listingGeneration++;
+  listingCursor = null;
+  listingLoading = false;
+  placeListingSentinel();
+}
+
+// Load the current directory from its first page
+function loadListing() {
   if (!currentUser) return;
   
-  fetch('/get-directories', {
+  resetListing();
+  directoryList.innerHTML = '';
+  fileList.innerHTML = '';
+  loadListingPage();
+}
+
+// Fetch the next page of the current directory and append it
+function loadListingPage() {
+  if (listingLoading) return;
+  
+  const generation = listingGeneration;
+  const firstPage = listingCursor === null;
+  listingLoading = true;
+  
+  fetch('/list-directory', {
     method: 'POST',
     headers: {
       'Content-Type': 'application/json',
     },
     body: JSON.stringify({
       uid: currentUser.uid,
-      path: currentPath
+      path: currentPath,
+      sort: listingSort,
+      order: listingOrder,
+      page_size: LISTING_PAGE_SIZE,
+      cursor: listingCursor
     }),
   })
   .then(response => response.json())
   .then(data => {
+    // Drop pages of a listing that has since been reloaded
+    if (generation !== listingGeneration) return;
+    listingLoading = false;
+    
     if (data.success) {
       renderDirectories(data.directories);
+      renderFiles(data.files);
+      prefetchDownloadUrls(data.files.map(file => file.id));
+      listingCursor = data.next_cursor;
+      
+      if (!listingCursor && !fileList.querySelector('.file-item')) {
+        fileList.innerHTML = '<div class="empty-message">No files in this directory</div>';
+      }
+      placeListingSentinel();
+      
+      if (firstPage) {
+        checkForDuplicates();
+      }
     } else {
-      console.error('Error loading directories:', data.message);
+      console.error('Error loading directory:', data.message);
     }
   })
   .catch(error => {
-    console.error('Error loading directories:', error);
+    if (generation === listingGeneration) {
+      listingLoading = false;
+    }
+    console.error('Error loading directory:', error);
   });
 }
 
-// Render directories in the UI
-function renderDirectories(directories) {
-  directoryList.innerHTML = '';
+// Move the sentinel to the end of the list that the next page continues
+function placeListingSentinel() {
+  listingObserver.unobserve(listingSentinel);
+  listingSentinel.remove();
+  if (!listingCursor) return;
+  
+  const list = fileList.querySelector('.file-item') ? fileList : directoryList;
+  list.appendChild(listingSentinel);
+  // Observing again reports the sentinel's visibility right away, so a page
+  // that doesn't fill the list loads the next one
+  listingObserver.observe(listingSentinel);
+}
+
+// Follow the user's change feed, starting from its current cursor
+function watchChanges() {
+  stopWatchingChanges();
+  changeCursor = null;
+  pollChanges();
+}
+
+function stopWatchingChanges() {
+  clearTimeout(changePollTimer);
+  changePollTimer = null;
+  clearTimeout(changeRefreshTimer);
+}
+
+function pollChanges() {
+  const user = currentUser;
+  const next = delay => {
+    if (currentUser === user) changePollTimer = setTimeout(pollChanges, delay);
+  };
+  
+  // Hidden tabs catch up once they're shown again
+  if (document.hidden) {
+    next(CHANGE_POLL_INTERVAL);
+    return;
+  }
+  
+  fetch('/list-changes', {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({ uid: user.uid, cursor: changeCursor }),
+  })
+  .then(response => response.json())
+  .then(data => {
+    if (!data.success || currentUser !== user) return next(CHANGE_POLL_INTERVAL);
+    // Too far behind the feed to know what changed, so reload what's on screen
+    if (data.reset) scheduleRefresh();
+    data.changes.forEach(applyChange);
+    changeCursor = data.cursor;
+    next(data.has_more ? 0 : CHANGE_POLL_INTERVAL);
+  })
+  .catch(() => next(CHANGE_POLL_INTERVAL));
+}
+
+// Refresh only the parts of the view that a change touched
+function applyChange(change) {
+  if (change.kind === 'share') {
+    checkForSharedFiles();
+    if (isInSharedDirectory) scheduleRefresh();
+    return;
+  }
   
+  if (isInSharedDirectory) return;
+
+  // Follow the folder on screen if it was moved, or leave it if it was deleted
+  if (change.kind === 'directory' && change.type !== 'create') {
+    const removed = change.source || `${change.path}/${change.name}`.replace('//', '/');
+    if (currentPath === removed || currentPath.startsWith(removed + '/')) {
+      loadCurrentDirectory(change.type === 'move' ? change.target + currentPath.slice(removed.length) : change.path);
+      return;
+    }
+  }
+
+  // A moved or deleted directory takes the folders below it along
+  const affected = [change.path, change.source, change.target].filter(Boolean);
+  if (affected.some(path => path === currentPath || currentPath.startsWith(path.replace(/\/$/, '') + '/'))) {
+    scheduleRefresh();
+  }
+}
+
+// Reload the view once a burst of changes has settled
+function scheduleRefresh() {
+  clearTimeout(changeRefreshTimer);
+  changeRefreshTimer = setTimeout(() => {
+    if (!currentUser) return;
+    if (isInSharedDirectory) {
+      loadSharedFiles();
+    } else {
+      loadListing();
+    }
+  }, CHANGE_REFRESH_DELAY);
+}
+
+// Render a page of directories in the UI
+function renderDirectories(directories) {
   directories.forEach(dir => {
     const dirElement = document.createElement('div');
     dirElement.className = 'directory-item';
@@ -121,6 +341,12 @@ function renderDirectories(directories) {
       <div class="directory-name">${dir.name}</div>
       ${!dir.is_special ? `
         <div class="directory-actions">
+          <button class="btn-rename" data-id="${dir.id}" title="Rename directory">
+            <i class="fas fa-pen"></i>
+          </button>
+          <button class="btn-move" data-id="${dir.id}" title="Move directory">
+            <i class="fas fa-folder-open"></i>
+          </button>
           <button class="btn-delete" data-id="${dir.id}" title="Delete directory">
             <i class="fas fa-trash"></i>
           </button>
@@ -135,6 +361,24 @@ function renderDirectories(directories) {
         return;
       }
       
+      if (e.target.closest('.btn-rename')) {
+        e.stopPropagation();
+        const newName = prompt('New name for this directory:', dir.name);
+        if (newName && newName !== dir.name) {
+          moveDirectory(dir.id, { new_name: newName });
+        }
+        return;
+      }
+      
+      if (e.target.closest('.btn-move')) {
+        e.stopPropagation();
+        const targetPath = prompt('Move this directory into (e.g. /photos):', currentPath);
+        if (targetPath && targetPath !== currentPath) {
+          moveDirectory(dir.id, { target_path: targetPath });
+        }
+        return;
+      }
+      
       navigateToDirectory(dir.id);
     });
     
@@ -168,9 +412,9 @@ function navigateToDirectory(directoryId) {
   });
 }
 
-// Delete a directory
-function deleteDirectory(directoryId) {
-  if (confirm('Are you sure you want to delete this directory?')) {
+// Delete a directory; a non-empty one is deleted with its contents in the background
+function deleteDirectory(directoryId, recursive = false) {
+  if (recursive || confirm('Are you sure you want to delete this directory?')) {
     fetch('/delete-directory', {
       method: 'POST',
       headers: {
@@ -178,14 +422,21 @@ function deleteDirectory(directoryId) {
       },
       body: JSON.stringify({
         uid: currentUser.uid,
-        directory_id: directoryId
+        directory_id: directoryId,
+        recursive: recursive
       }),
     })
     .then(response => response.json())
     .then(data => {
-      if (data.success) {
+      if (data.success && data.job_id) {
+        watchJob(data.job_id, 'Deleting directory');
+      } else if (data.success) {
         showNotification('Directory deleted');
-        loadDirectories();
+        loadListing();
+      } else if (!recursive && data.message.startsWith('Cannot delete directory with')) {
+        if (confirm('This directory is not empty. Delete it and everything in it?')) {
+          deleteDirectory(directoryId, true);
+        }
       } else {
         showNotification(data.message, 'error');
       }
@@ -197,6 +448,82 @@ function deleteDirectory(directoryId) {
   }
 }
 
+// Move and/or rename a directory in the background
+function moveDirectory(directoryId, changes) {
+  fetch('/move-directory', {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({
+      uid: currentUser.uid,
+      directory_id: directoryId,
+      ...changes
+    }),
+  })
+  .then(response => response.json())
+  .then(data => {
+    if (data.success && data.job_id) {
+      watchJob(data.job_id, 'Moving directory');
+    } else if (data.success) {
+      showNotification('Directory moved');
+      loadListing();
+    } else {
+      showNotification(data.message, 'error');
+    }
+  })
+  .catch(error => {
+    console.error('Error moving directory:', error);
+    showNotification('Error moving directory', 'error');
+  });
+}
+
+// Poll a background directory job until it finishes, showing its progress
+function watchJob(jobId, label) {
+  showNotification(`${label}...`, 'info');
+  
+  function poll() {
+    fetch('/job-status', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({ uid: currentUser.uid, job_id: jobId }),
+    })
+    .then(response => response.json())
+    .then(data => {
+      if (!data.success) {
+        showNotification(data.message, 'error');
+        return;
+      }
+      
+      const job = data.job;
+      if (job.state === 'done') {
+        showNotification(`${label} finished`);
+        loadListing();
+      } else if (job.state === 'failed') {
+        showNotification(`${label} stopped: ${job.error}. Try again to resume it.`, 'error');
+        loadListing();
+      } else {
+        const done = job.processed_files + job.processed_directories;
+        if (job.total_files === null) {
+          showNotification(`${label}: ${done} items`, 'info');
+        } else {
+          const total = job.total_files + job.total_directories;
+          showNotification(`${label}: ${done} of ${total} items`, 'info');
+        }
+        setTimeout(poll, 1000);
+      }
+    })
+    .catch(error => {
+      console.error('Error checking job status:', error);
+      setTimeout(poll, 5000);
+    });
+  }
+  
+  poll();
+}
+
 // Create a new directory
 function createDirectory(directoryName) {
   // Validate directory name (alphanumeric, spaces, underscores, and hyphens only)
@@ -227,7 +554,7 @@ function createDirectory(directoryName) {
     if (data.success) {
       showNotification('Directory created');
       createDirForm.reset();
-      loadDirectories();
+      loadListing();
     } else {
       showNotification(data.message, 'error');
     }
@@ -238,55 +565,27 @@ function createDirectory(directoryName) {
   });
 }
 
-// Load files in the current path
-function loadFiles() {
-  if (!currentUser) return;
-  
-  fetch('/get-files', {
-    method: 'POST',
-    headers: {
-      'Content-Type': 'application/json',
-    },
-    body: JSON.stringify({
-      uid: currentUser.uid,
-      path: currentPath
-    }),
-  })
-  .then(response => response.json())
-  .then(data => {
-    if (data.success) {
-      renderFiles(data.files);
-      checkForDuplicates();
-    } else {
-      console.error('Error loading files:', data.message);
-    }
-  })
-  .catch(error => {
-    console.error('Error loading files:', error);
-  });
-}
-
-// Render files in the UI
+// Render a page of files in the UI
 function renderFiles(files) {
-  fileList.innerHTML = '';
-  
-  if (files.length === 0) {
-    fileList.innerHTML = '<div class="empty-message">No files in this directory</div>';
-    return;
-  }
-  
   files.forEach(file => {
     const fileElement = document.createElement('div');
     fileElement.className = 'file-item';
     fileElement.dataset.id = file.id;
     fileElement.dataset.hash = file.hash;
+    if (duplicateFileIds.has(file.id)) {
+      fileElement.classList.add('duplicate-file');
+    }
     
     const fileIcon = getFileIcon(file.name);
     const fileSize = formatFileSize(file.size);
+    // Images and PDFs show their thumbnail once it has been generated
+    const thumbnail = file.preview_state === 'ready'
+      ? `<img class="file-thumbnail" loading="lazy" alt="" src="/preview?uid=${encodeURIComponent(currentUser.uid)}&file_id=${encodeURIComponent(file.id)}&size=thumbnail">`
+      : `<i class="${fileIcon}"></i>`;
     
     fileElement.innerHTML = `
       <div class="file-icon">
-        <i class="${fileIcon}"></i>
+        ${thumbnail}
       </div>
       <div class="file-info">
         <div class="file-name">${file.name}</div>
@@ -370,8 +669,19 @@ function formatFileSize(bytes) {
   return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + ' ' + sizes[i];
 }
 
+// Files above this size are sent as parallel, resumable chunks
+const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024; // 8MB
+const CHUNK_UPLOAD_CONCURRENCY = 4;
+const CHUNK_UPLOAD_RETRIES = 3;
+
 // Upload a file
 function uploadFile(file, overwrite = false) {
+  // Large files go through the chunked upload API when the browser can hash chunks
+  if (file.size > CHUNKED_UPLOAD_THRESHOLD && window.crypto && window.crypto.subtle) {
+    uploadFileChunked(file, overwrite);
+    return;
+  }
+
   // Check file size (limit to 50MB)
   const MAX_FILE_SIZE = 50 * 1024 * 1024; // 50MB in bytes
   if (file.size > MAX_FILE_SIZE) {
@@ -405,11 +715,11 @@ function uploadFile(file, overwrite = false) {
     if (data.success) {
       showNotification('File uploaded successfully');
       fileUploadForm.reset();
-      loadFiles();
+      loadListing();
     } else if (data.needs_confirmation) {
       showConfirmationDialog(
         `File "${file.name}" already exists. Do you want to overwrite it?`,
-        () => uploadFile(file, true)
+        () => overwriteFile(file)
       );
     } else {
       showNotification(data.message, 'error');
@@ -425,8 +735,341 @@ function uploadFile(file, overwrite = false) {
   });
 }
 
+// Key used to remember an unfinished upload session for a file
+function uploadSessionKey(file) {
+  return `uploadSession:${currentUser.uid}:${currentPath}:${file.name}:${file.size}:${file.lastModified}`;
+}
+
+// Hex-encoded SHA-256 of a chunk
+function sha256Hex(buffer) {
+  return crypto.subtle.digest('SHA-256', buffer).then(digest => {
+    return Array.from(new Uint8Array(digest))
+      .map(b => b.toString(16).padStart(2, '0'))
+      .join('');
+  });
+}
+
+// Start a new upload session, or pick up an unfinished one for the same file
+function openUploadSession(file, overwrite) {
+  const savedSessionId = localStorage.getItem(uploadSessionKey(file));
+
+  const startNewSession = () => fetch('/upload-session/init', {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({
+      uid: currentUser.uid,
+      path: currentPath,
+      filename: file.name,
+      size: file.size,
+      content_type: file.type,
+      overwrite: overwrite
+    }),
+  })
+  .then(response => response.json())
+  .then(data => {
+    if (data.success) {
+      localStorage.setItem(uploadSessionKey(file), data.session_id);
+      data.received = [];
+    }
+    return data;
+  });
+
+  if (!savedSessionId) {
+    return startNewSession();
+  }
+
+  return fetch(`/upload-session/${savedSessionId}/status`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({
+      uid: currentUser.uid
+    }),
+  })
+  .then(response => response.json())
+  .then(data => {
+    if (!data.success) {
+      localStorage.removeItem(uploadSessionKey(file));
+      return startNewSession();
+    }
+    data.session_id = savedSessionId;
+    return data;
+  });
+}
+
+// Upload a single chunk, retrying on failure
+function uploadChunk(sessionId, file, index, chunkSize, attempt = 1) {
+  const chunk = file.slice(index * chunkSize, Math.min(file.size, (index + 1) * chunkSize));
+
+  return chunk.arrayBuffer()
+    .then(buffer => sha256Hex(buffer).then(hash => fetch(
+      `/upload-session/${sessionId}/chunk/${index}?uid=${encodeURIComponent(currentUser.uid)}`, {
+      method: 'PUT',
+      headers: {
+        'Content-Type': 'application/octet-stream',
+        'X-Chunk-SHA256': hash
+      },
+      body: buffer,
+    })))
+    .then(response => response.json())
+    .then(data => {
+      if (!data.success) {
+        throw new Error(data.message);
+      }
+    })
+    .catch(error => {
+      if (attempt >= CHUNK_UPLOAD_RETRIES) {
+        throw error;
+      }
+      return uploadChunk(sessionId, file, index, chunkSize, attempt + 1);
+    });
+}
+
+// Upload a large file as parallel chunks, then ask the server to assemble it
+function uploadFileChunked(file, overwrite = false) {
+  const uploadButton = fileUploadForm.querySelector('button[type="submit"]');
+  const originalText = uploadButton.textContent;
+  uploadButton.disabled = true;
+  uploadButton.textContent = 'Uploading...';
+
+  const resetButton = () => {
+    uploadButton.textContent = originalText;
+    uploadButton.disabled = false;
+  };
+
+  openUploadSession(file, overwrite)
+  .then(session => {
+    if (!session.success) {
+      resetButton();
+      if (session.needs_confirmation) {
+        showConfirmationDialog(
+          `File "${file.name}" already exists. Do you want to overwrite it?`,
+          () => overwriteFile(file)
+        );
+      } else {
+        showNotification(session.message, 'error');
+      }
+      return;
+    }
+
+    // Queue every chunk the server does not have yet
+    const received = new Set(session.received);
+    const pending = [];
+    for (let index = 0; index < session.chunk_count; index++) {
+      if (!received.has(index)) {
+        pending.push(index);
+      }
+    }
+
+    let completed = session.chunk_count - pending.length;
+    const worker = () => {
+      if (pending.length === 0) {
+        return Promise.resolve();
+      }
+      const index = pending.shift();
+      return uploadChunk(session.session_id, file, index, session.chunk_size).then(() => {
+        completed++;
+        uploadButton.textContent = `Uploading... ${Math.floor(completed / session.chunk_count * 100)}%`;
+        return worker();
+      });
+    };
+
+    const workers = [];
+    for (let i = 0; i < CHUNK_UPLOAD_CONCURRENCY; i++) {
+      workers.push(worker());
+    }
+
+    return Promise.all(workers)
+      .then(() => fetch(`/upload-session/${session.session_id}/commit`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+          uid: currentUser.uid,
+          overwrite: overwrite
+        }),
+      }))
+      .then(response => response.json())
+      .then(data => {
+        resetButton();
+
+        if (data.success) {
+          localStorage.removeItem(uploadSessionKey(file));
+          showNotification('File uploaded successfully');
+          fileUploadForm.reset();
+          loadListing();
+        } else if (data.needs_confirmation) {
+          showConfirmationDialog(
+            `File "${file.name}" already exists. Do you want to overwrite it?`,
+            () => overwriteFile(file)
+          );
+        } else {
+          showNotification(data.message, 'error');
+        }
+      });
+  })
+  .catch(error => {
+    // The session is kept, so retrying the same file resumes where it stopped
+    resetButton();
+    console.error('Error uploading file:', error);
+    showNotification('Error uploading file. Upload again to resume.', 'error');
+  });
+}
+
+// Content-defined chunking parameters, identical to chunking.py on the server
+const CDC_MIN_CHUNK_SIZE = 64 * 1024;
+const CDC_AVG_CHUNK_BITS = 18; // 256KB average
+const CDC_MAX_CHUNK_SIZE = 1024 * 1024;
+const CDC_GEAR_SEED = 0x9E3779B9;
+const CDC_BOUNDARY_MASK = (((1 << CDC_AVG_CHUNK_BITS) - 1) << (32 - CDC_AVG_CHUNK_BITS)) >>> 0;
+
+// Gear table from the same 32-bit PRNG the server uses
+const CDC_GEAR = (function() {
+  let state = CDC_GEAR_SEED;
+  const table = new Uint32Array(256);
+  for (let i = 0; i < 256; i++) {
+    state = (state + 0x6D2B79F5) >>> 0;
+    let t = Math.imul(state ^ (state >>> 15), state | 1);
+    t = (t + Math.imul(t ^ (t >>> 7), t | 61)) ^ t;
+    table[i] = (t ^ (t >>> 14)) >>> 0;
+  }
+  return table;
+})();
+
+// Length of the chunk at the start of `bytes` (which holds at most one max-size chunk)
+function findChunkBoundary(bytes) {
+  if (bytes.length <= CDC_MIN_CHUNK_SIZE) {
+    return bytes.length;
+  }
+  const limit = Math.min(bytes.length, CDC_MAX_CHUNK_SIZE);
+  let h = 0;
+  for (let i = CDC_MIN_CHUNK_SIZE; i < limit; i++) {
+    h = ((h << 1) + CDC_GEAR[bytes[i]]) >>> 0;
+    if ((h & CDC_BOUNDARY_MASK) === 0) {
+      return i + 1;
+    }
+  }
+  return limit;
+}
+
+// Split a file into content-defined blocks, reading one window at a time
+async function chunkFile(file) {
+  const blocks = [];
+  let offset = 0;
+  while (offset < file.size) {
+    const windowEnd = Math.min(file.size, offset + CDC_MAX_CHUNK_SIZE);
+    const bytes = new Uint8Array(await file.slice(offset, windowEnd).arrayBuffer());
+    const length = findChunkBoundary(bytes);
+    const hash = await sha256Hex(bytes.subarray(0, length));
+    blocks.push({ hash: hash, size: length, offset: offset });
+    offset += length;
+  }
+  return blocks;
+}
+
+// Replace an existing file, sending only the blocks the server doesn't have
+async function overwriteFile(file) {
+  if (!window.crypto || !window.crypto.subtle) {
+    uploadFile(file, true);
+    return;
+  }
+
+  const uploadButton = fileUploadForm.querySelector('button[type="submit"]');
+  const originalText = uploadButton.textContent;
+  uploadButton.disabled = true;
+  uploadButton.textContent = 'Comparing...';
+
+  try {
+    const blocks = await chunkFile(file);
+
+    const missingResponse = await fetch('/sync/missing-blocks', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({
+        uid: currentUser.uid,
+        hashes: blocks.map(block => block.hash)
+      }),
+    });
+    const missingData = await missingResponse.json();
+    if (!missingData.success) {
+      throw new Error(missingData.message);
+    }
+
+    // Upload each missing block once, a few at a time
+    const missing = new Set(missingData.missing);
+    const pending = blocks.filter(block => missing.delete(block.hash));
+    const total = pending.length;
+    let completed = 0;
+    const worker = async () => {
+      while (pending.length > 0) {
+        const block = pending.shift();
+        const body = await file.slice(block.offset, block.offset + block.size).arrayBuffer();
+        const response = await fetch(`/sync/block/${block.hash}?uid=${encodeURIComponent(currentUser.uid)}`, {
+          method: 'PUT',
+          headers: {
+            'Content-Type': 'application/octet-stream',
+          },
+          body: body,
+        });
+        const data = await response.json();
+        if (!data.success) {
+          throw new Error(data.message);
+        }
+        completed++;
+        uploadButton.textContent = `Uploading... ${completed}/${total} blocks`;
+      }
+    };
+    const workers = [];
+    for (let i = 0; i < CHUNK_UPLOAD_CONCURRENCY; i++) {
+      workers.push(worker());
+    }
+    await Promise.all(workers);
+
+    const commitResponse = await fetch('/sync/commit', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({
+        uid: currentUser.uid,
+        path: currentPath,
+        filename: file.name,
+        content_type: file.type,
+        overwrite: true,
+        blocks: blocks.map(block => ({ hash: block.hash, size: block.size }))
+      }),
+    });
+    const commitData = await commitResponse.json();
+    if (!commitData.success) {
+      throw new Error(commitData.message);
+    }
+
+    showNotification(`File updated (${total} of ${blocks.length} blocks sent)`);
+    fileUploadForm.reset();
+    loadListing();
+  } catch (error) {
+    console.error('Error uploading file:', error);
+    showNotification('Error uploading file', 'error');
+  } finally {
+    uploadButton.textContent = originalText;
+    uploadButton.disabled = false;
+  }
+}
+
 // Download a file
 function downloadFile(fileId) {
+  const prefetched = downloadUrls.get(fileId);
+  if (prefetched && prefetched.expiresAt > Date.now()) {
+    startDownload(prefetched.url, prefetched.filename);
+    return;
+  }
+  
   fetch('/get-download-url', {
     method: 'POST',
     headers: {
@@ -440,13 +1083,7 @@ function downloadFile(fileId) {
   .then(response => response.json())
   .then(data => {
     if (data.success) {
-      // Create temporary link and trigger download
-      const link = document.createElement('a');
-      link.href = data.url;
-      link.download = data.filename;
-      document.body.appendChild(link);
-      link.click();
-      document.body.removeChild(link);
+      startDownload(data.url, data.filename);
     } else {
       showNotification(data.message, 'error');
     }
@@ -457,6 +1094,56 @@ function downloadFile(fileId) {
   });
 }
 
+// Download the current directory, with its subdirectories, as one streamed ZIP
+function downloadFolderZip() {
+  if (!checkNetworkBeforeRequest() || isInSharedDirectory) return;
+  
+  const params = new URLSearchParams({ uid: currentUser.uid, path: currentPath });
+  startDownload(`/download-zip?${params}`, '');
+}
+
+// Create temporary link and trigger download
+function startDownload(url, filename) {
+  const link = document.createElement('a');
+  link.href = url;
+  link.download = filename;
+  document.body.appendChild(link);
+  link.click();
+  document.body.removeChild(link);
+}
+
+// Fetch download URLs for a page of files in one request, so clicks don't wait
+function prefetchDownloadUrls(fileIds) {
+  if (fileIds.length === 0) return;
+  
+  fetch('/get-download-urls', {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({
+      uid: currentUser.uid,
+      file_ids: fileIds
+    }),
+  })
+  .then(response => response.json())
+  .then(data => {
+    if (!data.success) return;
+    
+    const now = Date.now();
+    Object.entries(data.urls).forEach(([fileId, entry]) => {
+      downloadUrls.set(fileId, {
+        url: entry.url,
+        filename: entry.filename,
+        expiresAt: now + (entry.expires_in - DOWNLOAD_URL_MARGIN) * 1000
+      });
+    });
+  })
+  .catch(error => {
+    console.error('Error prefetching download URLs:', error);
+  });
+}
+
 // Delete a file
 function deleteFile(fileId) {
   if (confirm('Are you sure you want to delete this file?')) {
@@ -473,8 +1160,9 @@ function deleteFile(fileId) {
     .then(response => response.json())
     .then(data => {
       if (data.success) {
+        downloadUrls.delete(fileId);
         showNotification('File deleted');
-        loadFiles();
+        loadListing();
       } else {
         showNotification(data.message, 'error');
       }
@@ -553,6 +1241,9 @@ function checkForDuplicates() {
         title.textContent = 'Duplicate Files in Current Directory';
         duplicatesContainer.appendChild(title);
         
+        // Remember duplicates so files on later pages are highlighted too
+        duplicateFileIds = new Set(duplicates.map(file => file.id));
+        
         // Group duplicates by hash
         const duplicateGroups = {};
         duplicates.forEach(file => {
@@ -614,6 +1305,7 @@ function checkForDuplicates() {
           }
         });
       } else {
+        duplicateFileIds = new Set();
         duplicatesContainer.style.display = 'none';
       }
     }
@@ -628,16 +1320,7 @@ function findAllDuplicates() {
   // Show a loading notification
   showNotification('Scanning for duplicate files...', 'info');
   
-  fetch('/find-all-duplicates', {
-    method: 'POST',
-    headers: {
-      'Content-Type': 'application/json',
-    },
-    body: JSON.stringify({
-      uid: currentUser.uid
-    }),
-  })
-  .then(response => response.json())
+  fetchNdjson('/find-all-duplicates', { uid: currentUser.uid }, 'duplicate_group', 'duplicate_groups')
   .then(data => {
     if (data.success) {
       const allDuplicatesContainer = document.getElementById('all-duplicates-container');
@@ -862,21 +1545,7 @@ function loadSharedFiles() {
   updateBreadcrumbs();
   
   // Load shared files from server
-  fetch('/get-shared-files', {
-    method: 'POST',
-    headers: {
-      'Content-Type': 'application/json',
-    },
-    body: JSON.stringify({
-      uid: currentUser.uid
-    }),
-  })
-  .then(response => {
-    if (!response.ok) {
-      throw new Error(`Server returned ${response.status}: ${response.statusText}`);
-    }
-    return response.json();
-  })
+  fetchNdjson('/get-shared-files', { uid: currentUser.uid }, 'shared_file', 'shared_files')
   .then(data => {
     console.log("Shared files response:", data);
     
@@ -1455,15 +2124,16 @@ firebase.auth().onAuthStateChanged((user) => {
     // Setup session timeout
     setupSessionTimeout();
     
-    // Check for shared files immediately and then every 60 seconds
+    // Check for shared files immediately, then as the change feed reports new shares
     checkForSharedFiles();
-    setInterval(checkForSharedFiles, 60000);
+    watchChanges();
   } else {
     // User is signed out
     document.getElementById('login-container').style.display = 'flex';
     document.getElementById('app-container').style.display = 'none';
     
     // Reset current user
+    stopWatchingChanges();
     currentUser = null;
   }
 });
@@ -1504,6 +2174,17 @@ document.addEventListener('DOMContentLoaded', function() {
     hideShareForm();
   });
   
+  // Sort order of the directory listing
+  document.getElementById('listing-sort').addEventListener('change', function() {
+    [listingSort, listingOrder] = this.value.split(':');
+    loadListing();
+  });
+  
+  // Download the current folder as a ZIP
+  document.getElementById('download-zip-btn').addEventListener('click', function() {
+    downloadFolderZip();
+  });
+  
   // Find all duplicates button
   document.getElementById('find-all-duplicates-btn').addEventListener('click', function() {
     findAllDuplicates();
@@ -1581,16 +2262,7 @@ function checkForSharedFiles() {
   // Don't check while offline
   if (!isOnline) return;
   
-  fetch('/get-shared-files', {
-    method: 'POST',
-    headers: {
-      'Content-Type': 'application/json',
-    },
-    body: JSON.stringify({
-      uid: currentUser.uid
-    }),
-  })
-  .then(response => response.json())
+  fetchNdjson('/get-shared-files', { uid: currentUser.uid }, 'shared_file', 'shared_files')
   .then(data => {
     if (data.success && data.shared_files) {
       updateSharedFilesButton(data.shared_files.length);
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Check storage usage counters against users' files
+
+Scans the files of every user, or of the users given with --uid, and
+compares the totals with their usage counters (see usage.py), correcting
+any that drifted. With --dry-run it only reports. Run it from cron now and
+then, or after restoring files or changing USAGE_SHARDS.
+
+Usage: python reconcile_usage.py [--uid UID ...] [--dry-run]
+"""
+import argparse
+
+from app import db
+from usage import USER_SCOPE, reconcile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--uid', action='append', help='user to check (repeatable; default: every user)')
+    parser.add_argument('--dry-run', action='store_true', help='report drift without correcting it')
+    args = parser.parse_args()
+
+    uids = args.uid or (user.id for user in db.collection('users').select(['email']).stream())
+    checked = drifted = 0
+    for uid in uids:
+        checked += 1
+        drift = reconcile(db, uid, fix=not args.dry_run)
+        if not drift:
+            continue
+        drifted += 1
+        for scope, (counted, scanned) in sorted(drift.items()):
+            where = 'total' if scope == USER_SCOPE else f"directory {scope}"
+            found = 'directory deleted' if scanned is None else f"{scanned[0]} bytes in {scanned[1]} files"
+            print(f"{uid} {where}: counted {counted[0]} bytes in {counted[1]} files, {found}")
+
+    action = 'found' if args.dry_run else 'corrected'
+    print(f"Checked {checked} users, {action} drift for {drifted}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Sampling profiler for Dropbox Clone
+
+A background thread looks at the stacks of the threads it is watching every
+few milliseconds and counts each distinct stack. When a thread is no longer
+watched, its counts can be written out as folded stacks, one
+"outer;inner;innermost count" line per stack, which flamegraph.pl or
+speedscope turn into a flame graph.
+
+The request threads themselves do no work for the profiler, so it can
+watch every request and keep the samples only for the slow ones. Calls run
+on the backend thread pool show up as the request thread waiting for them.
+"""
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+
+def _folded(frame):
+    """One line of a folded stack: the frames from outermost to innermost"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    """Samples the stacks of watched threads every `interval` seconds"""
+
+    def __init__(self, interval, directory):
+        self.interval = interval
+        self.directory = directory
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._watching = threading.Event()
+        self._pid = None
+
+    def watch(self, thread_id):
+        """Start sampling a thread, discarding anything sampled from it before"""
+        with self._lock:
+            # The sampler thread doesn't survive a fork; start one per process
+            if self._pid != os.getpid():
+                self._samples = {}
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='profiler', daemon=True).start()
+            self._samples[thread_id] = Counter()
+            self._watching.set()
+
+    def unwatch(self, thread_id):
+        """Stop sampling a thread and return its samples, a Counter of folded stacks"""
+        with self._lock:
+            samples = self._samples.pop(thread_id, Counter())
+            if not self._samples:
+                self._watching.clear()
+        return samples
+
+    def _run(self):
+        while True:
+            self._watching.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self._samples.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[_folded(frame)] += 1
+
+    def dump(self, samples, label):
+        """Write samples to a new .folded file in the profile directory and return its path"""
+        os.makedirs(self.directory, exist_ok=True)
+        name = re.sub(r'[^A-Za-z0-9]+', '-', label).strip('-')
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{name}.folded")
+        with open(path, 'w') as profile:
+            for stack, count in samples.most_common():
+                profile.write(f"{stack} {count}\n")
+        return path
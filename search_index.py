@@ -0,0 +1,501 @@
+"""
+File and directory search for Dropbox Clone
+
+Firestore can't answer "every file whose name contains 'report'" without
+reading all of a user's files, so search runs against an index kept beside
+the app instead. Each user's index is a SQLite file under SEARCH_INDEX_PATH,
+shared by every worker on the host, with one row per file and directory:
+its name, the path of the directory it is in, content type, size and
+creation time.
+
+- Substring queries go through an FTS5 trigram index on names, so they
+  cost the same however many names there are. Queries shorter than three
+  characters can't use trigrams and match name prefixes instead. The
+  trigram tokenizer needs SQLite 3.34 or newer; with an older library,
+  substring queries scan the names in order instead.
+- Prefix queries and the size, date, type and path filters use ordinary
+  B-tree indexes.
+- Filters that match only a few entries, such as one small folder or the
+  tiny files, are searched through their own indexes first, and names are
+  checked on what they match; walking the names or dates in order would
+  mostly read entries the filters then throw away.
+
+A user's index is built from Firestore the first time they search, on a
+background thread. Until then searches report that the index is being
+built. Afterwards the routes that add and remove files and directories
+update it as they go, and directory moves rewrite the paths under the moved
+directory. Changes the index can't follow step by step, such as recursive
+directory jobs, mark it stale instead. The next search then answers from
+the stale index and starts a rebuild. A rebuild replaces the index in place
+without losing changes made while it runs.
+
+Changes made through another host reach this host's index only through a
+rebuild; set SEARCH_INDEX_MAX_AGE to rebuild indexes older than that.
+"""
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+# Results per search, by default and at most
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+# A build that hasn't made progress for this long is taken over by the next search
+BUILD_LEASE_SECONDS = 300
+
+# Rows written per transaction while building
+BUILD_BATCH_SIZE = 1000
+
+# Open index files per thread
+MAX_CONNECTIONS = 32
+
+# Filters matching fewer entries than this are searched through their own indexes
+SELECTIVE_ROWS = 500
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS entries ('
+    'id TEXT PRIMARY KEY, kind TEXT NOT NULL, name TEXT NOT NULL COLLATE NOCASE, path TEXT NOT NULL, '
+    'content_type TEXT, size INTEGER, created_at REAL, build INTEGER NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS by_name ON entries (name)',
+    'CREATE INDEX IF NOT EXISTS by_size ON entries (size)',
+    'CREATE INDEX IF NOT EXISTS by_created ON entries (created_at)',
+    # A type or folder, newest first or by name, without sorting all of its entries
+    'DROP INDEX IF EXISTS by_path',
+    'DROP INDEX IF EXISTS by_type',
+    'CREATE INDEX IF NOT EXISTS by_path_name ON entries (path, name)',
+    'CREATE INDEX IF NOT EXISTS by_type_created ON entries (content_type, created_at)',
+    'CREATE INDEX IF NOT EXISTS by_type_name ON entries (content_type, name)',
+    # Entries deleted while a build runs, so the build doesn't bring them back
+    'CREATE TABLE IF NOT EXISTS tombstones (id TEXT PRIMARY KEY)',
+    'CREATE TABLE IF NOT EXISTS state ('
+    'id INTEGER PRIMARY KEY CHECK (id = 0), build INTEGER NOT NULL DEFAULT 0, built_at REAL, '
+    'building_since REAL, stale INTEGER NOT NULL DEFAULT 0)',
+    'INSERT OR IGNORE INTO state (id) VALUES (0)',
+]
+
+# The trigram index on names, where SQLite supports it (see has_trigrams())
+NAMES_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS names USING fts5("
+    "name, content='entries', content_rowid='rowid', tokenize='trigram')",
+    'CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN '
+    'INSERT INTO names (rowid, name) VALUES (new.rowid, new.name); END',
+    'CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN '
+    "INSERT INTO names (names, rowid, name) VALUES ('delete', old.rowid, old.name); END",
+    'CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF name ON entries BEGIN '
+    "INSERT INTO names (names, rowid, name) VALUES ('delete', old.rowid, old.name); "
+    'INSERT INTO names (rowid, name) VALUES (new.rowid, new.name); END',
+]
+
+UPSERT = (
+    'INSERT INTO entries (id, kind, name, path, content_type, size, created_at, build) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET '
+    'kind = excluded.kind, name = excluded.name, path = excluded.path, content_type = excluded.content_type, '
+    'size = excluded.size, created_at = excluded.created_at, build = excluded.build'
+)
+
+# Sorts after every other character, for prefix ranges
+PREFIX_END = '\U0010ffff'
+
+COLUMNS = 'entries.id, kind, entries.name, path, content_type, size, created_at'
+
+
+class SearchError(ValueError):
+    """A search request that can't be run, such as an unknown filter value"""
+
+
+def _timestamp(value):
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return value if isinstance(value, (int, float)) else None
+
+
+def _parse_time(value, name):
+    if value in (None, ''):
+        return None
+    try:
+        moment = datetime.datetime.fromisoformat(str(value))
+    except ValueError:
+        raise SearchError(f"{name} must be an ISO 8601 date or time")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+def _parse_size(value, name):
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise SearchError(f"{name} must be a number of bytes")
+
+
+def has_trigrams():
+    """Whether this SQLite has FTS5 with the trigram tokenizer (3.34 or newer)"""
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute("CREATE VIRTUAL TABLE names USING fts5(name, tokenize='trigram')")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+
+
+def _like(text):
+    """A LIKE pattern matching `text` anywhere in a name"""
+    return '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def _join(parent, name):
+    return f"{parent}/{name}".replace('//', '/')
+
+
+def _phrase(text):
+    """An FTS5 query matching `text` anywhere in a name"""
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _within(path):
+    """SQL condition and parameters for entries in the directory at `path` or below it"""
+    if path in (None, '', '/'):
+        return None, []
+    path = path.rstrip('/')
+    # '0' is the character after '/', so this range is everything under path/
+    return '(path = ? OR (path >= ? AND path < ?))', [path, path + '/', path + '0']
+
+
+class SearchIndex:
+    """Per-user search indexes in SQLite files under `directory`"""
+
+    def __init__(self, directory, db, max_age=0, clock=time.time):
+        self.directory = directory
+        self.db = db
+        self.max_age = max_age
+        self.clock = clock
+        self.trigrams = has_trigrams()
+        if not self.trigrams:
+            logger.warning(f"SQLite {sqlite3.sqlite_version} has no trigram tokenizer, "
+                           f"substring searches will scan every name")
+        self._local = threading.local()
+
+    def _path(self, uid):
+        return os.path.join(self.directory, quote(uid, safe='') + '.db')
+
+    def _connection(self, uid, create=True):
+        """This thread's connection to a user's index, or None if it doesn't exist and `create` is false"""
+        # One connection per thread and user, and fresh ones after a fork
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connections = OrderedDict()
+            self._local.pid = os.getpid()
+        connections = self._local.connections
+        connection = connections.get(uid)
+        if connection is not None:
+            connections.move_to_end(uid)
+            return connection
+        path = self._path(uid)
+        if not create and not os.path.exists(path):
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA + (NAMES_SCHEMA if self.trigrams else []):
+            connection.execute(statement)
+        connections[uid] = connection
+        while len(connections) > MAX_CONNECTIONS:
+            connections.popitem(last=False)[1].close()
+        return connection
+
+    def _state(self, connection):
+        """(build, built_at, building_since, stale) of an index"""
+        return connection.execute('SELECT build, built_at, building_since, stale FROM state').fetchone()
+
+    # Incremental updates, made by the routes that change files and directories
+
+    def add_file(self, uid, file_id, file_data):
+        """Index a new or changed file; `file_data` has its name, path, size and content_type"""
+        self._upsert(uid, [(
+            file_id, 'file', file_data['name'], file_data['path'], file_data.get('content_type'),
+            file_data.get('size'), _timestamp(file_data.get('created_at')) or self.clock()
+        )])
+
+    def add_directory(self, uid, directory_id, name, parent_path):
+        self._upsert(uid, [(directory_id, 'directory', name, parent_path, None, None, self.clock())])
+
+    def _upsert(self, uid, rows):
+        connection = self._connection(uid, create=False)
+        if connection is None:
+            # Never searched on this host; the first search builds the index from Firestore
+            return
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            build = self._state(connection)[0]
+            connection.executemany(UPSERT, [row + (build,) for row in rows])
+
+    def remove(self, uid, entry_ids):
+        """Drop files or directories from the index"""
+        connection = self._connection(uid, create=False)
+        if connection is None or not entry_ids:
+            return
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('DELETE FROM entries WHERE id = ?', [(entry_id,) for entry_id in entry_ids])
+            if self._state(connection)[2] is not None:
+                connection.executemany(
+                    'INSERT OR IGNORE INTO tombstones (id) VALUES (?)', [(entry_id,) for entry_id in entry_ids]
+                )
+
+    def move(self, uid, directory_id, source, target):
+        """Record that the directory at `source` is now at `target`, with everything in it"""
+        connection = self._connection(uid, create=False)
+        if connection is None:
+            return
+        parent, _, name = target.rpartition('/')
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute(
+                'UPDATE entries SET name = ?, path = ? WHERE id = ?', (name, parent or '/', directory_id)
+            )
+            condition, params = _within(source)
+            connection.execute(
+                f"UPDATE entries SET path = ? || substr(path, ?) WHERE {condition}",
+                [target, len(source) + 1] + params
+            )
+            # A build running now may have read the old paths
+            connection.execute('UPDATE state SET stale = 1 WHERE building_since IS NOT NULL')
+
+    def invalidate(self, uid):
+        """Mark a user's index stale, so the next search rebuilds it"""
+        connection = self._connection(uid, create=False)
+        if connection is not None:
+            connection.execute('UPDATE state SET stale = 1')
+
+    # Building from Firestore
+
+    def ensure(self, uid):
+        """
+        Make sure a user's index is usable, starting a build if it needs one.
+
+        Returns True if searches can be answered (possibly from a stale index
+        while it is rebuilt), or False while the first build runs.
+        """
+        connection = self._connection(uid)
+        now = self.clock()
+        _, built_at, building_since, stale = self._state(connection)
+        outdated = built_at is None or stale or (self.max_age and now - built_at > self.max_age)
+        if outdated and (building_since is None or now - building_since > BUILD_LEASE_SECONDS):
+            self._start_build(uid, connection, now)
+        return built_at is not None
+
+    def _start_build(self, uid, connection, now):
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            _, _, building_since, _ = self._state(connection)
+            if building_since is not None and now - building_since <= BUILD_LEASE_SECONDS:
+                # Another worker claimed it first
+                return
+            connection.execute('UPDATE state SET build = build + 1, building_since = ?, stale = 0', (now,))
+            build = self._state(connection)[0]
+        threading.Thread(
+            target=self.load, args=(uid, self._scan(uid), build), name='search-index', daemon=True
+        ).start()
+
+    def _scan(self, uid):
+        """Rows for every directory and file of a user, read from Firestore"""
+        directories = {}
+        for directory in self.db.collection('directories').where('user_id', '==', uid).select(
+                ['name', 'path', 'parent_id', 'created_at']).stream():
+            directories[directory.id] = directory.to_dict()
+
+        paths = {}
+
+        def directory_path(directory_id, seen=()):
+            # Paths stored on the ID schema go stale; follow the parent links instead
+            if directory_id not in paths:
+                data = directories.get(directory_id)
+                parent_id = data and data.get('parent_id')
+                if data is None:
+                    paths[directory_id] = None
+                elif parent_id is None or parent_id not in directories or directory_id in seen:
+                    paths[directory_id] = data.get('path') or '/'
+                else:
+                    parent = directory_path(parent_id, seen + (directory_id,))
+                    paths[directory_id] = _join(parent, data['name']) if parent else data.get('path')
+            return paths[directory_id]
+
+        for directory_id, data in directories.items():
+            path = directory_path(directory_id)
+            if path and path != '/':
+                yield (directory_id, 'directory', data['name'], path.rpartition('/')[0] or '/',
+                       None, None, _timestamp(data.get('created_at')))
+
+        for file in self.db.collection('files').where('user_id', '==', uid).select(
+                ['name', 'path', 'parent_id', 'size', 'content_type', 'created_at']).stream():
+            data = file.to_dict()
+            path = directory_path(data['parent_id']) if data.get('parent_id') else None
+            yield (file.id, 'file', data['name'], path or data.get('path') or '/', data.get('content_type'),
+                   data.get('size'), _timestamp(data.get('created_at')))
+
+    def load(self, uid, rows, build):
+        """
+        Write a build's rows, then drop rows that no longer exist.
+
+        Rows written by the routes while this runs carry the new build number
+        too, so they survive the cleanup; rows they deleted are skipped.
+        """
+        connection = self._connection(uid)
+        batch = []
+
+        def flush():
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                deleted = {
+                    row[0] for row in connection.execute(
+                        f"SELECT id FROM tombstones WHERE id IN ({','.join('?' * len(batch))})",
+                        [row[0] for row in batch]
+                    )
+                }
+                connection.executemany(UPSERT, [row + (build,) for row in batch if row[0] not in deleted])
+                # Keep the lease while making progress
+                connection.execute('UPDATE state SET building_since = ?', (self.clock(),))
+            batch.clear()
+
+        try:
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= BUILD_BATCH_SIZE:
+                    flush()
+            if batch:
+                flush()
+        except BaseException:
+            connection.execute('UPDATE state SET building_since = NULL, stale = 1')
+            raise
+
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM entries WHERE build < ?', (build,))
+            connection.execute('DELETE FROM tombstones')
+            connection.execute('UPDATE state SET built_at = ?, building_since = NULL', (self.clock(),))
+
+    # Queries
+
+    def search(self, uid, query='', match='substring', kind=None, content_type=None, path=None,
+               min_size=None, max_size=None, created_after=None, created_before=None, limit=DEFAULT_LIMIT):
+        """
+        Find a user's files and directories.
+
+        `query` matches anywhere in the name ('substring') or at its start
+        ('prefix'), ignoring case. `content_type` matches exactly, or as a
+        prefix if it ends in '/' (e.g. 'image/'). `path` keeps entries in that
+        directory or below it. Sizes are in bytes and dates ISO 8601.
+
+        Substring matches come back sorted by name, but which ones make up the
+        `limit` is unspecified; prefix matches are the first by name. With no
+        query, the newest entries matching the filters come first.
+        """
+        if match not in ('substring', 'prefix'):
+            raise SearchError("match must be 'substring' or 'prefix'")
+        if kind not in (None, '', 'file', 'directory'):
+            raise SearchError("kind must be 'file' or 'directory'")
+        try:
+            limit = min(max(int(limit or DEFAULT_LIMIT), 1), MAX_LIMIT)
+        except (TypeError, ValueError):
+            raise SearchError('limit must be a number')
+        query = (query or '').strip()
+
+        conditions, params = [], []
+        if kind:
+            conditions.append('kind = ?')
+            params.append(kind)
+        if content_type:
+            if content_type.endswith('/'):
+                conditions.append('content_type >= ? AND content_type < ?')
+                params += [content_type, content_type + PREFIX_END]
+            else:
+                conditions.append('content_type = ?')
+                params.append(content_type)
+        condition, path_params = _within(path)
+        if condition:
+            conditions.append(condition)
+            params += path_params
+        for value, operator in ((_parse_size(min_size, 'min_size'), '>='), (_parse_size(max_size, 'max_size'), '<=')):
+            if value is not None:
+                conditions.append(f"size {operator} ?")
+                params.append(value)
+        for value, operator in ((_parse_time(created_after, 'created_after'), '>='),
+                                (_parse_time(created_before, 'created_before'), '<')):
+            if value is not None:
+                conditions.append(f"created_at {operator} ?")
+                params.append(value)
+
+        connection = self._connection(uid)
+        # Filters matching only a few entries are cheaper to read whole than to
+        # find by walking the names or dates in order and throwing most away
+        if conditions and self._count(connection, conditions, params, SELECTIVE_ROWS) < SELECTIVE_ROWS:
+            rows = connection.execute(f"SELECT {COLUMNS} FROM entries WHERE {' AND '.join(conditions)}", params)
+            return self._narrow(rows.fetchall(), query, match, limit)
+
+        if query and match == 'substring' and len(query) >= 3 and self.trigrams:
+            sql = (f"SELECT {COLUMNS} FROM names JOIN entries ON entries.rowid = names.rowid "
+                   f"WHERE names MATCH ?{''.join(' AND ' + c for c in conditions)} LIMIT ?")
+            params = [_phrase(query)] + params + [limit]
+            order = 'name'
+        elif query and match == 'substring' and len(query) >= 3:
+            conditions.insert(0, "name LIKE ? ESCAPE '\\'")
+            params = [_like(query)] + params
+            sql = f"SELECT {COLUMNS} FROM entries WHERE {' AND '.join(conditions)} ORDER BY name LIMIT ?"
+            params.append(limit)
+            order = None
+        elif query:
+            conditions.insert(0, 'name >= ? AND name < ?')
+            params = [query, query + PREFIX_END] + params
+            sql = f"SELECT {COLUMNS} FROM entries WHERE {' AND '.join(conditions)} ORDER BY name LIMIT ?"
+            params.append(limit)
+            order = None
+        else:
+            where = f"WHERE {' AND '.join(conditions)} " if conditions else ''
+            sql = f"SELECT {COLUMNS} FROM entries {where}ORDER BY created_at DESC LIMIT ?"
+            params.append(limit)
+            order = None
+
+        results = [self._result(row) for row in connection.execute(sql, params)]
+        if order:
+            results.sort(key=lambda result: result['name'].lower())
+        return results
+
+    def _count(self, connection, conditions, params, most):
+        """How many entries match `conditions`, counting no further than `most`"""
+        sql = f"SELECT count(*) FROM (SELECT 1 FROM entries WHERE {' AND '.join(conditions)} LIMIT ?)"
+        return connection.execute(sql, params + [most]).fetchone()[0]
+
+    def _narrow(self, rows, query, match, limit):
+        """Results among every entry matching the filters, as search() would pick and order them"""
+        needle = query.lower()
+        if match == 'substring' and len(query) >= 3:
+            rows = [row for row in rows if needle in row[2].lower()]
+        elif query:
+            rows = [row for row in rows if row[2].lower().startswith(needle)]
+        if query:
+            rows.sort(key=lambda row: row[2].lower())
+        else:
+            rows.sort(key=lambda row: row[6] if row[6] is not None else float('-inf'), reverse=True)
+        return [self._result(row) for row in rows[:limit]]
+
+    def _result(self, row):
+        entry_id, kind, name, path, content_type, size, created_at = row
+        result = {'id': entry_id, 'kind': kind, 'name': name, 'path': path}
+        if kind == 'file':
+            result.update(content_type=content_type, size=size)
+        else:
+            result['full_path'] = _join(path, name)
+        if created_at is not None:
+            result['created_at'] = datetime.datetime.fromtimestamp(created_at, datetime.timezone.utc).isoformat()
+        return result
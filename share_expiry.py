@@ -0,0 +1,115 @@
+"""
+Share expiry for Dropbox Clone
+
+Every share carries an `expires_at` timestamp. Reads only ask Firestore for
+shares that haven't expired (`where('expires_at', '>', now)`), so expired
+shares cost them nothing. They are deleted here instead, by a sweeper that
+runs in its own process (see sweep_shares.py). It finds expired shares with
+a range query on `expires_at` and deletes them a batch at a time.
+
+A Firestore TTL policy on `shared_files.expires_at` can do the same job
+without the sweeper. It may take a day or more to delete a document, which
+is fine because reads never depend on expired shares being gone.
+
+Shares of deleted files are flagged `file_missing` when the file is deleted
+(see duplicate_index.update_files()). flag_missing_files() backfills the
+flag on shares whose file was deleted before that (sweep_shares.py
+--flag-missing).
+
+Times are compared as UTC. Shares written before expiry times were stored
+with a timezone were written as naive datetimes, which Firestore stores
+as UTC.
+"""
+import datetime
+import time
+
+from datastore import BATCH_LIMIT, get_all, delete_all, write_batch
+
+
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def expiration_of(share_data):
+    """Return a share's expiry as a timezone-aware datetime, or None if it has none"""
+    expires_at = share_data.get('expires_at')
+    if not isinstance(expires_at, datetime.datetime):
+        return None
+    if expires_at.tzinfo is None:
+        return expires_at.replace(tzinfo=datetime.timezone.utc)
+    return expires_at
+
+
+def is_expired(share_data, now):
+    expiration = expiration_of(share_data)
+    return expiration is not None and expiration <= now
+
+
+def active_shares_query(db, uid, now):
+    """Shares with a user that haven't expired by `now`"""
+    return db.collection('shared_files').where('shared_with', '==', uid).where('expires_at', '>', now)
+
+
+def sweep_expired_shares(db, clock=utc_now, batch_size=BATCH_LIMIT):
+    """
+    Delete every share that has expired, a batch at a time.
+
+    The cutoff is read from `clock` once, so shares expiring while the sweep
+    runs are left for the next one. Returns the number of shares deleted.
+    """
+    now = clock()
+    expired = (db.collection('shared_files')
+               .where('expires_at', '<=', now)
+               .order_by('expires_at')
+               .limit(batch_size)
+               .select([]))
+    deleted = 0
+    while True:
+        batch = expired.get()
+        delete_all(db, (share.reference for share in batch))
+        deleted += len(batch)
+        if len(batch) < batch_size:
+            return deleted
+
+
+def _flag_missing(db, shares):
+    files = get_all(db, (db.collection('files').document(share.get('file_id')) for share in shares))
+    missing = [share for share in shares if not files[share.get('file_id')].exists]
+    write_batch(db, (('update', share.reference, {'file_missing': True}) for share in missing))
+    return len(missing)
+
+
+def flag_missing_files(db, batch_size=BATCH_LIMIT):
+    """Flag every share whose file no longer exists; returns the number flagged"""
+    flagged = 0
+    batch = []
+    for share in db.collection('shared_files').select(['file_id', 'file_missing']).stream():
+        if share.to_dict().get('file_missing'):
+            continue
+        batch.append(share)
+        if len(batch) >= batch_size:
+            flagged += _flag_missing(db, batch)
+            batch = []
+    if batch:
+        flagged += _flag_missing(db, batch)
+    return flagged
+
+
+def run_sweeper(db, interval, clock=utc_now, sleep=time.sleep, log=print, rounds=None):
+    """
+    Sweep expired shares every `interval` seconds.
+
+    Runs forever unless `rounds` is given. A failed sweep is logged and
+    retried on the next round.
+    """
+    completed = 0
+    while rounds is None or completed < rounds:
+        started = time.monotonic()
+        try:
+            deleted = sweep_expired_shares(db, clock)
+            log(f"Deleted {deleted} expired shares in {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            log(f"Error sweeping expired shares: {str(e)}")
+        completed += 1
+        if rounds is None or completed < rounds:
+            sleep(interval)
@@ -0,0 +1,96 @@
+"""
+Signed download URL cache for Dropbox Clone
+
+Signing a V4 URL costs an RSA signature, and working out what to sign costs
+a Firestore read (and for shares a blob.exists() check). A URL stays valid
+until it expires, so the cache hands the same one out again until shortly
+before then. Entries are keyed by what the client asked for, a file or a
+share, so a hit needs no backend calls at all.
+
+The cache is per worker process. Deleting a file or removing a share drops
+its entry here. Another worker may still hand out its copy of the URL until
+it expires, and that URL then fails the same way one issued just before the
+delete would.
+"""
+import threading
+import time
+
+from listing_cache import MemoryStore
+
+
+class SignedUrlCache:
+    """Reuses signed URLs until `margin` seconds before they expire"""
+
+    def __init__(self, max_entries, ttl, margin, clock=time.time):
+        self.store = MemoryStore(max_entries)
+        self.ttl = ttl
+        self.margin = margin
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.signed = 0
+        self.sign_cpu_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return a cached entry dict (with 'expires_in' refreshed), or None"""
+        now = self.clock()
+        entry = self.store.get(key, now)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return dict(entry, expires_in=int(entry['expires_at'] - now))
+
+    def sign(self, key, blob, disposition, extra=None, not_after=None):
+        """
+        Sign a GET URL for a blob and cache it under `key`.
+
+        `extra` is stored alongside the URL (e.g. the filename); `not_after`
+        is a timestamp past which the entry must not be reused even if the
+        URL is still valid, such as when a share expires.
+        """
+        started = time.thread_time()
+        now = self.clock()
+        url = blob.generate_signed_url(
+            version="v4",
+            expiration=self.ttl,
+            method="GET",
+            response_disposition=disposition
+        )
+        with self._lock:
+            self.signed += 1
+            self.sign_cpu_seconds += time.thread_time() - started
+
+        expires_at = now + self.ttl
+        reuse_until = expires_at - self.margin
+        if not_after is not None:
+            reuse_until = min(reuse_until, not_after)
+        entry = dict(extra or {}, url=url, expires_at=expires_at)
+        if reuse_until > now:
+            self.store.put(key, entry, reuse_until)
+        return dict(entry, expires_in=self.ttl)
+
+    def invalidate(self, key):
+        self.store.delete(key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.store),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'signed': self.signed,
+            'sign_cpu_ms_per_url': round(1000 * self.sign_cpu_seconds / self.signed, 3) if self.signed else 0.0,
+            'url_ttl_seconds': self.ttl
+        }
+
+
+def file_key(file_id):
+    return f"file:{file_id}"
+
+
+def share_key(share_id):
+    return f"share:{share_id}"
@@ -0,0 +1,126 @@
+"""
+Streaming upload pipeline for Dropbox Clone
+
+Pipes an incoming file stream to a resumable Cloud Storage upload in
+fixed-size chunks, hashing each chunk as it passes through, so a worker
+never holds more than a couple of chunks of any upload in memory. Chunks
+can be compressed on the way (see compression.py).
+"""
+import hashlib
+import itertools
+from collections import namedtuple
+
+import config
+from compression import choose_codec, compressor
+
+# Resumable upload chunks must be a multiple of 256 KiB
+CHUNK_SIZE_MULTIPLE = 256 * 1024
+
+
+# What stream_to_blob() wrote: the MD5 and SHA-256 hex digests and size of
+# the bytes as sent, and how they are stored (see compression.py)
+StreamedBlob = namedtuple('StreamedBlob', ['md5', 'sha256', 'size', 'encoding', 'stored_size'])
+
+
+class MemoryLimitExceeded(Exception):
+    """Raised when an upload would buffer more bytes than the memory limit allows"""
+
+
+def held_bytes(chunk, data, unsent):
+    """
+    Bytes of an upload in memory while `data`, made from `chunk`, is written:
+    the chunk, the data if it's a compressed copy, and the writer's buffer,
+    which holds the `unsent` bytes of earlier writes and a copy of `data`
+    until it can upload a whole chunk.
+    """
+    return len(chunk) + (len(data) if data is not chunk else 0) + unsent + len(data)
+
+
+def validate_chunk_size(chunk_size, memory_limit):
+    """
+    Make sure a chunk size is usable for resumable uploads and fits the memory
+    limit. Uncompressed uploads then always fit; compressed ones can need up
+    to twice as much, and stream_to_blob() refuses those that would.
+    """
+    if chunk_size <= 0 or chunk_size % CHUNK_SIZE_MULTIPLE != 0:
+        raise ValueError(f'Chunk size must be a positive multiple of {CHUNK_SIZE_MULTIPLE} bytes')
+
+    # One chunk being read plus its copy in the upload session's buffer
+    if 2 * chunk_size > memory_limit:
+        raise ValueError(
+            f'Chunk size {chunk_size} needs {2 * chunk_size} bytes of buffer, '
+            f'which exceeds the upload memory limit of {memory_limit} bytes'
+        )
+
+
+def read_chunk(stream, size):
+    """Read exactly `size` bytes from a stream, or fewer only at end of stream"""
+    chunk = stream.read(size)
+    if not chunk or len(chunk) == size:
+        return chunk
+
+    # Some streams return short reads, keep going until the chunk is full
+    buffer = bytearray(chunk)
+    while len(buffer) < size:
+        more = stream.read(size - len(buffer))
+        if not more:
+            break
+        buffer.extend(more)
+    return bytes(buffer)
+
+
+def iter_chunks(stream, chunk_size):
+    """Yield fixed-size chunks from a stream until it is exhausted"""
+    while True:
+        chunk = read_chunk(stream, chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def stream_to_blob(stream, blob, content_type=None, chunk_size=None, memory_limit=None, compress=False):
+    """
+    Upload a stream to a blob through a resumable upload session.
+
+    With `compress`, the bytes are stored compressed if the compression
+    policy picks a codec for them, judged by the first chunk.
+
+    Returns a StreamedBlob; the encoding is None for bytes stored as they
+    are. The stream is read once; nothing is rewound or read into memory as
+    a whole.
+    """
+    chunk_size = chunk_size or config.UPLOAD_CHUNK_SIZE
+    memory_limit = memory_limit or config.UPLOAD_MEMORY_LIMIT
+    validate_chunk_size(chunk_size, memory_limit)
+
+    chunks = iter_chunks(stream, chunk_size)
+    first = next(chunks, b'')
+    encoding = choose_codec(content_type, first) if compress else None
+    encoder = compressor(encoding) if encoding else None
+
+    file_hash = hashlib.md5()
+    content_hash = hashlib.sha256()
+    size = 0
+    stored = 0
+
+    with blob.open('wb', chunk_size=chunk_size, content_type=content_type) as writer:
+        for chunk in itertools.chain([first] if first else [], chunks):
+            file_hash.update(chunk)
+            content_hash.update(chunk)
+            data = encoder.compress(chunk) if encoder else chunk
+
+            # The writer uploads every whole chunk it has, so it is still
+            # holding what's left over from the bytes written so far
+            held = held_bytes(chunk, data, stored % chunk_size)
+            if held > memory_limit:
+                raise MemoryLimitExceeded(f'Upload would hold {held} bytes in memory (limit {memory_limit})')
+            writer.write(data)
+            size += len(chunk)
+            stored += len(data)
+
+        if encoder:
+            data = encoder.flush()
+            writer.write(data)
+            stored += len(data)
+
+    return StreamedBlob(file_hash.hexdigest(), content_hash.hexdigest(), size, encoding, stored)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Delete expired shares
+
+Runs the share expiry sweeper (see share_expiry.py) as its own process,
+either once, for a cron job, or in a loop every --interval seconds, for a
+background worker. --flag-missing first flags shares of files deleted
+before deletes did so themselves; it only needs to run once.
+
+Usage: python sweep_shares.py [--once] [--interval SECONDS] [--flag-missing]
+"""
+import argparse
+
+import config
+from app import db
+from share_expiry import flag_missing_files, run_sweeper
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--once', action='store_true', help='sweep once and exit')
+    parser.add_argument('--interval', type=float, default=config.SHARE_SWEEP_INTERVAL,
+                        help='seconds between sweeps')
+    parser.add_argument('--flag-missing', action='store_true',
+                        help='first flag shares whose file was deleted')
+    args = parser.parse_args()
+
+    if args.flag_missing:
+        print(f"Flagged {flag_missing_files(db)} shares of deleted files")
+    try:
+        run_sweeper(db, args.interval, rounds=1 if args.once else None)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""
+Delete expired upload sessions
+
+Chunked uploads that were never committed leave their chunks under
+{uid}/.upload-sessions/ and their session documents behind. Sessions stop
+taking chunks UPLOAD_SESSION_TTL_HOURS after they were started; this deletes
+them with their chunks. Run it from cron, e.g. hourly.
+
+Usage: python sweep_upload_sessions.py
+"""
+import argparse
+
+from app import bucket, db
+from upload_sessions import sweep_expired_sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.parse_args()
+
+    print(f"Deleted {sweep_expired_sessions(db, bucket)} expired upload sessions")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Tests for share_expiry.py, run against the in-memory Firestore of the benchmarks
+
+Usage: python -m pytest tests
+"""
+import datetime
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from fake_firestore import FakeFirestore
+from share_expiry import run_sweeper
+
+START = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class FakeClock:
+    """A clock that only moves when something sleeps on it"""
+
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += datetime.timedelta(seconds=seconds)
+
+
+class RunSweeperTest(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeFirestore()
+        self.clock = FakeClock(START)
+        self.logged = []
+        for share_id, hours in [('now', 0), ('soon', 1), ('later', 3), ('forever', None)]:
+            expires_at = START + datetime.timedelta(hours=hours) if hours is not None else None
+            self.db.collection('shared_files').document(share_id).set(
+                {'shared_with': 'user', 'expires_at': expires_at}
+            )
+
+    def remaining(self):
+        return sorted(share.id for share in self.db.collection('shared_files').stream())
+
+    def test_sweeps_each_round(self):
+        run_sweeper(self.db, 3600, clock=self.clock, sleep=self.clock.sleep, log=self.logged.append, rounds=3)
+
+        self.assertEqual(self.remaining(), ['forever', 'later'])
+        self.assertEqual(self.clock.sleeps, [3600, 3600])
+        self.assertEqual([message.split(' in ')[0] for message in self.logged],
+                         ['Deleted 1 expired shares', 'Deleted 1 expired shares', 'Deleted 0 expired shares'])
+
+    def test_failed_round_is_retried(self):
+        failures = [RuntimeError('unavailable')]
+
+        def clock():
+            if failures:
+                raise failures.pop()
+            return self.clock()
+
+        run_sweeper(self.db, 60, clock=clock, sleep=self.clock.sleep, log=self.logged.append, rounds=2)
+
+        self.assertEqual(self.remaining(), ['forever', 'later', 'soon'])
+        self.assertEqual(self.logged[0], 'Error sweeping expired shares: unavailable')
+        self.assertTrue(self.logged[1].startswith('Deleted 1 expired shares'))
+        self.assertEqual(self.clock.sleeps, [60])
+
+
+if __name__ == '__main__':
+    unittest.main()
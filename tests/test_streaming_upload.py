@@ -0,0 +1,99 @@
+"""
+Tests for streaming_upload.py, run against the in-memory bucket of the benchmarks
+
+Usage: python -m pytest tests
+"""
+import hashlib
+import io
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import streaming_upload
+from fake_storage import FakeBucket
+from streaming_upload import CHUNK_SIZE_MULTIPLE, MemoryLimitExceeded, stream_to_blob, validate_chunk_size
+
+CHUNK_SIZE = CHUNK_SIZE_MULTIPLE
+
+
+class WatchedStream(io.BytesIO):
+    """A stream that remembers the largest read asked of it"""
+
+    largest_read = 0
+
+    def read(self, size=-1):
+        self.largest_read = max(self.largest_read, size if size >= 0 else len(self.getvalue()))
+        return super().read(size)
+
+
+class WatchedBucket(FakeBucket):
+    """A bucket whose writers remember the most bytes they held before uploading them"""
+
+    most_held = 0
+
+    def blob(self, name):
+        blob = super().blob(name)
+        opened = blob.open
+        bucket = self
+
+        def open_blob(mode='rb', **kwargs):
+            writer = opened(mode, **kwargs)
+            write = writer.write
+
+            def watched_write(data):
+                held = writer._buffer.tell() - writer._uploaded + len(data)
+                bucket.most_held = max(bucket.most_held, held)
+                return write(data)
+
+            writer.write = watched_write
+            return writer
+
+        blob.open = open_blob
+        return blob
+
+
+class StreamToBlobTest(unittest.TestCase):
+    def test_streams_in_chunks(self):
+        data = random.Random(0).randbytes(5 * CHUNK_SIZE + 123)
+        stream = WatchedStream(data)
+        bucket = WatchedBucket()
+
+        streamed = stream_to_blob(stream, bucket.blob('file'), chunk_size=CHUNK_SIZE, memory_limit=2 * CHUNK_SIZE)
+
+        self.assertEqual(streamed.md5, hashlib.md5(data).hexdigest())
+        self.assertEqual(streamed.sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual((streamed.size, streamed.stored_size, streamed.encoding), (len(data), len(data), None))
+        self.assertEqual(bucket.blob('file').download_as_bytes(), data)
+        self.assertLessEqual(stream.largest_read, CHUNK_SIZE)
+        self.assertLessEqual(bucket.most_held, CHUNK_SIZE)
+
+    def test_refuses_compressed_upload_over_the_limit(self):
+        # Compresses well at first, so the writer is left holding a partial
+        # chunk when random bytes that don't compress follow
+        data = bytes(CHUNK_SIZE) + random.Random(0).randbytes(4 * CHUNK_SIZE)
+        original = streaming_upload.choose_codec
+        streaming_upload.choose_codec = lambda content_type, first_chunk: 'gzip'
+        try:
+            with self.assertRaises(MemoryLimitExceeded):
+                stream_to_blob(io.BytesIO(data), FakeBucket().blob('file'), chunk_size=CHUNK_SIZE,
+                               memory_limit=2 * CHUNK_SIZE, compress=True)
+            streamed = stream_to_blob(io.BytesIO(data), FakeBucket().blob('file'), chunk_size=CHUNK_SIZE,
+                                      memory_limit=4 * CHUNK_SIZE, compress=True)
+        finally:
+            streaming_upload.choose_codec = original
+        self.assertEqual((streamed.size, streamed.encoding), (len(data), 'gzip'))
+
+    def test_validate_chunk_size(self):
+        validate_chunk_size(CHUNK_SIZE, 2 * CHUNK_SIZE)
+        with self.assertRaises(ValueError):
+            validate_chunk_size(CHUNK_SIZE + 1, 4 * CHUNK_SIZE)
+        with self.assertRaises(ValueError):
+            validate_chunk_size(2 * CHUNK_SIZE, 3 * CHUNK_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
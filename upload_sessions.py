@@ -0,0 +1,123 @@
+"""
+Chunked upload sessions for Dropbox Clone
+
+A session is created up front, numbered chunks are uploaded to their own
+blobs (in any order, by any worker), and the chunks are composed into the
+final blob on commit. All session state lives in Firestore and Storage so
+no worker has to remember anything between requests.
+
+A session takes chunks and commits for UPLOAD_SESSION_TTL_HOURS. After
+that, sweep_expired_sessions() deletes its chunks and documents (see
+sweep_upload_sessions.py).
+"""
+import hashlib
+import math
+
+from google.api_core.exceptions import NotFound
+
+import config
+from datastore import BATCH_LIMIT, delete_all
+from share_expiry import utc_now
+from streaming_upload import iter_chunks
+
+# Cloud Storage accepts at most this many sources per compose call
+MAX_COMPOSE_SOURCES = 32
+
+
+def chunk_count(size, chunk_size):
+    """Number of chunks needed for a file of the given size (at least one)"""
+    return max(1, math.ceil(size / chunk_size))
+
+
+def expected_chunk_size(index, size, chunk_size):
+    """Size in bytes the chunk at `index` must have"""
+    if size == 0:
+        return 0
+    last_index = chunk_count(size, chunk_size) - 1
+    if index < last_index:
+        return chunk_size
+    return size - chunk_size * last_index
+
+
+def chunk_blob_name(uid, session_id, index):
+    """Storage name of an uploaded chunk"""
+    return f"{uid}/.upload-sessions/{session_id}/{index:06d}"
+
+
+def verify_chunk(data, expected_sha256):
+    """Check a chunk against the SHA-256 digest the client sent with it"""
+    return hashlib.sha256(data).hexdigest() == (expected_sha256 or '').lower()
+
+
+def compose_blobs(bucket, sources, destination, content_type=None):
+    """
+    Compose any number of blobs into `destination`.
+
+    Compose only takes 32 sources at a time, so larger uploads are merged in
+    rounds through intermediate blobs, which are deleted afterwards.
+    """
+    intermediates = []
+    round_number = 0
+
+    while len(sources) > MAX_COMPOSE_SOURCES:
+        merged = []
+        for start in range(0, len(sources), MAX_COMPOSE_SOURCES):
+            group = sources[start:start + MAX_COMPOSE_SOURCES]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            part = bucket.blob(f"{destination.name}.compose-{round_number}-{start // MAX_COMPOSE_SOURCES}")
+            part.compose(group)
+            intermediates.append(part)
+            merged.append(part)
+        sources = merged
+        round_number += 1
+
+    destination.content_type = content_type
+    destination.compose(sources)
+
+    for part in intermediates:
+        part.delete()
+
+
+def hash_blob(blob, chunk_size=None):
+    """Stream a blob back from Storage and return its MD5 and SHA-256 hex digests"""
+    file_hash = hashlib.md5()
+    content_hash = hashlib.sha256()
+    with blob.open('rb', chunk_size=chunk_size or config.UPLOAD_CHUNK_SIZE) as reader:
+        for chunk in iter_chunks(reader, chunk_size or config.UPLOAD_CHUNK_SIZE):
+            file_hash.update(chunk)
+            content_hash.update(chunk)
+    return file_hash.hexdigest(), content_hash.hexdigest()
+
+
+def sweep_expired_sessions(db, bucket, clock=utc_now, batch_size=BATCH_LIMIT):
+    """
+    Delete every expired upload session with its chunks, a batch at a time.
+
+    Returns the number of sessions deleted.
+    """
+    expired = (db.collection('upload_sessions')
+               .where('expires_at', '<=', clock())
+               .order_by('expires_at')
+               .limit(batch_size)
+               .select(['user_id', 'chunk_count']))
+    deleted = 0
+    while True:
+        batch = expired.get()
+        for session in batch:
+            _delete_session(db, bucket, session)
+        deleted += len(batch)
+        if len(batch) < batch_size:
+            return deleted
+
+
+def _delete_session(db, bucket, session):
+    # Every chunk the session could have, as a chunk may be stored before it's recorded
+    for index in range(session.get('chunk_count')):
+        try:
+            bucket.blob(chunk_blob_name(session.get('user_id'), session.id, index)).delete()
+        except NotFound:
+            pass
+    chunks = session.reference.collection('chunks').select([]).stream()
+    delete_all(db, [chunk.reference for chunk in chunks] + [session.reference])
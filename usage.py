@@ -0,0 +1,224 @@
+"""
+Storage usage and quotas for Dropbox Clone
+
+Adding up a user's usage from their file records means reading every one of
+them, so usage is kept in counters instead, updated in the same transaction
+that creates or deletes a file record (see duplicate_index.py). Each user
+has USAGE_SHARDS counter documents for their total, and each directory
+USAGE_SHARDS more for the files directly in it, keyed by directory ID so
+moves and renames leave them alone. A write increments one shard picked at
+random, so concurrent uploads by one user rarely contend for a document;
+reading a total reads every shard, in the same round trip as the user
+document.
+
+Sizes are counted as recorded on the files: content shared between files by
+content-addressed storage or delta sync counts once per file.
+
+Quotas are checked before an upload is accepted. Uploads racing each other
+can all pass the check, so a user can end up over their quota by at most
+the uploads they had in flight.
+
+reconcile() compares a user's counters with a full scan of their files and
+corrects any drift. Users whose files predate the counters are reconciled
+on first use.
+"""
+import random
+from collections import defaultdict
+
+from firebase_admin import firestore
+
+import config
+from datastore import get_all
+
+COLLECTION = 'usage_counters'
+
+# Scope of a user's total; every other scope is a directory ID
+USER_SCOPE = 'user'
+
+# Values per Firestore 'in' filter
+IN_QUERY_LIMIT = 10
+
+
+class QuotaExceeded(Exception):
+    """An upload that would take a user over their storage quota"""
+
+
+def counter_ref(db, uid, scope, shard):
+    return db.collection(COLLECTION).document(f"{uid}_{scope}_{shard}")
+
+
+def counter_writes(db, uid, changes):
+    """
+    Transaction writes applying file changes to a user's counters.
+
+    `changes` holds (directory ID, bytes, files) deltas, e.g. (parent_id,
+    size, 1) for a new file; each is also added to the user's total. Returns
+    ('set', ref, data, True) operations, one per scope that changed.
+    """
+    deltas = defaultdict(lambda: [0, 0])
+    for directory_id, size, count in changes:
+        for scope in (USER_SCOPE, directory_id):
+            if scope is not None:
+                deltas[scope][0] += size or 0
+                deltas[scope][1] += count
+    return [
+        ('set', counter_ref(db, uid, scope, random.randrange(config.USAGE_SHARDS)), {
+            'user_id': uid,
+            'scope': scope,
+            'bytes': firestore.Increment(size),
+            'files': firestore.Increment(count)
+        }, True)
+        for scope, (size, count) in deltas.items()
+        if size or count
+    ]
+
+
+def _total(snapshots):
+    size = count = 0
+    for snapshot in snapshots:
+        if snapshot.exists:
+            counter = snapshot.to_dict()
+            size += counter.get('bytes', 0)
+            count += counter.get('files', 0)
+    return {'bytes': size, 'files': count}
+
+
+def read_usage(db, uid, directory_ids=()):
+    """
+    A user's document and usage, in one round trip.
+
+    Returns (user data, usage), where usage maps USER_SCOPE and each of
+    `directory_ids` to {'bytes': ..., 'files': ...}.
+    """
+    user_ref = db.collection('users').document(uid)
+    scopes = [USER_SCOPE] + list(directory_ids)
+    refs = {scope: [counter_ref(db, uid, scope, shard) for shard in range(config.USAGE_SHARDS)] for scope in scopes}
+    snapshots = get_all(db, [user_ref] + [ref for scope_refs in refs.values() for ref in scope_refs])
+    user = snapshots[uid].to_dict() or {}
+    usage = {scope: _total(snapshots[ref.id] for ref in scope_refs) for scope, scope_refs in refs.items()}
+    return user, usage
+
+
+def quota_of(user):
+    """A user's quota in bytes, or None if they have none"""
+    quota = user.get('quota_bytes', config.DEFAULT_QUOTA_BYTES)
+    return quota or None
+
+
+def ensure_counters(db, uid, user):
+    """Reconcile a user's counters on first use if their files predate them; returns True if it did"""
+    if user.get('usage_counters') == 'ready':
+        return False
+    # Writes keep the counters up to date from here on; the scan adds what came before
+    reconcile(db, uid)
+    db.collection('users').document(uid).set({'usage_counters': 'ready'}, merge=True)
+    return True
+
+
+def get_usage(db, uid, directory_ids=()):
+    """A user's document and usage (see read_usage()), reconciling legacy users first"""
+    user, usage = read_usage(db, uid, directory_ids)
+    if ensure_counters(db, uid, user):
+        user, usage = read_usage(db, uid, directory_ids)
+    return user, usage
+
+
+def check_quota(db, uid, added_bytes):
+    """Raise QuotaExceeded if `added_bytes` more would take a user over their quota"""
+    user, usage = read_usage(db, uid)
+    quota = quota_of(user)
+    if quota is None or added_bytes <= 0:
+        return
+    if ensure_counters(db, uid, user):
+        user, usage = read_usage(db, uid)
+    free = max(quota - usage[USER_SCOPE]['bytes'], 0)
+    if added_bytes > free:
+        raise QuotaExceeded(f"Not enough storage: this upload needs {added_bytes} bytes, "
+                            f"{free} of your {quota} bytes are free")
+
+
+# Reconciliation
+
+def _scan(db, uid):
+    """(bytes, files) per scope from the user's file records, with (0, 0) for empty directories"""
+    totals = defaultdict(lambda: (0, 0))
+    for directory in db.collection('directories').where('user_id', '==', uid).select(['name']).stream():
+        totals[directory.id] = (0, 0)
+    totals[USER_SCOPE] = (0, 0)
+    for file in db.collection('files').where('user_id', '==', uid).select(['size', 'parent_id']).stream():
+        file_data = file.to_dict()
+        size = file_data.get('size') or 0
+        for scope in (USER_SCOPE, file_data.get('parent_id')):
+            if scope is not None:
+                totals[scope] = (totals[scope][0] + size, totals[scope][1] + 1)
+    return dict(totals)
+
+
+def _count(counters):
+    totals = defaultdict(lambda: (0, 0))
+    for counter in counters:
+        counter_data = counter.to_dict()
+        scope = counter_data['scope']
+        totals[scope] = (totals[scope][0] + counter_data.get('bytes', 0), totals[scope][1] + counter_data.get('files', 0))
+    return totals
+
+
+def _differences(db, uid):
+    """{scope: (counted, scanned)} for scopes whose counters disagree with the files; None scanned means gone"""
+    counted = _count(db.collection(COLLECTION).where('user_id', '==', uid).stream())
+    scanned = _scan(db, uid)
+    return {
+        scope: (counted.get(scope, (0, 0)), scanned.get(scope))
+        for scope in set(counted) | set(scanned)
+        if counted.get(scope, (0, 0)) != scanned.get(scope, (0, 0)) or scope not in scanned
+    }
+
+
+def _correct(db, uid, targets):
+    """Bring the counters of a few scopes to their scanned totals, deleting those of directories that are gone"""
+    @firestore.transactional
+    def correct(transaction):
+        query = db.collection(COLLECTION).where('user_id', '==', uid).where('scope', 'in', list(targets))
+        counters = list(transaction.get(query))
+        counted = _count(counters)
+        for counter in counters:
+            if targets[counter.get('scope')] is None:
+                transaction.delete(counter.reference)
+        for scope, target in targets.items():
+            if target is None:
+                continue
+            size, count = target[0] - counted[scope][0], target[1] - counted[scope][1]
+            if size or count:
+                transaction.set(counter_ref(db, uid, scope, 0), {
+                    'user_id': uid,
+                    'scope': scope,
+                    'bytes': firestore.Increment(size),
+                    'files': firestore.Increment(count)
+                }, merge=True)
+
+    correct(db.transaction())
+
+
+def reconcile(db, uid, fix=True):
+    """
+    Check a user's counters against a full scan of their files, correcting drift.
+
+    A file written between reading the counters and scanning makes them
+    differ for a moment, so only differences that a second pass sees again
+    are drift. Corrections are computed inside a transaction from the
+    counters as they are then, so two reconciliations at once correct once.
+
+    Returns {scope: (counted, scanned)} for the scopes that drifted, each a
+    (bytes, files) pair; scanned is None for directories that no longer
+    exist, whose counters are deleted.
+    """
+    first = _differences(db, uid)
+    if not first:
+        return {}
+    second = _differences(db, uid)
+    drift = {scope: difference for scope, difference in second.items() if first.get(scope) == difference}
+    if fix:
+        scopes = list(drift)
+        for start in range(0, len(scopes), IN_QUERY_LIMIT):
+            _correct(db, uid, {scope: drift[scope][1] for scope in scopes[start:start + IN_QUERY_LIMIT]})
+    return drift
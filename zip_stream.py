@@ -0,0 +1,153 @@
+"""
+Streamed ZIP archives for Dropbox Clone
+
+Builds a ZIP archive on the fly while it is being sent: each member's bytes
+are read from Storage in chunks, written into the archive and handed to the
+response straight away. Nothing touches the disk and no member is ever held
+whole, so memory stays bounded however large the archive gets.
+
+While one member is being sent, the next few are already being read on
+background threads into small bounded queues. Memory is therefore at most
+about (read_ahead + 1) * queue_depth * chunk_size bytes per download, plus
+the few hundred bytes per member that the central directory at the end needs.
+
+Members are stored uncompressed (most large files are already compressed),
+and sizes and CRCs are written after each member's data, so the archive can
+be produced without seeking.
+"""
+import contextvars
+import datetime
+import io
+import queue
+import threading
+import zipfile
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# An archive member: its path inside the archive, size in bytes,
+# modification time, and whatever the read function needs to fetch it
+ZipEntry = namedtuple('ZipEntry', ['name', 'size', 'modified', 'source'])
+
+_END = object()
+
+
+class _Sink(io.RawIOBase):
+    """Write-only, unseekable buffer that the archive is written into and drained from"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        return len(data)
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+class _ReadAhead:
+    """Reads one member's chunks on a background thread into a bounded queue"""
+
+    def __init__(self, executor, chunks, depth, stop):
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = stop
+        executor.submit(contextvars.copy_context().run, self._run, chunks)
+
+    def _put(self, item):
+        # Give up once the download is abandoned, so no thread stays blocked
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, chunks):
+        try:
+            for chunk in chunks():
+                if not self._put(chunk):
+                    return
+            self._put(_END)
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+def zip_date_time(value):
+    """Convert a timestamp to the (year, month, day, hour, minute, second) ZIP stores"""
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.now()
+    # ZIP dates start in 1980
+    return max(value.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def unique_name(name, seen):
+    """Return `name`, or 'name (2).ext', 'name (3).ext', ... if already in `seen`; add it to `seen`"""
+    candidate = name
+    stem, dot, extension = name.rpartition('.')
+    if not stem:
+        stem, dot, extension = name, '', ''
+    copy = 2
+    while candidate in seen:
+        candidate = f"{stem} ({copy}){dot}{extension}"
+        copy += 1
+    seen.add(candidate)
+    return candidate
+
+
+def iter_zip(entries, read_chunks, read_ahead=2, queue_depth=4):
+    """
+    Yield a ZIP archive of `entries` as a sequence of byte strings.
+
+    `read_chunks(entry)` must return an iterator over the member's bytes;
+    it is called on a background thread up to `read_ahead` members early.
+    """
+    entries = iter(entries)
+    sink = _Sink()
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=read_ahead + 1, thread_name_prefix='zip-read')
+    pending = deque()
+
+    def schedule():
+        while len(pending) <= read_ahead:
+            entry = next(entries, None)
+            if entry is None:
+                return
+            chunks = _ReadAhead(executor, lambda entry=entry: read_chunks(entry), queue_depth, stop)
+            pending.append((entry, chunks))
+
+    try:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            schedule()
+            while pending:
+                entry, chunks = pending.popleft()
+                schedule()
+
+                info = zipfile.ZipInfo(entry.name, date_time=zip_date_time(entry.modified))
+                info.compress_type = zipfile.ZIP_STORED
+                with archive.open(info, 'w', force_zip64=entry.size >= zipfile.ZIP64_LIMIT) as member:
+                    for chunk in chunks:
+                        member.write(chunk)
+                        yield sink.drain()
+                data = sink.drain()
+                if data:
+                    yield data
+        # The central directory, written when the archive closes
+        yield sink.drain()
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)